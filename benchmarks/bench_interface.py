@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Benchmark the overheads of the drive-casa interface.
+
+Measures:
+
+- spawn latency (time to create a :class:`.Casapy` instance, including
+  loading subroutines),
+- per-command round-trip overhead of ``run_script``,
+- time to collect the output of a verbose command (e.g. ``log2term``
+  logging),
+- throughput (commands / second) for scripts of various lengths, for each
+  engine, transport and batching mode.
+
+By default casapy is replaced by the fake from :mod:`drivecasa.testing`, so
+the figures reflect drive-casa's own overheads rather than CASA's. Pass
+``--casa-dir`` to benchmark against a real installation. Since the commands
+are executed by the fake's interpreter, set ``FAKE_CASA_PYTHON`` if the
+default ``python`` is not suitable. Example::
+
+    python benchmarks/bench_interface.py --sizes 1 10 10000
+"""
+from __future__ import print_function
+
+import argparse
+import logging
+import shutil
+import tempfile
+import time
+
+import drivecasa
+from drivecasa.testing import fake_casa_dir
+
+
+def time_spawn(casa_kwargs, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        casa = drivecasa.Casapy(**casa_kwargs)
+        timings.append(time.time() - start)
+        casa.close()
+    return min(timings)
+
+
+def time_script(casa, n_commands, batch_size, repeat):
+    script = ['_dc_bench = {}'.format(i) for i in range(n_commands)]
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        casa.run_script(script, batch_size=batch_size)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def time_output(casa, n_lines, repeat):
+    script = ["for _dc_bench in range({}): print 'x' * 79".format(n_lines)]
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        casa.run_script(script)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def bench_session(casa_kwargs, args):
+    print("  Spawn latency: {:.3f}s".format(
+        time_spawn(casa_kwargs, args.repeat)))
+    casa = drivecasa.Casapy(**casa_kwargs)
+    round_trip = time_script(casa, 1, None, args.repeat * 10)
+    print("  Round-trip (single command): {:.2f}ms".format(
+        round_trip * 1000))
+    print("  Output of {} lines: {:.3f}s".format(
+        args.output_lines, time_output(casa, args.output_lines, args.repeat)))
+    print("  {:>10} {:>10} {:>12} {:>14}".format(
+        'commands', 'batch', 'elapsed/s', 'commands/s'))
+    for batch_size in args.batch_sizes:
+        for n_commands in args.sizes:
+            if batch_size is None and n_commands > args.max_unbatched:
+                print("  {:>10} {:>10} {:>12}".format(
+                    n_commands, 'none', 'skipped'))
+                continue
+            elapsed = time_script(casa, n_commands, batch_size,
+                                  args.repeat)
+            print("  {:>10} {:>10} {:>12.3f} {:>14.1f}".format(
+                n_commands, str(batch_size).lower(), elapsed,
+                n_commands / elapsed))
+    casa.close()
+
+
+def parse_batch_size(value):
+    return None if value.lower() == 'none' else int(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--casa-dir', default=fake_casa_dir,
+                        help="CASA installation to benchmark "
+                             "(default: the bundled fake casapy)")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 10000],
+                        help="Script lengths to time (default: %(default)s)")
+    parser.add_argument('--output-lines', type=int, default=100000,
+                        help="Lines of output for the verbose command "
+                             "(default: %(default)s)")
+    parser.add_argument('--engines', nargs='+', default=['pty', 'pipe'],
+                        help="Engines to compare (default: %(default)s)")
+    parser.add_argument('--transports', nargs='+', default=['pty', 'fifo'],
+                        help="Transports to compare (default: %(default)s)")
+    parser.add_argument('--batch-sizes', type=parse_batch_size, nargs='+',
+                        default=[None, 100],
+                        help="Batch sizes to compare, 'none' for unbatched "
+                             "(default: none 100)")
+    parser.add_argument('--max-unbatched', type=int, default=1000,
+                        help="Skip unbatched runs of longer scripts than this,"
+                             " since they are slow (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Take the best of this many runs "
+                             "(default: %(default)s)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    working_dir = tempfile.mkdtemp(prefix='drivecasa-bench-')
+    try:
+        for transport in args.transports:
+            for engine in args.engines:
+                casa_kwargs = dict(casa_dir=args.casa_dir,
+                                   working_dir=working_dir,
+                                   casa_logfile=False,
+                                   transport=transport,
+                                   engine=engine)
+                print("Engine: {}, transport: {}".format(engine, transport))
+                bench_session(casa_kwargs, args)
+    finally:
+        shutil.rmtree(working_dir)
+
+
+if __name__ == '__main__':
+    main()
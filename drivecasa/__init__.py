@@ -16,6 +16,7 @@ import drivecasa.commands
 import drivecasa.utils
 from drivecasa.casa_env import casapy_env
 from drivecasa.interface import Casapy
+from drivecasa.pool import CasapyPool
 
 
 default_test_ouput_dir = '/tmp/drivecasa-tests'
@@ -0,0 +1,140 @@
+"""
+Asyncio counterparts to the blocking :class:`~drivecasa.interface.Casapy`
+methods, see :meth:`.Casapy.run_script_async`.
+
+Requires Python 3.5+, so this module is only imported on demand.
+"""
+import asyncio
+import sys
+
+import pexpect
+
+from drivecasa.interface import ScriptResult
+
+
+async def expect(child, pattern, timeout=-1, searchwindowsize=None):
+    """
+    Non-blocking equivalent of
+    ``child.expect(pattern, timeout, searchwindowsize)``.
+
+    Waits for the child's file descriptor to become readable via the event
+    loop, then lets pexpect consume whatever output is available without
+    blocking (i.e. with a zero timeout).
+    """
+    loop = asyncio.get_event_loop()
+    if timeout == -1:
+        timeout = child.timeout
+    deadline = None if timeout is None else loop.time() + timeout
+    while True:
+        try:
+            return child.expect(pattern, timeout=0,
+                                searchwindowsize=searchwindowsize)
+        except pexpect.TIMEOUT:
+            pass
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise pexpect.TIMEOUT("Timeout exceeded.")
+        await _wait_readable(loop, child.child_fd, remaining)
+
+
+async def _wait_readable(loop, fd, timeout):
+    readable = loop.create_future()
+    loop.add_reader(fd, _set_done, readable)
+    try:
+        await asyncio.wait_for(readable, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        loop.remove_reader(fd)
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+async def execute(casa, source, timeout):
+    """
+    Async equivalent of :meth:`.Casapy._execute`.
+
+    If cancelled while waiting, the command is interrupted and casapy
+    returned to a ready state before the cancellation is propagated.
+    """
+    pattern = casa._begin_execute(source)
+    try:
+        await expect(casa.child, pattern, timeout, casa._search_window())
+    except asyncio.CancelledError:
+        await interrupt(casa)
+        raise
+    return await finish_execute(casa)
+
+
+async def finish_execute(casa):
+    """
+    Async equivalent of :meth:`.Casapy._finish_execute`.
+    """
+    out_lines, status, prompt_follows = casa._collect_output()
+    if prompt_follows:
+        await expect(casa.child, casa.prompt)
+        out_lines.extend(casa._trailing_output())
+    return out_lines, status
+
+
+async def interrupt(casa, timeout=60):
+    """
+    Async equivalent of :meth:`.Casapy.interrupt`.
+    """
+    pattern = casa._interrupt()
+    if pattern is not None:
+        await expect(casa.child, pattern, timeout, casa._search_window())
+        await finish_execute(casa)
+
+
+async def run_steps(casa, steps, timeout):
+    """
+    Async equivalent of :meth:`.Casapy._run_steps`.
+    """
+    try:
+        request = next(steps)
+        while not isinstance(request, ScriptResult):
+            try:
+                reply = await execute(casa, request, timeout)
+            except pexpect.EOF:
+                request = steps.throw(*sys.exc_info())
+            else:
+                request = steps.send(reply)
+        return request
+    finally:
+        steps.close()
+
+
+async def run_script_async(casa, script, raise_on_severe=True, timeout=-1,
+                           batch_size=None, checkpoint=None, resume=False):
+    """
+    Async equivalent of :meth:`.Casapy.run_script`.
+    """
+    return await run_steps(
+        casa,
+        casa._script_steps(script, raise_on_severe, timeout, batch_size,
+                           checkpoint, resume),
+        timeout)
+
+
+async def run_script_from_file_async(casa, path_to_scriptfile,
+                                     raise_on_severe=True,
+                                     command_pre_logged=False,
+                                     timeout=-1):
+    """
+    Async equivalent of :meth:`.Casapy.run_script_from_file`.
+    """
+    exec_cmd = casa._prepare_script_file(path_to_scriptfile,
+                                         command_pre_logged)
+    monitor = casa._start_monitor()
+    try:
+        out_lines, status = await execute(casa, exec_cmd, timeout)
+    finally:
+        casa._stop_monitor(monitor, 0, [exec_cmd])
+    return casa._script_file_result(path_to_scriptfile, exec_cmd, out_lines,
+                                    status, raise_on_severe)
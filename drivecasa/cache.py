@@ -0,0 +1,175 @@
+"""
+Content-addressed cache of completed data-reduction steps.
+
+Re-running a pipeline usually re-executes every step, even when the inputs
+and arguments are unchanged. The command helpers in
+:mod:`drivecasa.commands.reduction` append :class:`CachedStep` commands,
+which record the paths read and written by the step. If a
+:class:`ResultCache` is passed to :class:`.Casapy`, then each completed step
+is recorded, keyed on the command text plus a fingerprint of its inputs.
+On subsequent runs, steps whose outputs still exist (and are unchanged since
+they were recorded) are skipped, e.g.::
+
+    casa = drivecasa.Casapy(result_cache=ResultCache('pipeline.cache'))
+    script = []
+    ms = drivecasa.commands.import_uvfits(script, 'obs.fits', out_dir='.')
+    maps = drivecasa.commands.clean(script, ms, niter=500,
+                                    threshold_in_jy=1e-3, out_dir='.')
+    casa.run_script(script)  # Skips everything, second time around.
+
+Plain string commands are never skipped.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class CachedStep(str):
+    """
+    A command string, annotated with the paths it reads and writes.
+
+    Behaves exactly like the plain command string (so may be used anywhere
+    in a script), with additional attributes:
+
+    Attributes:
+        inputs (tuple): Paths of files / directories read by the command.
+        outputs (tuple): Paths of files / directories the command creates.
+        staged (bool): The outputs are moved into place in the background
+            (see :mod:`drivecasa.staging`), so are only complete once a
+            subsequent staging wait has run.
+    """
+
+    def __new__(cls, command, inputs=(), outputs=(), staged=False):
+        self = super(CachedStep, cls).__new__(cls, command)
+        self.inputs = tuple(os.path.abspath(p) for p in inputs if p)
+        self.outputs = tuple(os.path.abspath(p) for p in outputs if p)
+        self.staged = staged
+        return self
+
+
+def fingerprint(path, content_hash=False):
+    """
+    Fingerprint a file, or a directory tree (e.g. a MeasurementSet).
+
+    Args:
+        path (str): Path to fingerprint.
+        content_hash (bool): Hash the file contents. Otherwise (the default)
+            only names, sizes and modification times are used, which is far
+            quicker for large datasets.
+
+    Returns:
+        Hex-digest string, or ``None`` if ``path`` does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    if os.path.isdir(path):
+        files = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            files.extend(os.path.join(dirpath, f) for f in sorted(filenames))
+    else:
+        files = [path]
+    digest = hashlib.sha1()
+    for file_path in files:
+        stat = os.stat(file_path)
+        relpath = os.path.relpath(file_path, path)
+        digest.update(relpath.encode('utf-8'))
+        if content_hash:
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+        else:
+            digest.update('{}:{!r}'.format(stat.st_size,
+                                           stat.st_mtime).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Records completed :class:`CachedStep` commands in a JSON file.
+
+    Each entry is keyed on a hash of the command text and the fingerprints of
+    its inputs, and records the fingerprints of its outputs. A step is
+    'fresh' (and may be skipped) if there is an entry for its current key,
+    and its outputs still match the recorded fingerprints.
+    """
+
+    def __init__(self, path, content_hash=False):
+        """
+        Args:
+            path (str): Path of the cache file. Created if it does not exist.
+            content_hash (bool): Fingerprint by content, rather than by file
+                size and modification time (see :func:`fingerprint`).
+        """
+        self.path = os.path.abspath(path)
+        self.content_hash = content_hash
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self._entries = json.load(f)
+
+    def key(self, step):
+        """
+        Returns the cache key for ``step``, given the current state of its
+        inputs.
+        """
+        digest = hashlib.sha1(step.encode('utf-8'))
+        for path in step.inputs:
+            digest.update(b'\0' + path.encode('utf-8') + b'\0')
+            digest.update(str(fingerprint(path, self.content_hash))
+                          .encode('utf-8'))
+        return digest.hexdigest()
+
+    def is_fresh(self, step):
+        """
+        Returns ``True`` if ``step`` has already been run with the same
+        inputs, and its outputs are unchanged since.
+        """
+        if not isinstance(step, CachedStep) or not step.outputs:
+            return False
+        entry = self._entries.get(self.key(step))
+        if entry is None:
+            return False
+        for path in step.outputs:
+            recorded = entry['outputs'].get(path)
+            if (recorded is None or
+                    recorded != fingerprint(path, self.content_hash)):
+                return False
+        return True
+
+    def record(self, step):
+        """
+        Record that ``step`` has completed successfully.
+
+        Plain (un-annotated) commands are ignored.
+        """
+        if not isinstance(step, CachedStep) or not step.outputs:
+            return
+        outputs = dict((path, fingerprint(path, self.content_hash))
+                       for path in step.outputs)
+        missing = [path for path, fp in outputs.items() if fp is None]
+        if missing:
+            logger.warning("Not caching command '%s', outputs missing: %s",
+                           step, ', '.join(missing))
+            return
+        with self._lock:
+            self._entries[self.key(step)] = {'command': str(step),
+                                             'outputs': outputs}
+            self._save()
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries = {}
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
@@ -0,0 +1,214 @@
+"""
+Policies controlling how much casapy output is retained by
+:meth:`.Casapy.run_script`.
+
+By default every line of output is accumulated in a list, which can grow very
+large for verbose (``log2term``) sessions. Pass one of the policies below as
+the ``output_capture`` argument to :class:`.Casapy` to bound memory usage, e.g.::
+
+    casa = drivecasa.Casapy(output_capture=CaptureTail(1000))
+
+Each call to :meth:`.Casapy.run_script` then returns a fresh buffer in place
+of the ``casa_out`` list. Buffers support iteration, ``len`` and indexing,
+so can mostly be used as if they were a list.
+"""
+import collections
+import json
+import os
+import tempfile
+
+from drivecasa.interface import _is_severe
+from drivecasa.utils import byteify
+
+
+class CapturePolicy(object):
+    """
+    Base class for output capture policies.
+
+    Subclasses override :meth:`new_buffer`; the base class retains all
+    output, as for :class:`CaptureAll`.
+    """
+
+    def new_buffer(self):
+        """Returns an empty buffer to capture output in."""
+        return []
+
+
+class CaptureAll(CapturePolicy):
+    """
+    Retain all output lines in memory (equivalent to the default behaviour).
+    """
+
+
+class CaptureTail(CapturePolicy):
+    """
+    Retain only the last ``max_lines`` lines of output.
+    """
+
+    def __init__(self, max_lines):
+        self.max_lines = max_lines
+
+    def new_buffer(self):
+        return TailBuffer(self.max_lines)
+
+
+class CaptureErrors(CapturePolicy):
+    """
+    Retain only lines reporting errors ('SEVERE' log messages and exceptions).
+    """
+
+    def new_buffer(self):
+        return ErrorsBuffer()
+
+
+class SpillToDisk(CapturePolicy):
+    """
+    Retain the first ``max_lines`` lines in memory, and write any further
+    lines to a temporary file.
+
+    The spilled lines are only read back from disk when accessed.
+    """
+
+    def __init__(self, max_lines, spill_dir=None):
+        """
+        Args:
+            max_lines (int): Number of lines to hold in memory.
+            spill_dir (str): Directory for the spill-file. ``None`` implies
+                use the system default temporary directory.
+        """
+        self.max_lines = max_lines
+        self.spill_dir = spill_dir
+
+    def new_buffer(self):
+        return SpillBuffer(self.max_lines, self.spill_dir)
+
+
+class TailBuffer(object):
+    """
+    Ring-buffer of output lines, see :class:`CaptureTail`.
+
+    Attributes:
+        n_dropped (int): Number of lines discarded from the start of the
+            output.
+    """
+
+    def __init__(self, max_lines):
+        self._lines = collections.deque(maxlen=max_lines)
+        self.n_dropped = 0
+
+    def append(self, line):
+        if len(self._lines) == self._lines.maxlen:
+            self.n_dropped += 1
+        self._lines.append(line)
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __getitem__(self, index):
+        return list(self._lines)[index]
+
+
+class ErrorsBuffer(list):
+    """
+    List which only accepts error lines, see :class:`CaptureErrors`.
+    """
+
+    def append(self, line):
+        if _is_severe(line) or "Error:" in line:
+            super(ErrorsBuffer, self).append(line)
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+
+class SpillBuffer(object):
+    """
+    Output buffer which spills to disk beyond a threshold,
+    see :class:`SpillToDisk`.
+
+    The spill-file is deleted when the buffer is closed or garbage-collected.
+
+    Attributes:
+        spill_path (str): Path to the spill-file, or ``None`` if output has
+            not (yet) exceeded the in-memory threshold.
+    """
+
+    def __init__(self, max_lines, spill_dir=None):
+        self.max_lines = max_lines
+        self.spill_dir = spill_dir
+        self.spill_path = None
+        self._head = []
+        self._spill_file = None
+        self._n_spilled = 0
+        self._spilled_cache = None
+
+    def append(self, line):
+        if len(self._head) < self.max_lines:
+            self._head.append(line)
+            return
+        if self._spill_file is None:
+            self._spill_file = tempfile.NamedTemporaryFile(
+                mode='w', prefix='drivecasa-output-', suffix='.jsonl',
+                dir=self.spill_dir, delete=False)
+            self.spill_path = self._spill_file.name
+        # One JSON-string per line, in case the output contains newlines.
+        self._spill_file.write(json.dumps(line) + '\n')
+        self._n_spilled += 1
+        self._spilled_cache = None
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def iter_spilled(self):
+        """
+        Iterate through the spilled lines, reading them from disk.
+        """
+        if self._spill_file is None:
+            return
+        self._spill_file.flush()
+        with open(self.spill_path) as f:
+            for line in f:
+                yield byteify(json.loads(line))
+
+    def load(self):
+        """
+        Returns all captured lines as a list (loading any spilled lines).
+        """
+        if self._spilled_cache is None:
+            self._spilled_cache = list(self.iter_spilled())
+        return self._head + self._spilled_cache
+
+    def close(self):
+        """Delete the spill-file."""
+        if self._spill_file is not None:
+            self._spill_file.close()
+            if os.path.exists(self.spill_path):
+                os.remove(self.spill_path)
+            self._spill_file = None
+            self._spilled_cache = None
+
+    def __del__(self):
+        self.close()
+
+    def __iter__(self):
+        for line in self._head:
+            yield line
+        for line in self.iter_spilled():
+            yield line
+
+    def __len__(self):
+        return len(self._head) + self._n_spilled
+
+    def __getitem__(self, index):
+        if isinstance(index, int) and 0 <= index < len(self._head):
+            return self._head[index]
+        return self.load()[index]
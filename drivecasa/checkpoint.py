@@ -0,0 +1,71 @@
+"""
+Checkpoint files, allowing a failed script to be resumed part-way through.
+
+See the ``checkpoint`` and ``resume`` arguments to :meth:`.Casapy.run_script`.
+"""
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpoint(object):
+    """
+    Records the commands of a script which have completed successfully.
+
+    The checkpoint file holds one JSON object per line, one per completed
+    command, with fields ``index`` (position in the script), ``command``
+    and ``outputs`` (the output paths of a :class:`.CachedStep`, if known).
+    Each line is appended as the command completes, so the file is up to
+    date even if the calling process dies.
+    """
+
+    def __init__(self, path, resume=False):
+        """
+        Args:
+            path (str): Path of the checkpoint file.
+            resume (bool): Load the commands completed by a previous run from
+                ``path`` (if it exists), and append to it. Otherwise, any
+                existing file is overwritten.
+        """
+        self.path = path
+        self._completed = {}
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partial line, written as the previous run died.
+                        logger.warning("Ignoring corrupt line in checkpoint "
+                                       "file %s", path)
+                        continue
+                    self._completed[entry['index']] = entry
+            logger.info("Resuming from checkpoint %s, %s commands completed",
+                        path, len(self._completed))
+        else:
+            open(path, 'w').close()
+
+    def completed(self, index, command):
+        """
+        Returns ``True`` if the command at ``index`` was recorded as completed
+        (and was the same command), and its outputs (if known) still exist.
+        """
+        entry = self._completed.get(index)
+        if entry is None or entry['command'] != command:
+            return False
+        return all(os.path.exists(path) for path in entry['outputs'])
+
+    def record(self, index, command):
+        """
+        Record that the command at ``index`` has completed.
+        """
+        entry = {'index': index,
+                 'command': str(command),
+                 'outputs': list(getattr(command, 'outputs', ()))}
+        self._completed[index] = entry
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
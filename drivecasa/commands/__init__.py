@@ -13,6 +13,7 @@ from drivecasa.commands.reduction import (
     clean,
     concat,
     export_fits,
+    image_concat,
     import_uvfits,
     mstransform
 )
\ No newline at end of file
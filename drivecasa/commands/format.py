@@ -1,29 +1,95 @@
 """
 Short routines which produce CASA expressions from various data-structures.
 """
+import os
+
+import numpy as np
+
+#: First line of a CASA region text format (CRTF) file.
+crtf_header = '#CRTFv0 CASA Region Text Format version 0'
 
 
 def circular_mask_string(centre_ra_dec_posns, aperture_radius="1arcmin"):
     """Get a mask string representing circular apertures about (x,y) tuples"""
-    mask = ''
     if centre_ra_dec_posns is None:
-        return mask
-    for coords in centre_ra_dec_posns:
-        mask += 'circle [ [ {x} , {y}] , {r} ]\n'.format(
-                          x=coords[0], y=coords[1], r=aperture_radius)
-    return mask
+        return ''
+    return ''.join(
+        'circle [ [ {x} , {y}] , {r} ]\n'.format(
+            x=coords[0], y=coords[1], r=aperture_radius)
+        for coords in centre_ra_dec_posns)
 
 
 def box_mask_string(centre_pix_posns, width):
     """Get a mask string representing box apertures about (x,y) tuples"""
-    mask = ''
     if centre_pix_posns is None:
-        return mask
-    for coords in centre_pix_posns:
-        mask += 'box [ [{lx}pix , {ly}pix]  , [{hx}pix, {hy}pix] ]\n'.format(
-                          lx=coords[0] - width / 2, ly=coords[1] - width / 2,
-                          hx=coords[0] + width / 2, hy=coords[1] + width / 2,)
-    return mask
+        return ''
+    return ''.join(
+        'box [ [{lx}pix , {ly}pix]  , [{hx}pix, {hy}pix] ]\n'.format(
+            lx=coords[0] - width / 2, ly=coords[1] - width / 2,
+            hx=coords[0] + width / 2, hy=coords[1] + width / 2,)
+        for coords in centre_pix_posns)
+
+
+def circle_regions(centres, radius='1arcmin'):
+    """
+    Get CRTF region lines for circular apertures.
+
+    Args:
+        centres: Either an array-valued :class:`astropy.coordinates.SkyCoord`,
+            or an array of shape ``(N, 2)`` of (RA, Dec) in degrees.
+        radius (str): Aperture radius, with units, e.g. ``'1arcmin'``.
+
+    Returns:
+        List of strings, one region per line.
+    """
+    if hasattr(centres, 'ra'):
+        centres = np.column_stack((centres.ra.deg.ravel(),
+                                   centres.dec.deg.ravel()))
+    centres = np.asarray(centres, dtype=float).reshape(-1, 2)
+    return ['circle[[{}deg, {}deg], {}]'.format(x, y, radius)
+            for x, y in centres.tolist()]
+
+
+def box_regions(centre_pix_posns, width):
+    """
+    Get CRTF region lines for square apertures.
+
+    Args:
+        centre_pix_posns: Array of shape ``(N, 2)``, (x, y) pixel positions
+            of the box centres.
+        width (float): Box width, in pixels.
+
+    Returns:
+        List of strings, one region per line.
+    """
+    centres = np.asarray(centre_pix_posns, dtype=float).reshape(-1, 2)
+    corners = np.hstack((centres - width / 2., centres + width / 2.))
+    return ['box[[{}pix, {}pix], [{}pix, {}pix]]'.format(*c)
+            for c in corners.tolist()]
+
+
+def write_region_file(path, regions):
+    """
+    Write regions to a CASA region text format (CRTF) file.
+
+    The path can then be passed as e.g. the ``mask`` argument of
+    :func:`drivecasa.commands.clean`, keeping the clean command itself short
+    however many apertures there are.
+
+    Args:
+        path (str): Path of the region file.
+        regions: Iterable of region lines, as produced by
+            :func:`circle_regions` / :func:`box_regions`.
+
+    Returns (str):
+        Absolute path to the region file.
+    """
+    path = os.path.abspath(path)
+    with open(path, 'w') as f:
+        f.write(crtf_header + '\n')
+        for line in regions:
+            f.write(line + '\n')
+    return path
 
 
 def astropy_skycoord_as_casa_direction(skycoord):
@@ -31,13 +97,19 @@ def astropy_skycoord_as_casa_direction(skycoord):
     Generates a CASA `me.direction` corresponding to given sky-coordinates.
 
     Args:
-        skycoord (astropy.coordinates.SkyCoord): Sky position
+        skycoord (astropy.coordinates.SkyCoord): Sky position, or an
+            array-valued SkyCoord of positions.
 
-    Returns (str): casa `me.direction` instantiation expression.
+    Returns (str): casa `me.direction` instantiation expression. (A list of
+        expressions for array-valued input, converted in a single pass.)
 
     """
-    return "me.direction('J2000', '{}deg', '{}deg')".format(
-        skycoord.ra.degree, skycoord.dec.degree)
+    if skycoord.isscalar:
+        return "me.direction('J2000', '{}deg', '{}deg')".format(
+            skycoord.ra.degree, skycoord.dec.degree)
+    return ["me.direction('J2000', '{}deg', '{}deg')".format(ra, dec)
+            for ra, dec in zip(skycoord.ra.degree.ravel().tolist(),
+                               skycoord.dec.degree.ravel().tolist())]
 
 
 def astropy_time_as_casa_epoch(time):
@@ -11,13 +11,18 @@
 
     The composing functions return the paths to the files which should be
     created once the scripted command has been executed.
+
+    The commands appended are :class:`.CachedStep` strings, recording their
+    input and output paths, so they can be skipped when re-run with an
+    unchanged input (see :mod:`drivecasa.cache`).
 """
 
 
 import os
-import shutil
 from collections import namedtuple
-from drivecasa.utils import ensure_dir, derive_out_path, byteify, listify
+from drivecasa.cache import CachedStep
+from drivecasa.utils import (
+    ensure_dir, derive_out_path, byteify, listify, remove_tree)
 
 
 class CleanMaps(namedtuple('CleanMaps',
@@ -39,7 +44,8 @@ def clean(script,
           other_clean_args=None,
           out_dir=None,
           out_path=None,
-          overwrite=False
+          overwrite=False,
+          staging=None,
           ):
     """
     Perform clean process to produce an image/map.
@@ -69,6 +75,15 @@ def clean(script,
     NB niter = 0 implies create a  'dirty' map, outputs will be named
     accordingly.
 
+    The ``mask`` may be a region string (e.g. from
+    :func:`.circular_mask_string`), or the path to a mask image or region
+    file. For more than a handful of apertures, prefer a region file (see
+    :func:`.write_region_file`), which keeps the clean command short.
+
+    If a :class:`.Staging` is given as ``staging``, clean is run on copies of
+    the input visibilities in its scratch directory, and the maps are moved
+    back to the usual paths in the background afterwards.
+
     .. warning::
 
         This function can accept a list of multiple input visibilities. This
@@ -108,7 +123,6 @@ def clean(script,
         'mask': mask,
         'modelimage': modelimage
     })
-    script.append("clean(**{})".format(repr(clean_args)))
 
     ensure_dir(os.path.dirname(cleaned_path))
     expected_map_paths = CleanMaps(
@@ -119,11 +133,27 @@ def clean(script,
         mask=cleaned_path + '.mask',
         flux=cleaned_path + '.flux',
     )
+    # Mask / flux maps are not always produced, so are not cache outputs.
+    # (Region strings, unlike paths, always contain brackets.)
+    input_paths = vis_paths + [p for p in (mask, modelimage)
+                               if isinstance(p, str) and p and '[' not in p]
+    if staging is None:
+        command = "clean(**{})".format(repr(clean_args))
+    else:
+        clean_args['vis'] = [staging.scratch_path(vp) for vp in vis_paths]
+        clean_args['imagename'] = staging.scratch_path(cleaned_path)
+        command = staging.wrap("clean(**{})".format(repr(clean_args)),
+                               vis_paths, expected_map_paths)
+    script.append(CachedStep(
+        command,
+        inputs=input_paths,
+        outputs=expected_map_paths[:4],
+        staged=staging is not None))
 
     if overwrite:
         for path in expected_map_paths:
             if os.path.isdir(path):
-                shutil.rmtree(path)
+                remove_tree(path)
     return expected_map_paths
 
 
@@ -153,11 +183,12 @@ def concat(script, vis_paths, out_basename=None, out_dir=None, out_path=None,
     ensure_dir(os.path.dirname(concat_path))
     if overwrite:
         if os.path.isdir(concat_path):
-            shutil.rmtree(concat_path)
+            remove_tree(concat_path)
     abs_vis_paths = [os.path.abspath(v) for v in vis_paths]
-    script.append("concat(vis={0}, concatvis='{1}')".format(
-        str(abs_vis_paths), os.path.abspath(concat_path))
-    )
+    script.append(CachedStep(
+        "concat(vis={0}, concatvis='{1}')".format(
+            str(abs_vis_paths), os.path.abspath(concat_path)),
+        inputs=abs_vis_paths, outputs=[concat_path]))
     return concat_path
 
 
@@ -176,14 +207,51 @@ def export_fits(script, image_path, out_dir=None, out_path=None,
     ensure_dir(os.path.dirname(fits_path))
     # NB Be sure to specify the abspath as seen from current ipython process,
     # in case the user has specified relative path:
-    script.append("exportfits(imagename='{0}', fitsimage='{1}', overwrite={2})"
-                  .format(os.path.abspath(image_path),
-                          os.path.abspath(fits_path),
-                          str(overwrite))
-                  )
+    script.append(CachedStep(
+        "exportfits(imagename='{0}', fitsimage='{1}', overwrite={2})"
+        .format(os.path.abspath(image_path),
+                os.path.abspath(fits_path),
+                str(overwrite)),
+        inputs=[image_path], outputs=[fits_path]))
     return fits_path
 
 
+def image_concat(script, image_paths, out_path, axis=-1, relax=True,
+                 overwrite=False):
+    """
+    Concatenate images along an axis, e.g. to combine cubes covering
+    consecutive channel ranges into a single cube.
+
+    Uses the ``imageconcat`` method of the CASA image tool.
+
+    Args:
+        script: List to which the relevant casapy command line will be appended.
+        image_paths: Paths of the images to concatenate, in order.
+        out_path: Path of the combined image.
+        axis: Pixel axis to concatenate along. The default of ``-1`` means the
+            spectral axis.
+        relax: Allow the images to differ in e.g. coordinate reference
+            values, as long as they are otherwise compatible.
+        overwrite: Delete any pre-existing data at the output path (danger!).
+
+    Returns:
+        Path to combined image.
+    """
+    image_paths = [os.path.abspath(p) for p in listify(byteify(image_paths))]
+    out_path = byteify(out_path)
+    ensure_dir(os.path.dirname(os.path.abspath(out_path)))
+    if overwrite:
+        if os.path.isdir(out_path):
+            remove_tree(out_path)
+    script.append(CachedStep(
+        "ia.imageconcat(outfile='{0}', infiles={1}, axis={2}, relax={3}, "
+        "overwrite={4}).done()".format(
+            os.path.abspath(out_path), repr(image_paths), axis, relax,
+            overwrite),
+        inputs=image_paths, outputs=[out_path]))
+    return out_path
+
+
 def import_uvfits(script, uvfits_path, out_dir=None, out_path=None,
                   overwrite=False):
     """
@@ -217,23 +285,28 @@ def import_uvfits(script, uvfits_path, out_dir=None, out_path=None,
     ensure_dir(os.path.dirname(ms_path))
     if overwrite:
         if os.path.isdir(ms_path):
-            shutil.rmtree(ms_path)
+            remove_tree(ms_path)
     # NB Be sure to specify the abspath as seen from current ipython process,
     # in case the user has specified relative path:
-    script.append("importuvfits(fitsfile='{0}', vis='{1}')".format(
-        os.path.abspath(uvfits_path), os.path.abspath(ms_path))
-    )
+    script.append(CachedStep(
+        "importuvfits(fitsfile='{0}', vis='{1}')".format(
+            os.path.abspath(uvfits_path), os.path.abspath(ms_path)),
+        inputs=[uvfits_path], outputs=[ms_path]))
     return ms_path
 
 
 def mstransform(script, vis_path, out_path, other_transform_args=None,
-                overwrite=False):
+                overwrite=False, staging=None):
     """
     Useful for pre-imaging steps of interferometric data reduction.
 
     Guide:
     http://www.eso.org/~scastro/ALMA/casa/MST/MSTransformDocs/MSTransformDocs.html
 
+    If a :class:`.Staging` is given as ``staging``, the transform is run on
+    a copy of the input in its scratch directory, and the output moved back
+    to ``out_path`` in the background afterwards.
+
     Returns:
         out_path
     """
@@ -248,10 +321,21 @@ def mstransform(script, vis_path, out_path, other_transform_args=None,
         'vis': os.path.abspath(vis_path),
         'outputvis': os.path.abspath(out_path)
     })
-    script.append("mstransform(**{})".format(repr(transform_args)))
+    if staging is None:
+        command = "mstransform(**{})".format(repr(transform_args))
+    else:
+        transform_args['vis'] = staging.scratch_path(vis_path)
+        transform_args['outputvis'] = staging.scratch_path(out_path)
+        command = staging.wrap(
+            "mstransform(**{})".format(repr(transform_args)),
+            [vis_path], [out_path])
+    script.append(CachedStep(
+        command,
+        inputs=[vis_path], outputs=[out_path],
+        staged=staging is not None))
 
     if overwrite:
         if os.path.isdir(out_path):
-            shutil.rmtree(out_path)
+            remove_tree(out_path)
 
     return out_path
@@ -3,19 +3,86 @@ Provides convenience functions for composing casapy simulation scripts.
 """
 import logging
 import os
-import shutil
 
 import astropy.units as u
+import numpy as np
+from astropy.coordinates import (
+    SkyCoord, SphericalRepresentation, UnitSphericalRepresentation)
 
+from drivecasa.cache import CachedStep
 from drivecasa.commands.format import (
     astropy_skycoord_as_casa_direction, astropy_time_as_casa_epoch)
-from drivecasa.utils import ensure_dir
+from drivecasa.utils import ensure_dir, remove_tree
 
 logger = logging.getLogger(__name__)
 
 _DRIVECASA_FIELD_NAME = "drivecasa_field0"
 _DRIVECASA_SPECTRAL_WINDOW_NAME = "drivecasa_spw0"
 
+#: Record layout of the source tables written by
+#: :func:`make_componentlist_bulk`.
+source_table_dtype = np.dtype([('ra_deg', 'f8'),
+                               ('dec_deg', 'f8'),
+                               ('flux_jy', 'f8'),
+                               ('freq_hz', 'f8')])
+
+# Frames whose spherical longitude / latitude are RA / Dec.
+_equatorial_frames = ('icrs', 'fk5', 'fk4', 'fk4noeterms')
+
+
+def source_table(source_list):
+    """
+    Convert a list of point sources to a table of plain floats.
+
+    Unit conversions are applied to whole columns at once, avoiding astropy's
+    (considerable) per-object overheads for large source lists.
+
+    Args:
+        source_list: Either a list of (position, flux, frequency) tuples;
+            a single tuple of (positions, fluxes, frequencies), where
+            positions is an array-valued :class:`astropy.coordinates.SkyCoord`
+            and fluxes and frequencies are (array or scalar) quantities; or a
+            table (e.g. NumPy structured array or :class:`astropy.table.Table`)
+            with the columns of :data:`source_table_dtype`.
+
+    Returns:
+        NumPy array with dtype :data:`source_table_dtype`.
+    """
+    if hasattr(source_list, 'dtype') or hasattr(source_list, 'colnames'):
+        table = np.empty(len(source_list), dtype=source_table_dtype)
+        for name in source_table_dtype.names:
+            table[name] = source_list[name]
+        return table
+
+    if (len(source_list) == 3 and isinstance(source_list[0], SkyCoord)
+            and not source_list[0].isscalar):
+        positions, fluxes, freqs = source_list
+        ra = positions.ra.deg.ravel()
+        dec = positions.dec.deg.ravel()
+    else:
+        ra = np.empty(len(source_list))
+        dec = np.empty(len(source_list))
+        for i, (posn, _, _) in enumerate(source_list):
+            # SkyCoord.ra / .dec are slow, so read the underlying
+            # representation directly where it is equivalent.
+            if (posn.frame.name in _equatorial_frames and
+                    isinstance(posn.data, (UnitSphericalRepresentation,
+                                           SphericalRepresentation))):
+                ra[i] = posn.data.lon.deg
+                dec[i] = posn.data.lat.deg
+            else:
+                ra[i] = posn.ra.deg
+                dec[i] = posn.dec.deg
+        fluxes = u.Quantity([flux for (_, flux, _) in source_list])
+        freqs = u.Quantity([freq for (_, _, freq) in source_list])
+
+    table = np.empty(len(ra), dtype=source_table_dtype)
+    table['ra_deg'] = ra
+    table['dec_deg'] = dec
+    table['flux_jy'] = fluxes.to(u.Jy).value
+    table['freq_hz'] = freqs.to(u.Hz).value
+    return table
+
 
 def make_componentlist(script, source_list, out_path, overwrite=True):
     """
@@ -28,12 +95,17 @@ def make_componentlist(script, source_list, out_path, overwrite=True):
 
     Typically used when simulating observations.
 
+    Each source is a separate command, so for more than a few hundred
+    sources use :func:`make_componentlist_bulk` instead.
+
     Args:
         script (list): List of strings to append commands to.
         source_list: List of (position, flux, frequency) tuples.
             Positions should be :class:`astropy.coordinates.SkyCoord`
             instances, while flux and frequency should be quantities supplied
             using the :mod:`astropy.units` functionality.
+            Array-valued positions and quantities, or a table of plain
+            values, may be supplied instead (see :func:`source_table`).
         out_path (str): Path to save the component list at
         overwrite (bool): Delete any pre-existing component list at out_path.
 
@@ -44,26 +116,73 @@ def make_componentlist(script, source_list, out_path, overwrite=True):
     out_path = os.path.abspath(out_path)
     if os.path.isdir(out_path):
         if overwrite:
-            shutil.rmtree(out_path)
+            remove_tree(out_path)
         else:
             logger.warning(
                 "Componentlist already exists (and overwrite=False).")
     ensure_dir(os.path.dirname(out_path))
 
+    table = source_table(source_list)
     script.append("cl.done()")
-    for (posn, flux, freq) in source_list:
-        posn_str = "J2000 {}deg {}deg".format(posn.ra.deg, posn.dec.deg)
-        freq_str = "{}Hz".format(freq.to(u.Hz).value)
+    for (ra, dec, flux, freq) in table.tolist():
+        posn_str = "J2000 {}deg {}deg".format(ra, dec)
+        freq_str = "{}Hz".format(freq)
         script.append(
             "cl.addcomponent(dir='{posn_str}', flux={flux}, fluxunit='Jy',"
             "freq='{freq_str}', shape='point')".format(
-                posn_str=posn_str, flux=flux.to(u.Jy).value, freq_str=freq_str
+                posn_str=posn_str, flux=flux, freq_str=freq_str
             ))
     script.append("cl.rename('{}')".format(out_path))
     script.append("cl.close()")
     return out_path
 
 
+def make_componentlist_bulk(script, source_list, out_path, table_path=None,
+                            overwrite=True):
+    """
+    Build a componentlist of point sources and save it to disk, in a single
+    command.
+
+    Equivalent to :func:`make_componentlist`, but rather than one
+    ``cl.addcomponent`` command per source, the sources are written to a
+    NumPy (``.npy``) table which is then loaded and looped over inside
+    casapy, so the cost of the script does not grow with the number of
+    sources.
+
+    Args:
+        script (list): List of strings to append commands to.
+        source_list: Sources, in any of the forms accepted by
+            :func:`source_table`.
+        out_path (str): Path to save the component list at
+        table_path (str): Path to write the source table to. Defaults to
+            `out_path` with a ``.npy`` suffix appended.
+        overwrite (bool): Delete any pre-existing component list at out_path.
+
+    Returns (str):
+        Absolute path to the output component list
+    """
+    out_path = os.path.abspath(out_path)
+    if table_path is None:
+        table_path = out_path + '.npy'
+    table_path = os.path.abspath(table_path)
+    if os.path.isdir(out_path):
+        if overwrite:
+            remove_tree(out_path)
+        else:
+            logger.warning(
+                "Componentlist already exists (and overwrite=False).")
+    ensure_dir(os.path.dirname(out_path))
+    ensure_dir(os.path.dirname(table_path))
+
+    np.save(table_path, source_table(source_list))
+
+    script.append(CachedStep(
+        "drivecasa_componentlist_from_table('{}', '{}')".format(
+            table_path, out_path),
+        inputs=[table_path], outputs=[out_path]))
+    return out_path
+
+
 def _load_antennalist(script, antennalist_path):
     """
     Load the columns from an antenna-list config file into lists.
@@ -80,7 +199,8 @@ def _load_antennalist(script, antennalist_path):
     any risk of name-clashes.
 
     The actual parsing is performed by a subroutine to keep the scripts
-    minimal.
+    minimal. The subroutine caches parsed files for the life of the casapy
+    session, so repeatedly loading the same (unmodified) file is cheap.
     """
     path = os.path.abspath(antennalist_path)
     cmd = (
@@ -380,6 +500,19 @@ def set_simplenoise(script, noise_std_dev):
     script.append(cmd)
 
 
+def setseed(script, seed):
+    """
+    Seed the random number generator used by `sm.corrupt`, via `sm.setseed`.
+
+    cf https://casa.nrao.edu/docs/CasaRef/simulator.setseed.html
+
+    Args:
+        script (list): casapy script-list
+        seed (int): Random number seed.
+    """
+    script.append("sm.setseed(seed={})".format(int(seed)))
+
+
 def corrupt(script):
     """
     Apply pre-configured simulated noise via `sm.corrupt`
@@ -419,7 +552,7 @@ def open_sim(script, output_ms_path, overwrite=True):
     output_ms_path = os.path.abspath(output_ms_path)
     if os.path.isdir(output_ms_path):
         if overwrite:
-            shutil.rmtree(output_ms_path)
+            remove_tree(output_ms_path)
         else:
             logger.warning(
                 "Componentlist already exists (and overwrite=False).")
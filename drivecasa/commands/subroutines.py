@@ -1,29 +1,369 @@
 """
-Define some subroutines which we pre-load into the CASA environment.
+Define some subroutines which we load into the CASA environment.
 
 These allow us to e.g. define subroutines for converting a custom file-format
 into native Python data-structures.
+
+Subroutines are kept in a :data:`registry`, keyed by function name. Those
+which drive-casa itself relies on are loaded in a single round-trip when
+casapy is spawned (see :data:`preloaded`); the rest are loaded on demand,
+the first time a command referring to them is run in a given session.
+Command helpers needing a new subroutine should define it here (or
+:func:`register` it), then simply refer to it by name in the script.
 """
+import re
+from collections import OrderedDict
+
+#: Maps subroutine (function) name to the source defining it.
+registry = OrderedDict()
+
+#: Names of the subroutines loaded into every session on start-up.
+preloaded = []
+
+_reference = re.compile(r'\bdrivecasa_\w+')
+
+
+def register(name, definition, preload=False):
+    """
+    Add a subroutine to the registry.
+
+    Args:
+        name (str): Name of the function defined, must begin ``drivecasa_``.
+        definition (str): Python source defining the function.
+        preload (bool): Load into every casapy session on start-up, rather
+            than on demand.
+    """
+    if not name.startswith('drivecasa_'):
+        raise ValueError("Subroutine names must begin 'drivecasa_'")
+    registry[name] = definition
+    if preload and name not in preloaded:
+        preloaded.append(name)
+
+
+def bundle(names):
+    """
+    Returns source defining the named subroutines, in a single chunk.
+    """
+    return '\n'.join(registry[name] for name in names) + '\n'
+
+
+def required(commands, loaded=()):
+    """
+    Find the subroutines referred to by ``commands`` which are not yet
+    ``loaded``.
+
+    Returns:
+        List of subroutine names, in registry order.
+    """
+    referenced = set()
+    for cmd in commands:
+        referenced.update(_reference.findall(cmd))
+    return [name for name in registry
+            if name in referenced and name not in loaded]
+
 
 # Load the columns from an antenna-list config file into lists.
+# Parsed configurations are memoised (per path, modification time and size)
+# for the lifetime of the session, so repeated `setconfig` calls with the same
+# file only parse it once. Fresh lists are returned each call, in case the
+# caller modifies them.
 def_load_antennalist = """
-def drivecasa_load_antennalist(antennalist_path):
-    with open(antennalist_path, 'r') as f:
-        x = [];
-        y = [];
-        z = [];
-        d = []
-        lines = f.readlines()
-        for l in lines:
-            items = l.split()
-            if (items[0] != '#'):
-                x.append(float(items[0]))
-                y.append(float(items[1]))
-                z.append(float(items[2]))
-                d.append(float(items[3]))
-    return x, y, z, d
-    """
-
-all_subroutines = (
-    def_load_antennalist,
-)
+def drivecasa_load_antennalist(antennalist_path, _cache={}):
+    import os
+    import numpy
+    path = os.path.abspath(antennalist_path)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    if key not in _cache:
+        columns = numpy.loadtxt(path, comments='#', usecols=(0, 1, 2, 3),
+                                ndmin=2, dtype=float).T
+        for stale in [k for k in _cache if k[0] == path]:
+            del _cache[stale]
+        _cache[key] = tuple(c.tolist() for c in columns)
+    return tuple(list(c) for c in _cache[key])
+    """
+
+# Build a componentlist of point sources from a NumPy table, see
+# :func:`drivecasa.commands.simulation.make_componentlist_bulk`.
+def_componentlist_from_table = """
+def drivecasa_componentlist_from_table(table_path, out_path):
+    import numpy
+    sources = numpy.load(table_path)
+    cl.done()
+    for src in sources:
+        cl.addcomponent(dir='J2000 %rdeg %rdeg' % (float(src['ra_deg']),
+                                                   float(src['dec_deg'])),
+                        flux=float(src['flux_jy']), fluxunit='Jy',
+                        freq='%rHz' % float(src['freq_hz']), shape='point')
+    cl.rename(out_path)
+    cl.close()
+    return len(sources)
+    """
+
+# Save the value of an expression to a side file, see
+# :meth:`drivecasa.Casapy.evaluate`. Arrays are saved in NumPy format
+# (`<base_path>.npy`), anything else as JSON (`<base_path>.json`), with any
+# arrays nested inside (e.g. in the dicts returned by `imstat`) encoded as
+# `{'__ndarray__': values, 'dtype': dtype}`.
+def_save_value = """
+def drivecasa_save_value(value, base_path):
+    import json
+    import numpy
+    if isinstance(value, numpy.ndarray):
+        numpy.save(base_path + '.npy', value)
+        return
+    def encode(obj):
+        if isinstance(obj, numpy.ndarray) and obj.dtype.kind != 'c':
+            return {'__ndarray__': obj.tolist(), 'dtype': str(obj.dtype)}
+        if isinstance(obj, numpy.generic) and obj.dtype.kind != 'c':
+            return obj.item()
+        raise TypeError('Cannot serialise %r' % type(obj))
+    with open(base_path + '.json', 'w') as f:
+        json.dump(value, f, default=encode)
+    """
+
+# Copy (a region of) an image's pixels into a `.npy` file, see
+# :meth:`drivecasa.Casapy.image_pixels`. Pixels are copied one plane (along
+# the last axis) at a time into a memory-mapped output, so casapy never holds
+# the whole region in memory.
+def_dump_pixels = """
+def drivecasa_dump_pixels(image_path, out_path, blc=None, trc=None):
+    from numpy.lib.format import open_memmap
+    ia.open(image_path)
+    try:
+        shape = [int(n) for n in ia.shape()]
+        lo = list(blc or [])
+        lo += [0] * (len(shape) - len(lo))
+        hi = list(trc or [])
+        hi += [n - 1 for n in shape[len(hi):]]
+        out_shape = tuple(h - l + 1 for l, h in zip(lo, hi))
+        pixels = None
+        for i in range(out_shape[-1]):
+            plane = ia.getchunk(blc=lo[:-1] + [lo[-1] + i],
+                                trc=hi[:-1] + [lo[-1] + i], dropdeg=False)
+            if pixels is None:
+                pixels = open_memmap(out_path, mode='w+', dtype=plane.dtype,
+                                     shape=out_shape)
+            pixels[..., i] = plane[..., 0]
+        pixels.flush()
+        del pixels
+    finally:
+        ia.close()
+    """
+
+# Copy data between slow storage and local scratch, see
+# :class:`drivecasa.staging.Staging`. Modes are:
+#  - 'in': copy `sources` to `destinations`, unless an up-to-date copy (as
+#    recorded in a `.drivecasa-stamp` file alongside) is already present.
+#    Waits for any pending copy-back to a source first. Paths in `clear` are
+#    deleted, so commands start afresh.
+#  - 'out': move `sources` (if present) to `destinations` in a background
+#    thread, via a temporary name so each destination appears atomically.
+#  - 'wait': wait for background copies, raising if any failed.
+# Copies use `cp --reflink=auto` where available, else shutil.copytree.
+def_stage = """
+def drivecasa_stage(mode, sources=(), destinations=(), clear=(),
+                    _state={'pending': {}, 'failed': []}):
+    import os
+    import shutil
+    import subprocess
+    import threading
+
+    def copy_tree(src, dst):
+        try:
+            subprocess.check_call(['cp', '-a', '--reflink=auto', src, dst])
+        except (OSError, subprocess.CalledProcessError):
+            if os.path.exists(dst):
+                shutil.rmtree(dst)
+            shutil.copytree(src, dst, symlinks=True)
+
+    def stamp(path):
+        n_files, size, mtime = 0, 0, 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                st = os.stat(os.path.join(root, name))
+                n_files += 1
+                size += st.st_size
+                mtime = max(mtime, st.st_mtime)
+        return '%d %d %r' % (n_files, size, mtime)
+
+    def move_back(src, dst):
+        try:
+            partial = dst + '.drivecasa-partial'
+            if os.path.exists(partial):
+                shutil.rmtree(partial)
+            copy_tree(src, partial)
+            if os.path.exists(dst):
+                shutil.rmtree(dst)
+            os.rename(partial, dst)
+            shutil.rmtree(src)
+        except Exception as e:
+            _state['failed'].append('%s -> %s: %s' % (src, dst, e))
+
+    def wait(paths=None):
+        for dst, thread in list(_state['pending'].items()):
+            if paths is None or dst in paths:
+                thread.join()
+                del _state['pending'][dst]
+
+    if mode == 'in':
+        wait(sources)
+        for path in clear:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        for src, dst in zip(sources, destinations):
+            current = stamp(src)
+            stamp_path = dst + '.drivecasa-stamp'
+            if os.path.isdir(dst) and os.path.exists(stamp_path):
+                with open(stamp_path) as f:
+                    if f.read() == current:
+                        continue
+            if os.path.exists(dst):
+                shutil.rmtree(dst)
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            copy_tree(src, dst)
+            with open(stamp_path, 'w') as f:
+                f.write(current)
+    elif mode == 'out':
+        for src, dst in zip(sources, destinations):
+            if not os.path.exists(src):
+                continue
+            wait([dst])
+            thread = threading.Thread(target=move_back, args=(src, dst))
+            thread.start()
+            _state['pending'][dst] = thread
+    elif mode == 'wait':
+        wait()
+        failed, _state['failed'][:] = list(_state['failed']), []
+        if failed:
+            raise RuntimeError('Copy-back failed: ' + '; '.join(failed))
+    else:
+        raise ValueError('Unknown staging mode: %r' % (mode,))
+    """
+
+# Return a session to a clean state, e.g. before re-use by a session-pool.
+# Closes any tool state left open by the previous user, removes the
+# `_dc_`-prefixed variables pushed into the namespace by command helpers, and
+# waits for any staged outputs to be copied back.
+def_reset_session = """
+def drivecasa_reset_session():
+    for toolname, methods in (('sm', ('close',)),
+                              ('cl', ('done', 'close')),
+                              ('ia', ('close',)),
+                              ('im', ('close',)),
+                              ('ms', ('close',)),
+                              ('tb', ('close',))):
+        tool = globals().get(toolname)
+        for method in methods:
+            try:
+                getattr(tool, method)()
+            except Exception:
+                pass
+    for name in [n for n in globals() if n.startswith('_dc_')]:
+        del globals()[name]
+    if 'drivecasa_stage' in globals():
+        drivecasa_stage('wait')
+    """
+
+# Run a single command, then print a sequence-numbered marker line giving its
+# completion status, which the interface waits for in place of the casapy
+# prompt. See :meth:`drivecasa.interface.Casapy._begin_execute`.
+def_run = """
+def drivecasa_run(seq, command):
+    import sys
+    import traceback
+    status = 'ok'
+    try:
+        exec(command, globals())
+    except KeyboardInterrupt:
+        status = 'interrupted'
+        print('KeyboardInterrupt')
+    except Exception:
+        status = 'error'
+        etype, evalue, tb = sys.exc_info()
+        print(''.join(
+            traceback.format_exception(etype, evalue, tb.tb_next)).rstrip())
+    sys.stdout.flush()
+    sys.stderr.flush()
+    print('<<drivecasa:done:%d:%s>>' % (seq, status))
+    sys.stdout.flush()
+    """
+
+# Run a batch of commands, printing a marker line before and after each so
+# that output can be attributed to the command that produced it.
+# Execution halts at the first command raising an exception.
+def_run_batch = """
+def drivecasa_run_batch(first_index, commands):
+    import sys
+    import traceback
+    for index, command in enumerate(commands, first_index):
+        print('<<drivecasa:%d:begin>>' % index)
+        sys.stdout.flush()
+        try:
+            exec(command, globals())
+        except Exception:
+            etype, evalue = sys.exc_info()[:2]
+            print(''.join(
+                traceback.format_exception_only(etype, evalue)).rstrip())
+            print('<<drivecasa:%d:error>>' % index)
+            sys.stdout.flush()
+            return
+        sys.stdout.flush()
+        print('<<drivecasa:%d:ok>>' % index)
+        sys.stdout.flush()
+    """
+
+# Serve commands received via a named pipe, until a zero-length frame is
+# received. See :class:`drivecasa.transport.FifoChannel`.
+def_serve_fifo = """
+def drivecasa_serve_fifo(command_path, result_path):
+    import struct
+    import sys
+    import traceback
+    header = struct.Struct('>II')
+    commands = open(command_path, 'rb')
+    results = open(result_path, 'wb')
+    try:
+        while True:
+            data = commands.read(header.size)
+            if len(data) < header.size:
+                break
+            seq, length = header.unpack(data)
+            if not length:
+                break
+            source = commands.read(length)
+            status, message = 'ok', ''
+            try:
+                exec(source, globals())
+            except KeyboardInterrupt:
+                status = 'interrupted'
+                print('KeyboardInterrupt')
+            except Exception:
+                etype, evalue = sys.exc_info()[:2]
+                message = ''.join(
+                    traceback.format_exception_only(etype, evalue)).rstrip()
+                status = 'error'
+                print(message)
+            sys.stdout.flush()
+            print('<<drivecasa:fifo:%d:%s>>' % (seq, status))
+            sys.stdout.flush()
+            frame = status + '\\n' + message
+            results.write(header.pack(seq, len(frame)) + frame)
+            results.flush()
+    finally:
+        commands.close()
+        results.close()
+    """
+
+register('drivecasa_dump_pixels', def_dump_pixels)
+register('drivecasa_load_antennalist', def_load_antennalist)
+register('drivecasa_componentlist_from_table', def_componentlist_from_table)
+register('drivecasa_reset_session', def_reset_session)
+register('drivecasa_stage', def_stage)
+register('drivecasa_save_value', def_save_value)
+register('drivecasa_run', def_run, preload=True)
+register('drivecasa_run_batch', def_run_batch, preload=True)
+register('drivecasa_serve_fifo', def_serve_fifo, preload=True)
+
+all_subroutines = tuple(registry.values())
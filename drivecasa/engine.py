@@ -0,0 +1,284 @@
+"""
+Process engines for driving casapy.
+
+By default casapy is run under a pseudo-terminal via :class:`pexpect.spawn`
+(``engine='pty'``), as the historical note in :mod:`drivecasa.interface`
+explains. The terminal echoes every command, translates each ``\\n`` to
+``\\r\\n``, and pexpect waits briefly before each send; all of which costs
+time on every command and every byte of output.
+
+:class:`PipeSpawn` (``engine='pipe'``) instead runs casapy with plain pipes
+for stdin / stdout / stderr. To avoid the pipe-fill deadlocks which
+originally motivated the switch to pexpect, a reader thread per output pipe
+drains it continuously into a bounded in-memory buffer, from which the
+usual pexpect ``expect`` machinery reads.
+"""
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import subprocess
+import threading
+import time
+
+from pexpect import EOF, TIMEOUT
+from pexpect.spawnbase import SpawnBase
+
+logger = logging.getLogger(__name__)
+
+
+class PipeSpawn(SpawnBase):
+    """
+    A :class:`pexpect.spawn` work-alike which talks to the child process via
+    pipes rather than a pseudo-terminal.
+
+    Provides the subset of the :class:`pexpect.spawn` interface used by
+    :class:`.Casapy`: ``expect``, ``before``, ``send`` / ``sendline``,
+    ``sendintr``, ``isalive``, ``terminate``, ``close``, ``pid`` and
+    ``child_fd`` (which becomes readable whenever new output is buffered,
+    for use with ``select`` / event-loops).
+
+    Stdout and stderr are merged, a line at a time for stderr (so a log
+    message is never spliced into the middle of a stdout line), and as it
+    arrives for stdout (so prompts without a trailing newline are seen).
+    Output lines end in ``\\n`` (see ``crlf``), and commands are not echoed.
+    """
+
+    def __init__(self, command, args=(), timeout=30, maxread=65536,
+                 searchwindowsize=None, cwd=None, env=None, encoding=None,
+                 max_buffer=1 << 20):
+        """
+        Args:
+            command (str): Program to run.
+            args (list): Arguments to pass to it.
+            timeout, maxread, searchwindowsize, encoding: As for
+                :class:`pexpect.spawn`.
+            cwd, env: Working directory and environment for the child.
+            max_buffer (int): Maximum number of bytes of output to buffer.
+                Once the buffer is full, the reader threads stop draining
+                the pipes until output has been consumed by ``expect``.
+        """
+        super(PipeSpawn, self).__init__(timeout=timeout, maxread=maxread,
+                                        searchwindowsize=searchwindowsize,
+                                        encoding=encoding)
+        self.crlf = b'\n' if encoding is None else u'\n'
+        self.echo = False
+        self.delaybeforesend = None
+        self.max_buffer = max_buffer
+        self.command = command
+        self.args = list(args)
+        # Run in a new session / process group, so that sendintr can signal
+        # casapy along with any subprocesses of its start-up script.
+        self.proc = subprocess.Popen([command] + self.args,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     cwd=cwd, env=env, bufsize=0,
+                                     preexec_fn=os.setsid,
+                                     close_fds=True)
+        self.pid = self.proc.pid
+        self.closed = False
+        self.terminated = False
+
+        self._output = bytearray()
+        self._cond = threading.Condition()
+        self._n_open = 2
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        flags = fcntl.fcntl(self._wakeup_w, fcntl.F_GETFL)
+        fcntl.fcntl(self._wakeup_w, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.child_fd = self._wakeup_r
+        self._readers = [
+            threading.Thread(target=self._drain,
+                             args=(self.proc.stdout, False),
+                             name='drivecasa-stdout-{}'.format(self.pid)),
+            threading.Thread(target=self._drain,
+                             args=(self.proc.stderr, True),
+                             name='drivecasa-stderr-{}'.format(self.pid)),
+        ]
+        for reader in self._readers:
+            reader.daemon = True
+            reader.start()
+
+    def _drain(self, pipe, whole_lines):
+        """
+        Reader thread: move output from ``pipe`` to the shared buffer, until
+        the pipe is closed.
+        """
+        fd = pipe.fileno()
+        partial = b''
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                data = b''
+            if not data:
+                # Flush any incomplete last line.
+                self._append(partial)
+                break
+            if whole_lines:
+                data, newline, partial = (partial + data).rpartition(b'\n')
+                data += newline
+            self._append(data)
+        pipe.close()
+        with self._cond:
+            self._n_open -= 1
+        self._wake()
+
+    def _append(self, data):
+        if not data:
+            return
+        with self._cond:
+            while len(self._output) >= self.max_buffer and not self.closed:
+                self._cond.wait()
+            if self.closed:
+                return
+            self._output.extend(data)
+        self._wake()
+
+    def _wake(self):
+        """Make ``child_fd`` readable."""
+        with self._cond:
+            if self._wakeup_w is None:
+                # Closed.
+                return
+            try:
+                os.write(self._wakeup_w, b'x')
+            except OSError:
+                # Already readable (pipe full).
+                pass
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        """
+        Read up to ``size`` characters of buffered output, waiting up to
+        ``timeout`` seconds for some to arrive.
+
+        Raises:
+            pexpect.TIMEOUT: If no output arrives in time.
+            pexpect.EOF: If the child has closed its output and the buffer
+                is empty.
+        """
+        if timeout == -1:
+            timeout = self.timeout
+        while True:
+            with self._cond:
+                if self._output:
+                    data = bytes(self._output[:size])
+                    del self._output[:size]
+                    more = bool(self._output)
+                    self._cond.notify_all()
+                    break
+                if not self._n_open:
+                    self.flag_eof = True
+                    raise EOF('End Of File (EOF).')
+            ready, _, _ = select.select([self._wakeup_r], [], [], timeout)
+            if not ready:
+                raise TIMEOUT('Timeout exceeded.')
+            os.read(self._wakeup_r, 65536)
+        if more:
+            # The wakeup pipe may have been drained above, keep child_fd
+            # readable while output remains buffered.
+            self._wake()
+        s = self._decoder.decode(data, final=False)
+        self._log(s, 'read')
+        return s
+
+    def send(self, s):
+        """
+        Write ``s`` to the child's stdin.
+
+        Returns:
+            The number of bytes written.
+        """
+        s = self._coerce_send_string(s)
+        self._log(s, 'send')
+        data = self._encoder.encode(s, final=False)
+        try:
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+        except (IOError, OSError) as e:
+            if e.errno == errno.EPIPE:
+                raise EOF('Child process closed stdin.')
+            raise
+        return len(data)
+
+    def sendline(self, s=''):
+        """Write ``s`` to the child's stdin, followed by a newline."""
+        return self.send(s) + self.send(self.linesep)
+
+    def sendeof(self):
+        """Close the child's stdin."""
+        self.proc.stdin.close()
+
+    def sendintr(self):
+        """Send SIGINT to the child's process group (as for Ctrl-C)."""
+        self._signal_group(signal.SIGINT)
+
+    def isalive(self):
+        """Returns ``True`` if the child process is still running."""
+        return self.proc.poll() is None
+
+    def terminate(self, force=False):
+        """
+        Terminate the child's process group, with SIGHUP / SIGINT, then
+        SIGKILL if ``force`` is set and it has not exited.
+
+        Returns:
+            ``True`` if the child has exited.
+        """
+        for sig in (signal.SIGHUP, signal.SIGINT):
+            self._signal_group(sig)
+            if self._wait_exit(0.1):
+                return True
+        if force:
+            self._signal_group(signal.SIGKILL)
+            return self._wait_exit(1)
+        return not self.isalive()
+
+    def close(self, force=True):
+        """
+        Close the pipes and terminate the child (if still running).
+        """
+        if self.closed:
+            return
+        if self.isalive():
+            self.terminate(force)
+        with self._cond:
+            # Unblock any reader waiting for buffer space.
+            self.closed = True
+            self._cond.notify_all()
+        try:
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        try:
+            for reader in self._readers:
+                reader.join(1)
+        finally:
+            # Any reader still running (e.g. if a grandchild holds the
+            # output pipes open) checks for this before waking, see _wake.
+            with self._cond:
+                os.close(self._wakeup_r)
+                os.close(self._wakeup_w)
+                self._wakeup_r = self._wakeup_w = None
+            self.child_fd = -1
+        self.terminated = not self.isalive()
+        self.exitstatus = self.proc.returncode
+
+    def _signal_group(self, sig):
+        try:
+            os.killpg(self.pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _wait_exit(self, timeout):
+        deadline = time.time() + timeout
+        while self.isalive():
+            if time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
@@ -0,0 +1,166 @@
+"""
+Per-command timing and resource-usage instrumentation.
+
+CPU time and memory usage are read from ``/proc``, so are only available on
+Linux. They are summed over the casapy process and all its descendants,
+since the ``casa`` executable is typically a wrapper script which launches
+the actual casapy interpreter (and CASA tasks may run helper processes).
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+
+_proc_dir = '/proc'
+
+try:
+    _clock_ticks = os.sysconf('SC_CLK_TCK')
+except (AttributeError, ValueError, OSError):
+    _clock_ticks = 100
+
+
+class CommandStats(namedtuple('CommandStats',
+                              ('index', 'command', 'wall_time', 'cpu_time',
+                               'peak_rss'))):
+    """
+    Resources used while running a command, see :meth:`.Casapy.run_script`.
+
+    Fields:
+
+    - ``index``: Position of the command within the script.
+    - ``command``: The command text. (In batched mode, stats are recorded
+      per-batch, in which case this holds all the commands in the batch,
+      newline-separated, and ``index`` refers to the first.)
+    - ``wall_time``: Elapsed time, in seconds.
+    - ``cpu_time``: User + system CPU time used by casapy, in seconds
+      (``None`` if unavailable).
+    - ``peak_rss``: Peak resident memory of casapy while running the
+      command, in bytes (``None`` if unavailable). Sampled periodically, so
+      very brief peaks may be missed.
+    """
+
+    def as_dict(self):
+        return dict(zip(self._fields, self))
+
+
+def process_tree(pid):
+    """
+    Returns a list of ``pid`` and the process IDs of all its descendants.
+    """
+    children = {}
+    try:
+        entries = os.listdir(_proc_dir)
+    except OSError:
+        return [pid]
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        stat = _read_stat(int(entry))
+        if stat is not None:
+            children.setdefault(int(stat[1]), []).append(int(entry))
+    tree = [pid]
+    for p in tree:
+        tree.extend(children.get(p, []))
+    return tree
+
+
+def cpu_time(pids):
+    """
+    Total user + system CPU time (including reaped children) of ``pids``, in
+    seconds, or ``None`` if unavailable.
+    """
+    total = None
+    for pid in pids:
+        stat = _read_stat(pid)
+        if stat is None:
+            continue
+        # utime, stime, cutime, cstime, cf proc(5)
+        ticks = sum(int(field) for field in stat[11:15])
+        total = (total or 0) + ticks / float(_clock_ticks)
+    return total
+
+
+def resident_memory(pids):
+    """
+    Total resident memory of ``pids`` in bytes, or ``None`` if unavailable.
+    """
+    total = None
+    for pid in pids:
+        try:
+            with open(os.path.join(_proc_dir, str(pid), 'status')) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total = (total or 0) + int(line.split()[1]) * 1024
+                        break
+        except (IOError, OSError):
+            continue
+    return total
+
+
+def _read_stat(pid):
+    """
+    Returns the fields of ``/proc/<pid>/stat`` following the process name,
+    (i.e. starting from 'state'), or ``None`` if the process has gone.
+    """
+    try:
+        with open(os.path.join(_proc_dir, str(pid), 'stat')) as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return None
+    # The process name may contain spaces, but is bracketed.
+    return stat[stat.rfind(')') + 2:].split()
+
+
+class CommandMonitor(object):
+    """
+    Measures the resources used by a process tree between :meth:`start`
+    and :meth:`stop`.
+
+    Memory usage is sampled in a background thread.
+    """
+
+    def __init__(self, pid, sample_interval=0.5):
+        self.pid = pid
+        self.sample_interval = sample_interval
+        self._stopped = threading.Event()
+        self._thread = None
+        self._start_wall = None
+        self._start_cpu = None
+        self.peak_rss = None
+
+    def start(self):
+        self._start_wall = time.time()
+        self._start_cpu = cpu_time(process_tree(self.pid))
+        self._sample()
+        self._thread = threading.Thread(target=self._sample_loop)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, index, command):
+        """
+        Stop monitoring.
+
+        Returns:
+            :class:`CommandStats`
+        """
+        wall_time = time.time() - self._start_wall
+        self._stopped.set()
+        self._thread.join()
+        self._sample()
+        end_cpu = cpu_time(process_tree(self.pid))
+        used_cpu = None
+        if end_cpu is not None and self._start_cpu is not None:
+            used_cpu = end_cpu - self._start_cpu
+        return CommandStats(index=index, command=command,
+                            wall_time=wall_time, cpu_time=used_cpu,
+                            peak_rss=self.peak_rss)
+
+    def _sample_loop(self):
+        while not self._stopped.wait(self.sample_interval):
+            self._sample()
+
+    def _sample(self):
+        rss = resident_memory(process_tree(self.pid))
+        if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+            self.peak_rss = rss
@@ -1,10 +1,21 @@
+import json
 import logging
 import os
+import re
 import sys
+import numpy as np
 import pexpect
 import tempfile
+import time
+from collections import deque, namedtuple
 import drivecasa.utils
+from drivecasa.cache import CachedStep
 from drivecasa.casa_env import casapy_env
+from drivecasa.checkpoint import Checkpoint
+from drivecasa.engine import PipeSpawn
+from drivecasa.instrument import CommandMonitor
+from drivecasa.staging import wait_command as staging_wait_command
+from drivecasa.transport import FifoChannel
 import drivecasa.commands.subroutines as subroutines
 
 logger = logging.getLogger(__name__)
@@ -20,6 +31,207 @@ logger = logging.getLogger(__name__)
 
 default_casa_dir = os.environ.get('CASA_DIR', None)
 
+# On Python 3, have pexpect decode the casapy output to `str`.
+_child_encoding = 'utf-8' if sys.version_info[0] >= 3 else None
+
+# Printed by the `drivecasa_run_batch` subroutine around each command,
+# cf :meth:`Casapy.run_script` (batched mode).
+_batch_marker = re.compile(r'^<<drivecasa:(\d+):(begin|ok|error)>>$')
+
+# Printed by the `drivecasa_run` subroutine once each command has completed,
+# cf :meth:`Casapy._begin_execute`.
+_sentinel = r'<<drivecasa:done:{}:(ok|error|interrupted)>>'
+
+# Sentinels only ever appear at the end of the output received so far, so
+# there is no need to search (repeatedly) the whole of a command's output.
+_sentinel_window = 4096
+
+# Commands after which any staged outputs are back in place.
+_staging_waits = (staging_wait_command, 'drivecasa_reset_session()')
+
+
+class OutputLine(namedtuple('OutputLine',
+                             ('index', 'command', 'text', 'severe'))):
+    """
+    A line of casapy output, as yielded by :meth:`Casapy.iter_script`.
+
+    Fields: ``('index', 'command', 'text', 'severe')``, where ``index``
+    is the position within the script of the ``command`` which produced
+    this line of output ``text``, and ``severe`` flags 'SEVERE' level log
+    messages.
+    """
+
+
+class ScriptResult(namedtuple('ScriptResult', ('casa_out', 'errors'))):
+    """
+    Returned by :meth:`Casapy.run_script` and
+    :meth:`Casapy.run_script_from_file`.
+
+    Unpacks as the tuple ``(casa_out, errors)``, for backwards compatibility.
+
+    Attributes:
+        stats: List of :class:`.CommandStats`, one per command run
+            (empty unless the :class:`Casapy` instance was created with
+            ``instrument=True``).
+    """
+
+    def __new__(cls, casa_out, errors, stats=None):
+        self = super(ScriptResult, cls).__new__(cls, casa_out, errors)
+        self.stats = stats if stats is not None else []
+        return self
+
+
+def _is_severe(line):
+    """Returns ``True`` if this line is a 'SEVERE' level log message."""
+    tokens = line.split('\t', 2)
+    return (len(tokens) >= 2) and (tokens[1] == 'SEVERE')
+
+
+def _find_severe_lines(out_lines):
+    """Return any 'SEVERE' level log messages from a list of output lines."""
+    return [line for line in out_lines if _is_severe(line)]
+
+
+# Subroutines whose calls only write files (query results, componentlists,
+# staged copies), so are not replayed after a respawn by default.
+_unreplayed_subroutines = ('drivecasa_save_value', 'drivecasa_dump_pixels',
+                           'drivecasa_componentlist_from_table',
+                           'drivecasa_stage')
+
+
+def _replay_by_default(cmd):
+    """
+    Default ``replay_filter``: skip :class:`.CachedStep` commands, since
+    their outputs are already on disk, and calls to the subroutines in
+    ``_unreplayed_subroutines``.
+    """
+    if isinstance(cmd, CachedStep):
+        return False
+    return not any(name in cmd for name in _unreplayed_subroutines)
+
+
+def _split_batch_output(out_lines):
+    """
+    Split the output of a batched script into per-command segments.
+
+    Returns:
+        Tuple ``(segments, statuses)``, dicts mapping command index to
+        the list of output lines and the completion status ('ok' or 'error')
+        respectively. Commands which were never reached are absent.
+    """
+    segments = {}
+    statuses = {}
+    current = None
+    for line in out_lines:
+        match = _batch_marker.match(line)
+        if match:
+            index, state = int(match.group(1)), match.group(2)
+            if state == 'begin':
+                current = index
+                segments[index] = []
+            else:
+                statuses[index] = state
+                current = None
+        elif current is not None:
+            segments[current].append(line)
+    return segments, statuses
+
+
+def _decode_json_array(obj):
+    """
+    Restore the NumPy arrays encoded by the ``drivecasa_save_value``
+    subroutine.
+    """
+    if '__ndarray__' in obj:
+        return np.array(obj['__ndarray__'], dtype=obj['dtype'])
+    return obj
+
+
+def _check_output(out_lines, status, description, raise_on_severe):
+    """
+    Check casapy output for exceptions and SEVERE messages.
+
+    Args:
+        out_lines: Output lines from running a command or script.
+        status: Completion status ('ok' / 'error'), or ``None`` if unknown.
+        description: Describes what was run, for use in error messages.
+        raise_on_severe: See :meth:`Casapy.run_script`.
+
+    Returns:
+        Tuple ``(out_lines, severe_lines)``.
+    """
+    severe_warnings_raised = _find_severe_lines(out_lines)
+    if status == 'error' or any("Error:" in l for l in out_lines):
+        raise ValueError(
+            "Casapy probably encountered an exception running the "
+            + description + ": \n"
+            + "*********\n"
+            + "\n".join(out_lines)
+            + "\n*********\n"
+        )
+
+    if severe_warnings_raised and raise_on_severe:
+        error_str = '\n'.join(severe_warnings_raised)
+        raise RuntimeError(
+            "Casapy encountered a 'SEVERE' level problem running the "
+            + description + ": \n"
+            + "*********\n"
+            + "\n".join(out_lines)
+            + "\n*********\n"
+            + "Errors are as follows:\n"
+            + error_str)
+    return out_lines, severe_warnings_raised
+
+
+def _check_batch_output(batch, batch_start, out_lines, raise_on_severe):
+    """
+    Check the output of a batch of commands, cf :func:`_check_output`.
+    """
+    segments, statuses = _split_batch_output(out_lines)
+    if not segments:
+        # The batch-runner itself failed; report whatever we got.
+        raise ValueError(
+            "Casapy probably encountered an exception running a "
+            "batch of commands: \n"
+            + "*********\n"
+            + "\n".join(out_lines)
+            + "\n*********\n"
+        )
+    casa_out = []
+    errors = []
+    for index, cmd in enumerate(batch, batch_start):
+        if index not in segments:
+            break
+        cmd_out, cmd_errors = _check_output(segments[index],
+                                            statuses.get(index, 'error'),
+                                            "command " + cmd,
+                                            raise_on_severe)
+        casa_out.extend(cmd_out)
+        errors.extend(cmd_errors)
+    return casa_out, errors
+
+
+def _check_streamed_command(cmd, status, severe_lines, error_lines,
+                            raise_on_severe):
+    """
+    Equivalent of :func:`_check_output` for :meth:`Casapy.iter_script`,
+    where only the relevant lines have been retained.
+    """
+    if status == 'error' or error_lines:
+        raise ValueError(
+            "Casapy probably encountered an exception running the "
+            "command " + cmd + ": \n"
+            + "*********\n"
+            + "\n".join(error_lines)
+            + "\n*********\n"
+        )
+    if severe_lines and raise_on_severe:
+        raise RuntimeError(
+            "Casapy encountered a 'SEVERE' level problem running the "
+            "command " + cmd + ": \n"
+            + "Errors are as follows:\n"
+            + "\n".join(severe_lines))
+
 
 class Casapy(object):
     """
@@ -47,6 +259,15 @@ class Casapy(object):
                  timeout=600,
                  log2term=True,
                  echo_to_stdout=False,
+                 transport='pty',
+                 engine='pty',
+                 output_capture=None,
+                 instrument=False,
+                 stats_logfile=None,
+                 crash_recovery=False,
+                 max_respawns=3,
+                 replay_filter=None,
+                 result_cache=None,
                  ):
         """
         Initialise a casapy instance.
@@ -84,7 +305,87 @@ class Casapy(object):
                 at the price of cluttering your working terminal. As an alternative,
                 it is recommended to open a separate terminal and ``tail -f`` the
                 casa_logfile.
+            transport: How commands are passed to casapy. Valid options are:
+
+                - ``'pty'`` (default): each command is written to a tempfile,
+                  which casapy is told to ``execfile`` via the terminal.
+                - ``'fifo'``: commands are streamed to a subroutine running
+                  inside casapy via a named pipe, avoiding the per-command
+                  tempfile and terminal round-trip.
+                  See :class:`drivecasa.transport.FifoChannel`.
+            engine: How casapy is run. Valid options are:
+
+                - ``'pty'`` (default): under a pseudo-terminal, via pexpect.
+                - ``'pipe'``: with plain pipes, avoiding the terminal's
+                  echo and line-ending translation.
+                  See :class:`drivecasa.engine.PipeSpawn`.
+            output_capture: Controls how much output is retained by
+                :meth:`run_script`. ``None`` (the default) retains everything.
+                Otherwise, should be one of the policies in
+                :mod:`drivecasa.capture`, in which case output is read
+                line-by-line (as for :meth:`iter_script`) and passed to a
+                buffer created by the policy.
+            instrument: Record the wall-time, CPU-time and peak memory usage
+                of each command run (see :class:`.CommandStats`).
+                The results are attached to the value returned by
+                :meth:`run_script` (see :class:`.ScriptResult`), and are also
+                available as the ``command_stats`` attribute after each
+                call to :meth:`run_script` / :meth:`iter_script`.
+            stats_logfile: Path of logfile to append the per-command
+                statistics to, as JSON lines. Implies ``instrument=True``.
+                As with ``commands_logfile``, will not overwrite an
+                existing file.
+            crash_recovery: If casapy dies part-way through
+                :meth:`run_script` or :meth:`iter_script` (e.g. a segfault),
+                spawn a fresh casapy, replay the commands which had completed
+                successfully in the session so far (recorded in
+                ``session_history``, cleared by :meth:`reset_session`), then
+                resume the script from the command which was running when
+                casapy died. (With the asyncio API, the event loop is
+                blocked while casapy is respawned and the session replayed.)
+            max_respawns: Maximum number of times casapy is respawned during
+                a single call to :meth:`run_script` / :meth:`iter_script`
+                with ``crash_recovery`` enabled, after which the ``pexpect.EOF``
+                is re-raised (e.g. if a command crashes casapy every time).
+            replay_filter: Optional function taking a command and returning
+                ``True`` if it should be replayed after a respawn, to
+                limit the replay to the setup commands which actually matter
+                (e.g. ``lambda cmd: cmd.startswith('sm.')``).
+                ``None`` implies replay everything except
+                :class:`.CachedStep` commands (e.g. those generated by the
+                :mod:`drivecasa.commands.reduction` helpers), whose results
+                are already on disk, and drive-casa's own file-writing
+                helper calls (saving query results, building
+                componentlists from tables, staging). Everything else is
+                replayed as-is, including heavy commands such as
+                ``sm.observe`` / ``sm.predict``, which append to any
+                existing MeasurementSet - pass a filter to skip these.
+            result_cache: A :class:`.ResultCache`. If given, script commands
+                which are :class:`.CachedStep` instances (as generated by
+                the :mod:`drivecasa.commands.reduction` helpers) are
+                recorded on completion, and skipped by later runs if their
+                inputs and outputs are unchanged.
         """
+        if transport not in ('pty', 'fifo'):
+            raise ValueError("Unknown transport: " + repr(transport))
+        if engine not in ('pty', 'pipe'):
+            raise ValueError("Unknown engine: " + repr(engine))
+        self.engine = engine
+        self.output_capture = output_capture
+        self.instrument = instrument or stats_logfile is not None
+        self.command_stats = []
+        self._checkpoint = None
+        self.transport = transport
+        self.crash_recovery = crash_recovery
+        self.max_respawns = max_respawns
+        self.replay_filter = replay_filter
+        self.result_cache = result_cache
+        #: Commands completed successfully since casapy was spawned or reset
+        #: (only recorded if ``crash_recovery`` is enabled).
+        self.session_history = []
+        # Staged steps completed, but awaiting the move back of their
+        # outputs: tuples ``(checkpoint, index, command)``.
+        self._staged_steps = []
         drivecasa.utils.ensure_dir(working_dir)
         # NB It would make sense to switch off ipython, ('noipython' flag)
         # but doing so breaks stuff! I suspect this may be a bug.
@@ -120,6 +421,13 @@ class Casapy(object):
                     "at " + commands_logfile)
                 raise
 
+        self.stats_logfile_handle = None
+        if stats_logfile is not None:
+            if os.path.isfile(stats_logfile):
+                raise ValueError("Will not overwrite a logfile, "
+                                 "try including a timestamp in the filename.")
+            self.stats_logfile_handle = open(stats_logfile, 'w')
+
         if log2term:
             cmd.append('--log2term')
 
@@ -131,18 +439,56 @@ class Casapy(object):
         else:
             casapy_cmd = os.path.join(casa_dir, 'bin', 'casa')
 
+        self._spawn_args = (casapy_cmd, cmd, working_dir, casa_dir, timeout,
+                            echo_to_stdout)
+        self.child = None
+        self.channel = None
+        self._seq = 0
+        #: Sentinel pattern for the command currently running, if any.
+        self._pending = None
+        if engine == 'pipe':
+            # Also consume the space following the prompt, since there is no
+            # echoed command for it to precede.
+            self.prompt = r'CASA <[0-9]+>: '
+        else:
+            self.prompt = r'CASA <[0-9]+>:'
+        self._spawn()
+
+    def _spawn(self):
+        """
+        Start casapy (allowing up to 3 attempts), and get it ready to run
+        commands.
+        """
+        (casapy_cmd, cmd, working_dir, casa_dir, timeout,
+         echo_to_stdout) = self._spawn_args
         failed_casapy_spawns = 0
         self.child = None
+        self.channel = None
+        self._pending = None
+        # (The outputs of any staged steps by a dead casapy never arrive.)
+        self._staged_steps = []
+        self._loaded_subroutines = set()
         while failed_casapy_spawns < 3:
             try:
-                self.child = pexpect.spawn(casapy_cmd,
+                if self.engine == 'pipe':
+                    env = casapy_env(casa_dir)
+                    # Output to a pipe is block-buffered by default.
+                    env['PYTHONUNBUFFERED'] = '1'
+                    self.child = PipeSpawn(casapy_cmd,
                                            cmd,
                                            cwd=working_dir,
-                                           env=casapy_env(casa_dir),
-                                           timeout=timeout)
+                                           env=env,
+                                           timeout=timeout,
+                                           encoding=_child_encoding)
+                else:
+                    self.child = pexpect.spawn(casapy_cmd,
+                                               cmd,
+                                               cwd=working_dir,
+                                               env=casapy_env(casa_dir),
+                                               timeout=timeout,
+                                               encoding=_child_encoding)
                 if echo_to_stdout:
                     self.child.logfile_read = sys.stdout
-                self.prompt = r'CASA <[0-9]+>:'
                 self.child.expect(self.prompt, timeout=60)
                 break
             except pexpect.TIMEOUT:
@@ -153,9 +499,13 @@ class Casapy(object):
                 self.child = None
         if self.child is None:
             raise RuntimeError("Could not spawn CASA instance")
-        self.load_subroutines()
+        self.load_subroutines(subroutines.preloaded)
+        if self.transport == 'fifo':
+            self.channel = FifoChannel(self.child, self.prompt)
+            self.channel.open()
 
-    def run_script(self, script, raise_on_severe=True, timeout=-1):
+    def run_script(self, script, raise_on_severe=True, timeout=-1,
+                   batch_size=None, checkpoint=None, resume=False):
         """
         Run the commands listed in `script`.
 
@@ -170,14 +520,40 @@ class Casapy(object):
             timeout: If `-1` (the default, use the class default timeout).
                 Otherwise, specifies timeout in seconds for this command.
                 `None` implies no timeout (wait indefinitely).
-
+                (In batched mode, the timeout applies to each batch.)
+            batch_size: If ``None`` (the default), each command is sent to
+                casapy separately. Otherwise, commands are sent in batches
+                of up to this many commands, each batch requiring only a single
+                round-trip to casapy. Pass ``len(script)`` to send the whole
+                script at once. See note below.
+            checkpoint: Path of a checkpoint file, recording the index (and
+                any output paths) of each command as it completes.
+                See :class:`.Checkpoint`.
+            resume: If ``True``, skip the commands recorded as completed in
+                the ``checkpoint`` file by a previous run of the same script
+                (provided their outputs still exist), e.g. to carry on
+                after a failure part-way through. Note that casapy state set
+                up by skipped commands (variables, open tools) is not
+                restored, so any such set-up should be done separately.
 
         Returns:
             Tuple ``(casa_out, errors)``
                 Where ``casa_out`` is a line-by-line list containing the contents
                 of the casapy terminal output, and ``errors`` is a line-by-line
                 list of 'SEVERE' error messages.
+                (If an ``output_capture`` policy was specified,
+                ``casa_out`` is a buffer created by that policy.)
 
+        .. note::
+
+            In batched mode, casapy prints a marker line before and after
+            each command, so that output, SEVERE messages and exceptions are
+            still attributed to the command which produced them. A batch is
+            halted at the first command raising an exception, but SEVERE
+            messages are only inspected once the batch has completed, so
+            with ``raise_on_severe=True`` the remaining commands in that batch
+            will have been run before the ``RuntimeError`` is raised.
+            Use a smaller ``batch_size`` if this matters.
 
         """
         #     casa = subprocess.Popen(cmd,
@@ -187,41 +563,95 @@ class Casapy(object):
         #                         casa_out=subprocess.PIPE,
         #                         )
 
+        if self.output_capture is not None:
+            casa_out = self.output_capture.new_buffer()
+            errors = []
+            for line in self.iter_script(script, raise_on_severe, timeout,
+                                         batch_size, checkpoint, resume):
+                casa_out.append(line.text)
+                if line.severe:
+                    errors.append(line.text)
+            return ScriptResult(casa_out, errors, self.command_stats)
+
+        return self._run_steps(
+            self._script_steps(script, raise_on_severe, timeout, batch_size,
+                               checkpoint, resume),
+            timeout)
+
+    def _script_steps(self, script, raise_on_severe, timeout, batch_size,
+                      checkpoint, resume):
+        """
+        The body of :meth:`run_script`, shared with
+        :meth:`run_script_async`.
+
+        A generator which yields the source of each batch to be executed,
+        expecting to be sent the resulting ``(out_lines, status)`` (or
+        thrown the ``pexpect.EOF``, if casapy died), as done by
+        :meth:`_run_steps`. Finally yields the :class:`ScriptResult`.
+        """
         casa_out = []
         errors = []
-        logger.debug("Running casa script:")
-        logger.debug("*************")
-        logger.debug('\n' + '\n'.join([l for l in script]))
-        logger.debug("*************")
-        for cmd in script:
-            # Casapy gets upset when you feed it a long command
-            # The output gets filled with backspace characters as it reformats,
-            # which is a PITA to parse.
-            # So instead, we dump the command in a tempfile, and tell casa to
-            # exec it. Oh, the perversity!
-            with tempfile.NamedTemporaryFile(delete=False) as tmpfile:
-                tmpfile_path = tmpfile.name
-                tmpfile.write(cmd + '\n')
+        self.command_stats = []
+        self._checkpoint = self._open_checkpoint(checkpoint, resume)
+        pending = deque(self._plan_script(script, batch_size))
+        respawns = 0
+        while pending:
+            batch_start, batch = self._next_batch(pending)
+            if not batch:
+                continue
+            source, tmpfile_path = self._prepare_source(batch, batch_start,
+                                                        batch_size)
+            monitor = self._start_monitor()
             try:
-                if self.commands_logfile_handle is not None:
-                    self.commands_logfile_handle.write(cmd + '\n')
-                    self.commands_logfile_handle.flush()
-                line_out, line_err = self.run_script_from_file(tmpfile_path,
-                                                               raise_on_severe,
-                                                               command_pre_logged=True,
-                                                               timeout=timeout)
-            except RuntimeError as e:
-                raise RuntimeError(
-                    "Casapy encountered a 'SEVERE' level problem running the "
-                    "command " + cmd + "\n"
-                                       "Error message is as follows:\n" +
-                    e.message)
-            casa_out.extend(line_out)
-            errors.extend(line_err)
+                out_lines, status = yield source
+            except pexpect.EOF:
+                if not self.crash_recovery or respawns >= self.max_respawns:
+                    raise
+                respawns += 1
+                n_done = 0
+                if batch_size is not None:
+                    n_done = self._count_completed(
+                        batch_start, self.child.before.split(self.child.crlf))
+                self._commands_completed(batch_start, batch[:n_done])
+                pending.appendleft(self._recover(batch, batch_start, n_done,
+                                                 timeout))
+                continue
+            finally:
+                self._stop_monitor(monitor, batch_start, batch)
+                if tmpfile_path is not None:
+                    os.remove(tmpfile_path)
+            try:
+                batch_out, batch_errors = self._check_script_output(
+                    batch, batch_start, batch_size, out_lines, status,
+                    raise_on_severe)
+            except (ValueError, RuntimeError):
+                if batch_size is not None:
+                    n_done = self._count_completed(batch_start, out_lines,
+                                                   raise_on_severe)
+                    self._commands_completed(batch_start, batch[:n_done])
+                raise
+            self._commands_completed(batch_start, batch)
+            casa_out.extend(batch_out)
+            errors.extend(batch_errors)
+        yield ScriptResult(casa_out, errors, self.command_stats)
 
-            os.remove(tmpfile_path)
-            out_lines = self.child.before.split('\r\n')
-        return casa_out, errors
+    def _run_steps(self, steps, timeout):
+        """
+        Run a generator of steps such as :meth:`_script_steps`, executing
+        each source it yields, until it yields the :class:`ScriptResult`.
+        """
+        try:
+            request = next(steps)
+            while not isinstance(request, ScriptResult):
+                try:
+                    reply = self._execute(request, timeout)
+                except pexpect.EOF:
+                    request = steps.throw(*sys.exc_info())
+                else:
+                    request = steps.send(reply)
+            return request
+        finally:
+            steps.close()
 
     def run_script_from_file(self, path_to_scriptfile, raise_on_severe=True,
                              command_pre_logged=False,
@@ -248,47 +678,775 @@ class Casapy(object):
                 of the casapy terminal output, and ``errors`` is a line-by-line
                 list of 'SEVERE' error messages.
         """
+        exec_cmd = self._prepare_script_file(path_to_scriptfile,
+                                             command_pre_logged)
+        monitor = self._start_monitor()
+        try:
+            out_lines, status = self._execute(exec_cmd, timeout)
+        finally:
+            self._stop_monitor(monitor, 0, [exec_cmd])
+        return self._script_file_result(path_to_scriptfile, exec_cmd,
+                                        out_lines, status, raise_on_severe)
+
+    def run_script_async(self, script, raise_on_severe=True, timeout=-1,
+                         batch_size=None, checkpoint=None, resume=False):
+        """
+        Asyncio counterpart of :meth:`run_script`.
+
+        Returns a coroutine, which waits for casapy output without blocking
+        the event loop, so that a single loop can drive many casapy sessions
+        concurrently, e.g.::
+
+            results = await asyncio.gather(
+                casa1.run_script_async(script1),
+                casa2.run_script_async(script2))
+
+        If the awaiting task is cancelled, the running command is
+        interrupted (see :meth:`interrupt`) before the ``CancelledError``
+        is propagated, leaving the session ready for re-use.
 
-        casa_stdout = []
-        severe_warnings_raised = []
+        Requires Python 3.5+.
+        """
+        from drivecasa._async import run_script_async
+        return run_script_async(self, script, raise_on_severe, timeout,
+                                batch_size, checkpoint, resume)
+
+    def run_script_from_file_async(self, path_to_scriptfile,
+                                   raise_on_severe=True,
+                                   command_pre_logged=False,
+                                   timeout=-1):
+        """
+        Asyncio counterpart of :meth:`run_script_from_file`.
+
+        See :meth:`run_script_async`. Requires Python 3.5+.
+        """
+        from drivecasa._async import run_script_from_file_async
+        return run_script_from_file_async(self, path_to_scriptfile,
+                                          raise_on_severe, command_pre_logged,
+                                          timeout)
+
+    def iter_script(self, script, raise_on_severe=True, timeout=-1,
+                    batch_size=None, checkpoint=None, resume=False):
+        """
+        Run the commands listed in `script`, yielding output as it arrives.
 
+        A generator alternative to :meth:`run_script`, useful for
+        monitoring the progress of long-running commands. Output is not
+        accumulated, so memory use stays constant no matter how verbose
+        casapy is. Arguments are as for :meth:`run_script`, and the same
+        exceptions are raised once the offending command has completed.
+
+        To abort early, simply stop iterating and ``close()`` the
+        generator (this happens automatically on garbage-collection, or if
+        ``break``-ing out of a for-loop over a generator which is then
+        discarded); the running command is interrupted (see
+        :meth:`interrupt`) so the session remains usable, e.g.::
+
+            lines = casa.iter_script(script)
+            for line in lines:
+                monitor(line.text)
+                if line.severe:
+                    lines.close()
+
+        If casapy dies and is respawned (see ``crash_recovery``), output
+        already yielded for the command which was running is yielded again
+        when that command is re-run.
+
+        Yields:
+            :class:`.OutputLine` instances.
+        """
+        self.command_stats = []
+        self._checkpoint = self._open_checkpoint(checkpoint, resume)
+        pending = deque(self._plan_script(script, batch_size))
+        respawns = 0
+        while pending:
+            batch_start, batch = self._next_batch(pending)
+            if not batch:
+                continue
+            source, tmpfile_path = self._prepare_source(batch, batch_start,
+                                                        batch_size)
+            monitor = self._start_monitor()
+            n_history = len(self.session_history)
+            try:
+                for line in self._iter_output(source, batch, batch_start,
+                                              batch_size, timeout,
+                                              raise_on_severe):
+                    yield line
+            except pexpect.EOF:
+                if not self.crash_recovery or respawns >= self.max_respawns:
+                    raise
+                respawns += 1
+                n_done = len(self.session_history) - n_history
+                pending.appendleft(self._recover(batch, batch_start, n_done,
+                                                 timeout))
+            finally:
+                self._stop_monitor(monitor, batch_start, batch)
+                if tmpfile_path is not None:
+                    os.remove(tmpfile_path)
+
+    def _iter_output(self, source, batch, batch_start, batch_size, timeout,
+                     raise_on_severe):
+        """
+        Execute ``source``, yielding output lines as they arrive.
+
+        Output is attributed to commands by tracking the batch markers (in
+        batched mode), and each command is checked for errors as it
+        completes. If a command fails, output is drained until casapy is
+        ready for the next command, and then the exception is raised.
+        """
+        if timeout == -1:
+            timeout = self.child.timeout
+        deadline = None if timeout is None else time.time() + timeout
+        pattern = self._begin_execute(source)
+        # State for the command currently running:
+        index = batch_start if batch_size is None else None
+        severe_lines = []
+        error_lines = []
+        unattributed_error_lines = []
+        first_line = True
+        running = True
+        failure = None
+        try:
+            while running:
+                remaining = None
+                if deadline is not None:
+                    remaining = max(deadline - time.time(), 0)
+                if self.child.expect([pattern, self.child.crlf],
+                                     timeout=remaining) == 0:
+                    running = False
+                    texts = [self.child.before] if self.child.before else []
+                    _, status, prompt_follows = self._collect_output()
+                    if prompt_follows:
+                        # Keep any output printed before the prompt, as for
+                        # _finish_execute.
+                        self.child.expect(self.prompt)
+                        texts.extend(self._trailing_output())
+                else:
+                    status = None
+                    texts = [self.child.before]
+                    if first_line:
+                        first_line = False
+                        if self.channel is not None:
+                            skip = self.channel.skip_first_line
+                        else:
+                            # The echoed command (pipes do not echo).
+                            skip = self.engine == 'pty'
+                        if skip:
+                            continue
+                for text in texts:
+                    marker = _batch_marker.match(text)
+                    if batch_size is not None and marker:
+                        if marker.group(2) == 'begin':
+                            index = int(marker.group(1))
+                            severe_lines, error_lines = [], []
+                        else:
+                            cmd = batch[index - batch_start]
+                            try:
+                                _check_streamed_command(
+                                    cmd, marker.group(2), severe_lines,
+                                    error_lines, raise_on_severe)
+                                if failure is None:
+                                    self._commands_completed(index, [cmd])
+                            except (ValueError, RuntimeError) as e:
+                                failure = failure or e
+                            index = None
+                        continue
+                    if failure is not None:
+                        continue
+                    if index is None:
+                        if "Error:" in text:
+                            unattributed_error_lines.append(text)
+                        continue
+                    line = OutputLine(index, batch[index - batch_start], text,
+                                      _is_severe(text))
+                    if line.severe:
+                        severe_lines.append(text)
+                    if "Error:" in text:
+                        error_lines.append(text)
+                    yield line
+        except GeneratorExit:
+            if running:
+                self.interrupt()
+            raise
+        if failure is not None:
+            raise failure
+        if batch_size is None:
+            _check_streamed_command(batch[0], status, severe_lines,
+                                    error_lines, raise_on_severe)
+            self._commands_completed(batch_start, batch)
+        elif unattributed_error_lines:
+            raise ValueError(
+                "Casapy probably encountered an exception running a "
+                "batch of commands: \n"
+                + "*********\n"
+                + "\n".join(unattributed_error_lines)
+                + "\n*********\n"
+            )
+
+    def interrupt(self, timeout=60):
+        """
+        Interrupt the currently running command (as if Ctrl-C was pressed).
+
+        Only needed if a command has been abandoned part-way, e.g. after a
+        timeout. Waits until casapy is ready to accept further commands.
+        """
+        pattern = self._interrupt()
+        if pattern is not None:
+            self.child.expect(pattern, timeout=timeout,
+                              searchwindowsize=self._search_window())
+            self._finish_execute()
+
+    def _plan_script(self, script, batch_size):
+        """
+        Log the script, and split into chunks to be sent in one go.
+
+        Returns:
+            List of tuples ``(index_of_first_command, commands)``.
+        """
+        logger.debug("Running casa script:")
+        logger.debug("*************")
+        logger.debug('\n' + '\n'.join([l for l in script]))
+        logger.debug("*************")
+        script = list(script)
+        if batch_size is None:
+            return [(index, [cmd]) for index, cmd in enumerate(script)]
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer")
+        return [(start, script[start:start + batch_size])
+                for start in range(0, len(script), batch_size)]
+
+    def _open_checkpoint(self, checkpoint, resume):
+        if checkpoint is None:
+            if resume:
+                raise ValueError("Cannot resume without a checkpoint file")
+            return None
+        return Checkpoint(checkpoint, resume)
+
+    def _next_batch(self, pending):
+        """
+        Take the next batch from the ``pending`` deque, skipping any commands
+        already completed according to the checkpoint or result cache.
+
+        Returns:
+            Tuple ``(batch_start, batch)``. The batch may be empty, if all
+            its commands were skipped.
+        """
+        batch_start, batch = pending.popleft()
+        if self.result_cache is None and self._checkpoint is None:
+            return batch_start, batch
+        n_skip = 0
+        while (n_skip < len(batch) and
+               self._is_done(batch_start + n_skip, batch[n_skip])):
+            n_skip += 1
+        batch_start, batch = batch_start + n_skip, batch[n_skip:]
+        for offset in range(1, len(batch)):
+            # Whether a later step is up to date depends on the outcome of
+            # this batch, so split the batch before the next cacheable step.
+            cacheable = (self.result_cache is not None and
+                         isinstance(batch[offset], CachedStep))
+            checkpointed = (self._checkpoint is not None and
+                            self._checkpoint.completed(batch_start + offset,
+                                                       batch[offset]))
+            if cacheable or checkpointed:
+                pending.appendleft((batch_start + offset, batch[offset:]))
+                batch = batch[:offset]
+                break
+        return batch_start, batch
+
+    def _is_done(self, index, cmd):
+        if (self._checkpoint is not None and
+                self._checkpoint.completed(index, cmd)):
+            logger.info("Skipping command %s, completed by a previous run: "
+                        "%s", index, cmd)
+            return True
+        if self.result_cache is not None and self.result_cache.is_fresh(cmd):
+            logger.info("Skipping command %s, outputs are up to date: %s",
+                        index, cmd)
+            return True
+        return False
+
+    def _commands_completed(self, first_index, commands):
+        """
+        Record commands which have completed successfully.
+        """
+        if self.crash_recovery:
+            self.session_history.extend(commands)
+        for index, cmd in enumerate(commands, first_index):
+            if getattr(cmd, 'staged', False):
+                # Outputs are still being moved back, record them later.
+                self._staged_steps.append((self._checkpoint, index, cmd))
+                continue
+            self._record_completed(self._checkpoint, index, cmd)
+            if cmd in _staging_waits:
+                staged, self._staged_steps = self._staged_steps, []
+                for checkpoint, staged_index, staged_cmd in staged:
+                    self._record_completed(checkpoint, staged_index,
+                                           staged_cmd)
+
+    def _record_completed(self, checkpoint, index, cmd):
+        if checkpoint is not None:
+            checkpoint.record(index, cmd)
+        if self.result_cache is not None:
+            self.result_cache.record(cmd)
+
+    def _prepare_source(self, batch, batch_start, batch_size,
+                        log_commands=True):
+        """
+        Log the commands, and convert to a single line of source for casapy.
+
+        Returns:
+            Tuple ``(source, tmpfile_path)``. If the source refers to a
+            tempfile, then ``tmpfile_path`` should be removed once the
+            command has been executed.
+        """
+        if log_commands and self.commands_logfile_handle is not None:
+            for cmd in batch:
+                self.commands_logfile_handle.write(cmd + '\n')
+            self.commands_logfile_handle.flush()
+        if batch_size is None:
+            source = batch[0]
+        else:
+            source = "drivecasa_run_batch({}, {})".format(batch_start,
+                                                          repr(batch))
+        # Define any subroutines used for the first time in this session
+        # ahead of the commands, saving a separate round-trip.
+        needed = subroutines.required(batch, self._loaded_subroutines)
+        if needed:
+            source = subroutines.bundle(needed) + source
+            self._loaded_subroutines.update(needed)
+        if self.channel is not None:
+            # No terminal line-discipline to worry about, send as-is.
+            return source, None
+        # Casapy gets upset when you feed it a long command
+        # The output gets filled with backspace characters as it reformats,
+        # which is a PITA to parse.
+        # So instead, we dump the command in a tempfile, and tell casa to
+        # exec it. Oh, the perversity!
+        with tempfile.NamedTemporaryFile(mode='w', delete=False) as tmpfile:
+            tmpfile_path = tmpfile.name
+            tmpfile.write(source + '\n')
+        return "execfile('{}')".format(tmpfile_path), tmpfile_path
+
+    def _prepare_script_file(self, path_to_scriptfile, command_pre_logged):
+        """
+        Log the command which runs a script file, and load any subroutines
+        the script needs, cf :meth:`run_script_from_file`.
+
+        Returns:
+            The command to execute.
+        """
         exec_cmd = "execfile('{}')".format(os.path.abspath(path_to_scriptfile))
         if not command_pre_logged and self.commands_logfile_handle is not None:
             self.commands_logfile_handle.write(exec_cmd + '\n')
             self.commands_logfile_handle.flush()
-        self.child.sendline(exec_cmd)
-        self.child.expect(self.prompt, timeout=timeout)
-        out_lines = self.child.before.split('\r\n')
-        # Skip the first line: 'execfile(blah)'
-        casa_stdout.extend(out_lines[1:])
-        for line in out_lines:
-            tokens = line.split('\t', 2)
-            if (len(tokens) >= 2) and (tokens[1] == 'SEVERE'):
-                severe_warnings_raised.append(line)
-            if "Error:" in line:
-                raise ValueError(
-                    "Casapy probably encountered an exception running the "
-                    "script at " + path_to_scriptfile + ": \n"
-                    + "*********\n"
-                    + "\n".join(out_lines)
-                    + "\n*********\n"
-                )
-
-        if severe_warnings_raised and raise_on_severe:
-            error_str = '\n'.join(severe_warnings_raised)
-            raise RuntimeError(
-                "Casapy encountered a 'SEVERE' level problem running the "
-                "script at " + path_to_scriptfile + ": \n"
-                                                    "*********\n" +
-                "\n".join(line) +
-                "\n*********\n" +
-                "Errors are as follows:\n" +
-                error_str)
-        return casa_stdout, severe_warnings_raised
-
-    def load_subroutines(self):
-        for subdef in subroutines.all_subroutines:
-            with tempfile.NamedTemporaryFile(delete=False) as tmpfile:
+        with open(path_to_scriptfile) as f:
+            needed = subroutines.required([f.read()],
+                                          self._loaded_subroutines)
+        if needed:
+            self.load_subroutines(needed)
+        self.command_stats = []
+        return exec_cmd
+
+    def _script_file_result(self, path_to_scriptfile, exec_cmd, out_lines,
+                            status, raise_on_severe):
+        """
+        Check the output of a script file, and record it as completed.
+        """
+        casa_out, errors = _check_output(out_lines, status,
+                                         "script at " + path_to_scriptfile,
+                                         raise_on_severe)
+        if self.crash_recovery:
+            self.session_history.append(exec_cmd)
+        return ScriptResult(casa_out, errors, self.command_stats)
+
+    def _count_completed(self, batch_start, out_lines, raise_on_severe=False):
+        """
+        Count the commands at the start of a batch which completed
+        successfully (e.g. before casapy died, or before a command failed),
+        from the batch markers in the output.
+        """
+        segments, statuses = _split_batch_output(out_lines)
+        n_done = 0
+        while statuses.get(batch_start + n_done) == 'ok':
+            if (raise_on_severe and
+                    _find_severe_lines(segments[batch_start + n_done])):
+                break
+            n_done += 1
+        return n_done
+
+    def _recover(self, batch, batch_start, n_done, timeout):
+        """
+        Respawn casapy after it died part-way through a batch, and replay
+        the session history.
+
+        Args:
+            batch: The commands which were being run.
+            batch_start: Index of the first command in the batch.
+            n_done: Number of commands in the batch which had completed
+                (and have already been added to the session history).
+            timeout: Timeout for the replay, as for :meth:`run_script`.
+
+        Returns:
+            Tuple ``(batch_start, batch)`` for the remaining commands.
+        """
+        logger.warning("Casapy died while running command %s: %s",
+                       batch_start + n_done, batch[n_done])
+        logger.warning("Last casapy output:\n%s", self.child.before)
+        loaded = set(self._loaded_subroutines)
+        self._respawn()
+        missing = loaded - self._loaded_subroutines
+        if missing:
+            self.load_subroutines(sorted(missing))
+        replay_filter = self.replay_filter or _replay_by_default
+        replay = [cmd for cmd in self.session_history if replay_filter(cmd)]
+        if replay:
+            logger.warning("Replaying %s commands to restore session state",
+                           len(replay))
+            source, tmpfile_path = self._prepare_source(
+                replay, 0, len(replay), log_commands=False)
+            try:
+                out_lines, status = self._execute(source, timeout)
+            finally:
+                if tmpfile_path is not None:
+                    os.remove(tmpfile_path)
+            try:
+                _check_batch_output(replay, 0, out_lines,
+                                    raise_on_severe=False)
+            except ValueError as e:
+                raise RuntimeError(
+                    "Could not restore casapy session after respawn: " +
+                    str(e))
+        return batch_start + n_done, batch[n_done:]
+
+    def _respawn(self):
+        """
+        Discard the (dead) casapy child and spawn a new one.
+        """
+        if self.channel is not None:
+            try:
+                self.channel.close(timeout=10)
+            except Exception as e:
+                logger.warning("Error closing casapy command channel: %s", e)
+            self.channel = None
+        self.child.close(force=True)
+        self._spawn()
+
+    def _start_monitor(self):
+        if not self.instrument:
+            return None
+        return CommandMonitor(self.child.pid).start()
+
+    def _stop_monitor(self, monitor, batch_start, batch):
+        """
+        Record stats for a command (or batch), see :meth:`_start_monitor`.
+        """
+        if monitor is None:
+            return
+        stats = monitor.stop(batch_start, '\n'.join(batch))
+        self.command_stats.append(stats)
+        if self.stats_logfile_handle is not None:
+            self.stats_logfile_handle.write(json.dumps(stats.as_dict()) + '\n')
+            self.stats_logfile_handle.flush()
+
+    def _check_script_output(self, batch, batch_start, batch_size, out_lines,
+                             status, raise_on_severe):
+        if batch_size is None:
+            return _check_output(out_lines, status, "command " + batch[0],
+                                 raise_on_severe)
+        return _check_batch_output(batch, batch_start, out_lines,
+                                   raise_on_severe)
+
+    def _execute(self, source, timeout):
+        """
+        Send a single line of source to casapy and wait for it to complete.
+
+        Returns:
+            Tuple ``(out_lines, status)``, where ``status`` is 'ok', 'error'
+            or 'interrupted' if known (i.e. once the ``drivecasa_run``
+            subroutine has been loaded), else ``None``.
+        """
+        pattern = self._begin_execute(source)
+        self.child.expect(pattern, timeout=timeout,
+                          searchwindowsize=self._search_window())
+        return self._finish_execute()
+
+    def _begin_execute(self, source):
+        """
+        Send ``source`` to casapy.
+
+        Rather than waiting for the next casapy prompt (which means
+        repeatedly searching the accumulated output, and may be matched by
+        the output itself), the command is run via the ``drivecasa_run``
+        subroutine, which prints a sentinel line bearing the command's
+        sequence number and completion status once it is done.
+
+        Returns:
+            The pattern to expect once execution has completed. Pass
+            ``searchwindowsize=self._search_window()`` when expecting it.
+        """
+        if self.channel is not None:
+            return self.channel.send(source)
+        if 'drivecasa_run' not in self._loaded_subroutines:
+            # Still loading the subroutines, at start-up.
+            self.child.sendline(source)
+            return self.prompt
+        self._seq += 1
+        self._pending = _sentinel.format(self._seq)
+        self.child.sendline("drivecasa_run({}, {!r})".format(self._seq,
+                                                             source))
+        return self._pending
+
+    def _search_window(self):
+        """
+        Returns the ``searchwindowsize`` to use when expecting the pattern
+        returned by :meth:`_begin_execute` or :meth:`_interrupt`: bounded
+        for sentinels, else ``None`` (search all output).
+        """
+        if self._pending is not None:
+            return _sentinel_window
+        if self.channel is not None and self.channel.pending is not None:
+            return _sentinel_window
+        return None
+
+    def _finish_execute(self):
+        """
+        Collect the output once the pattern returned by
+        :meth:`_begin_execute` has been matched.
+        """
+        out_lines, status, prompt_follows = self._collect_output()
+        if prompt_follows:
+            self.child.expect(self.prompt)
+            out_lines.extend(self._trailing_output())
+        return out_lines, status
+
+    def _collect_output(self):
+        """
+        Collect the output matched so far, see :meth:`_finish_execute`.
+
+        Returns:
+            Tuple ``(out_lines, status, prompt_follows)``. If
+            ``prompt_follows``, the caller must wait for the casapy prompt
+            which follows the sentinel, then add the
+            :meth:`_trailing_output`.
+        """
+        if self.channel is not None:
+            out_lines, status, _ = self.channel.receive()
+            return out_lines, status, False
+        out_lines = self.child.before.split(self.child.crlf)
+        if self.engine == 'pty':
+            # Skip the first line: the echoed command, e.g. 'execfile(blah)'
+            out_lines = out_lines[1:]
+        if self._pending is None:
+            return out_lines, None, False
+        status = self.child.match.group(1)
+        self._pending = None
+        return out_lines, status, True
+
+    def _trailing_output(self):
+        """
+        Output printed between the sentinel and the prompt which follows it.
+        """
+        return self.child.before.split(self.child.crlf)[1:-1]
+
+    def _interrupt(self):
+        """
+        Send an interrupt to casapy.
+
+        Returns:
+            The pattern to expect once casapy has responded, or ``None`` if
+            no response is expected.
+        """
+        if self.channel is not None:
+            if self.channel.pending is None:
+                # Interrupting the idle serving-loop would close the channel.
+                return None
+            self.child.sendintr()
+            return self.channel.pending
+        self.child.sendintr()
+        if self._pending is not None:
+            return self._pending
+        return self.prompt
+
+    def evaluate(self, expr, timeout=-1):
+        """
+        Evaluate a Python expression in casapy, and return its value.
+
+        Rather than printing the value and parsing the terminal output,
+        the value is saved by casapy to a side file and loaded back: arrays
+        in NumPy ``.npy`` format, anything else as JSON. So e.g. ::
+
+            stats = casa.evaluate("imstat('obs.clean.image')")
+
+        returns the statistics dictionary, with array entries as NumPy arrays.
+
+        Args:
+            expr (str): A single Python expression.
+            timeout: As for :meth:`run_script`.
+
+        Unlike :meth:`run_script`, the query is not recorded in the
+        ``session_history``, ``command_stats`` or commands logfile.
+
+        Returns:
+            The value of ``expr``: a NumPy array, or a JSON-compatible value
+            (scalar, string, list or dict, with any nested NumPy arrays
+            restored). Tuples are returned as lists. Strings are returned as
+            bytestrings on Python 2, as for :func:`drivecasa.utils.byteify`.
+            Complex values are only supported as (top-level) arrays.
+
+        Raises:
+            ValueError: If ``expr`` raises an exception in casapy, or its
+                value cannot be serialised.
+        """
+        fd, base_path = tempfile.mkstemp(prefix='drivecasa-value-')
+        os.close(fd)
+        try:
+            self._query(
+                "drivecasa_save_value(({}), '{}')".format(expr, base_path),
+                timeout)
+            if os.path.exists(base_path + '.npy'):
+                return np.load(base_path + '.npy')
+            with open(base_path + '.json') as f:
+                return drivecasa.utils.byteify(
+                    json.load(f, object_hook=_decode_json_array))
+        finally:
+            for path in (base_path, base_path + '.npy', base_path + '.json'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _query(self, command, timeout):
+        """
+        Run a single command on behalf of drive-casa itself (e.g. to fetch
+        a value), bypassing the script bookkeeping: the command is not
+        logged, and leaves the ``session_history``, ``command_stats``,
+        checkpoint and result cache untouched.
+
+        Raises:
+            ValueError: If the command raises an exception in casapy.
+            RuntimeError: If casapy reports a 'SEVERE' level problem.
+        """
+        source, tmpfile_path = self._prepare_source([command], 0, None,
+                                                    log_commands=False)
+        try:
+            out_lines, status = self._execute(source, timeout)
+        finally:
+            if tmpfile_path is not None:
+                os.remove(tmpfile_path)
+        _check_output(out_lines, status, "command: " + command,
+                      raise_on_severe=True)
+
+    def image_pixels(self, image_path, blc=None, trc=None, out_path=None,
+                     timeout=-1):
+        """
+        Get the pixel values of (a region of) a casapy image, as a
+        memory-mapped array.
+
+        Casapy copies the pixels (via the image tool) straight into a NumPy
+        ``.npy`` file, which is then memory-mapped rather than read, so only
+        the parts of the array actually accessed are loaded. This avoids
+        exporting to FITS and re-reading, and allows slicing cubes too large
+        to load whole.
+
+        Args:
+            image_path (str): Path to the casapy image.
+            blc, trc: Bottom-left and top-right corners (inclusive) of the
+                region to fetch, as lists of pixel indices. Trailing axes
+                not given (or ``None``) default to the whole axis.
+            out_path (str): Path to write the ``.npy`` file to. Defaults to a
+                temporary file in the casapy working directory, which is
+                unlinked as soon as it has been mapped (the mapped data
+                remain accessible until the array is released).
+            timeout: As for :meth:`run_script`.
+
+        As for :meth:`evaluate`, the dump command is not recorded in the
+        ``session_history``, ``command_stats`` or commands logfile.
+
+        Returns:
+            numpy.memmap: The pixel values, read-only, with axes in the
+            image's order (e.g. RA, Dec, Stokes, frequency). Degenerate axes
+            are not dropped.
+        """
+        image_path = os.path.abspath(image_path)
+        remove = out_path is None
+        if out_path is None:
+            working_dir = self._spawn_args[2]
+            fd, out_path = tempfile.mkstemp(prefix='drivecasa-pixels-',
+                                            suffix='.npy', dir=working_dir)
+            os.close(fd)
+        out_path = os.path.abspath(out_path)
+        try:
+            self._query("drivecasa_dump_pixels('{}', '{}', {}, {})".format(
+                image_path, out_path, blc, trc), timeout)
+            return np.load(out_path, mmap_mode='r')
+        finally:
+            if remove:
+                os.remove(out_path)
+
+    def reset_session(self):
+        """
+        Return the casapy session to a clean state, ready for re-use.
+
+        Closes any open simulator / componentlist / image (etc.) tools and
+        deletes the ``_dc_``-prefixed variables pushed into the casapy
+        namespace by the :mod:`drivecasa.commands` helpers, and waits for
+        any outputs staged on scratch (see :mod:`drivecasa.staging`) to be
+        moved back. Any other user-defined variables are left untouched.
+        """
+        self.run_script(['drivecasa_reset_session()'], raise_on_severe=False)
+        self.session_history = []
+
+    def isalive(self):
+        """Returns ``True`` if the casapy child process is still running."""
+        return self.child is not None and self.child.isalive()
+
+    def close(self):
+        """
+        Terminate the casapy process and close the commands logfile (if any).
+        """
+        if self.channel is not None:
+            try:
+                self.channel.close(timeout=10)
+            except Exception as e:
+                logger.warning("Error closing casapy command channel: %s", e)
+            self.channel = None
+        if self.child is not None:
+            if self.child.isalive():
+                self.child.terminate(force=True)
+            # Release the pty / pipes (and reader threads).
+            self.child.close(force=True)
+        if self.commands_logfile_handle is not None:
+            self.commands_logfile_handle.close()
+            self.commands_logfile_handle = None
+        if self.stats_logfile_handle is not None:
+            self.stats_logfile_handle.close()
+            self.stats_logfile_handle = None
+
+    def load_subroutines(self, names=None):
+        """
+        Load subroutines into the casapy session, in a single round-trip.
+
+        This is not usually required, since subroutines are loaded on demand
+        (see :mod:`drivecasa.commands.subroutines`).
+
+        Args:
+            names: Names of the subroutines to load. If ``None``, load
+                every subroutine in the registry.
+        """
+        if names is None:
+            names = list(subroutines.registry)
+        source = subroutines.bundle(names)
+        tmpfile_path = None
+        if self.channel is not None:
+            exec_cmd = source
+        else:
+            with tempfile.NamedTemporaryFile(mode='w', delete=False) as tmpfile:
                 tmpfile_path = tmpfile.name
-                tmpfile.write(subdef + '\n')
-            self.run_script_from_file(tmpfile_path, command_pre_logged=True)
+                tmpfile.write(source)
+            exec_cmd = "execfile('{}')".format(tmpfile_path)
+        try:
+            out_lines, status = self._execute(exec_cmd, -1)
+        finally:
+            if tmpfile_path is not None:
+                os.remove(tmpfile_path)
+        _check_output(out_lines, status, "subroutine definitions",
+                      raise_on_severe=True)
+        self._loaded_subroutines.update(names)
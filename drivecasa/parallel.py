@@ -0,0 +1,263 @@
+"""
+Drivers which split a single large job into parts, run them in parallel on
+a :class:`.CasapyPool`, and recombine the results.
+"""
+import logging
+import os
+import zlib
+
+import astropy.units as u
+
+from drivecasa.commands import simulation as sim
+from drivecasa.commands.reduction import clean, concat, image_concat
+from drivecasa.scheduler import TaskGraph
+from drivecasa.utils import remove_tree
+
+logger = logging.getLogger(__name__)
+
+# Maps which clean always produces, so can be recombined.
+_combined_maps = ('image', 'model', 'residual', 'psf')
+
+
+def split_range(start, count, n_chunks):
+    """
+    Split the range ``[start, start + count)`` into (at most) ``n_chunks``
+    contiguous chunks of near-equal size.
+
+    Returns:
+        List of tuples ``(chunk_start, chunk_count)``.
+    """
+    n_chunks = max(1, min(n_chunks, count))
+    chunks = []
+    for i in range(n_chunks):
+        chunk_start = start + (count * i) // n_chunks
+        chunk_end = start + (count * (i + 1)) // n_chunks
+        chunks.append((chunk_start, chunk_end - chunk_start))
+    return chunks
+
+
+def parallel_clean(pool,
+                   vis_paths,
+                   niter,
+                   threshold_in_jy,
+                   nchan,
+                   start=0,
+                   n_chunks=None,
+                   mask='',
+                   modelimage='',
+                   other_clean_args=None,
+                   out_dir=None,
+                   out_path=None,
+                   overwrite=False,
+                   keep_chunks=False,
+                   raise_on_severe=True,
+                   timeout=-1,
+                   ):
+    """
+    Produce a spectral cube by cleaning ranges of channels in parallel.
+
+    The channel range is split into chunks, each cleaned (as a
+    ``mode='channel'`` cube) on a separate session from ``pool``, then the
+    per-chunk maps are concatenated along the spectral axis (see
+    :func:`.image_concat`). Channels are imaged independently by clean, so
+    the result matches a single clean over the whole range, while the run
+    time scales down with the number of sessions available.
+
+    Arguments are as for :func:`.commands.clean`, plus:
+
+    Args:
+        pool (:class:`.CasapyPool`): Sessions to run the chunks on.
+        nchan (int): Number of channels in the output cube.
+        start (int): First channel to image.
+        n_chunks (int): Number of chunks to split the channel range into.
+            Defaults to the pool size.
+        keep_chunks (bool): Keep the per-chunk maps, rather than deleting
+            them once combined. They are named after the output maps, with a
+            ``.chunkNNN`` suffix inserted before the map type.
+        raise_on_severe, timeout: As for :meth:`.Casapy.run_script`.
+
+    The ``mode``, ``start``, ``nchan`` and ``width`` clean arguments are set
+    for each chunk, so should not be passed in ``other_clean_args``.
+
+    Returns:
+        :class:`.CleanMaps`: Paths of the combined maps. Only the image,
+        model, residual and psf maps are combined, so the ``mask`` and
+        ``flux`` fields are ``None``.
+    """
+    if n_chunks is None:
+        n_chunks = pool.size
+    if other_clean_args is None:
+        other_clean_args = {}
+
+    # Derive the output paths exactly as for a regular clean.
+    combined = clean([], vis_paths, niter, threshold_in_jy, mask=mask,
+                     modelimage=modelimage, other_clean_args=other_clean_args,
+                     out_dir=out_dir, out_path=out_path, overwrite=overwrite)
+    basename = combined.image[:-len('.image')]
+
+    graph = TaskGraph()
+    chunk_maps = []
+    for index, (chunk_start, chunk_nchan) in enumerate(
+            split_range(start, nchan, n_chunks)):
+        chunk_args = other_clean_args.copy()
+        chunk_args.update({'mode': 'channel',
+                           'start': chunk_start,
+                           'nchan': chunk_nchan,
+                           'width': 1})
+        script = []
+        # Always overwrite, since clean would otherwise continue from any
+        # existing model left over from a previous run.
+        maps = clean(script, vis_paths, niter, threshold_in_jy, mask=mask,
+                     modelimage=modelimage, other_clean_args=chunk_args,
+                     out_path='{}.chunk{:03d}'.format(basename, index),
+                     overwrite=True)
+        graph.add(script, name='clean chunk {}'.format(index))
+        chunk_maps.append(maps)
+
+    script = []
+    for map_type in _combined_maps:
+        image_concat(script,
+                     [getattr(maps, map_type) for maps in chunk_maps],
+                     getattr(combined, map_type), overwrite=overwrite)
+    graph.add(script, name='combine chunks')
+
+    logger.debug("Cleaning %s channels in %s chunks", nchan, len(chunk_maps))
+    graph.run(pool, raise_on_severe=raise_on_severe, timeout=timeout)
+
+    if not keep_chunks:
+        for maps in chunk_maps:
+            for path in maps:
+                if os.path.isdir(path):
+                    remove_tree(path)
+    return combined._replace(mask=None, flux=None)
+
+
+def shard_seed(seed, index):
+    """
+    Derive the noise seed for shard ``index`` of a simulation from ``seed``.
+
+    The result depends only on the arguments (not on the Python version or
+    which session runs the shard), so a simulation can be reproduced exactly,
+    while each shard gets an unrelated random-number sequence.
+
+    Returns:
+        int: A seed in the range ``[0, 2**31)``.
+    """
+    key = '{}:{}'.format(seed, index).encode('ascii')
+    return zlib.crc32(key) & 0x7fffffff
+
+
+def parallel_simulate(pool,
+                      output_ms_path,
+                      configure,
+                      integration_time,
+                      stop_delay,
+                      start_delay=0 * u.s,
+                      n_shards=None,
+                      component_list_path=None,
+                      noise_std_dev=None,
+                      seed=0,
+                      overwrite=True,
+                      keep_shards=False,
+                      raise_on_severe=True,
+                      timeout=-1,
+                      ):
+    """
+    Simulate an observation by splitting its time-range into shards.
+
+    Each shard is simulated into a MeasurementSet of its own on a separate
+    session from ``pool``, then the shards are concatenated (see
+    :func:`.commands.concat`). Each shard script runs::
+
+        open_sim -> configure -> observe -> [predict] ->
+            [setseed -> set_simplenoise -> corrupt] -> close_sim
+
+    where ``configure`` supplies the telescope setup, i.e. the calls to
+    :func:`.setconfig`, :func:`.setspwindow`, :func:`.setfield`,
+    :func:`.settimes` etc. which would precede :func:`.observe` in a serial
+    script. Shard boundaries fall on whole integrations, counted from
+    ``start_delay``.
+
+    Noise for each shard is seeded with :func:`shard_seed`, so repeat runs
+    (with the same ``seed`` and ``n_shards``) give identical visibilities.
+
+    Args:
+        pool (:class:`.CasapyPool`): Sessions to run the shards on.
+        output_ms_path (str): Path of the combined MeasurementSet.
+        configure: Function called as ``configure(script)`` to append the
+            simulator configuration commands to each shard script.
+        integration_time (astropy.units.Quantity): As passed to
+            :func:`.settimes`.
+        stop_delay, start_delay (astropy.units.Quantity): Time-range of the
+            whole observation, as for :func:`.observe`.
+        n_shards (int): Number of shards. Defaults to the pool size.
+        component_list_path (str): If given, predict visibilities from this
+            component list (see :func:`.predict`).
+        noise_std_dev (astropy.units.Quantity): If given, add simple noise of
+            this standard deviation (see :func:`.set_simplenoise`).
+        seed (int): Base noise seed.
+        overwrite (bool): Delete any pre-existing output MeasurementSet.
+            Otherwise a ``ValueError`` is raised if it exists (before any
+            shards are simulated), since concat would append to it.
+        keep_shards (bool): Keep the per-shard MeasurementSets, rather than
+            deleting them once combined. They are named after the output,
+            with a ``.shardNNN`` suffix inserted before the ``.ms`` extension.
+        raise_on_severe, timeout: As for :meth:`.Casapy.run_script`.
+
+    Returns (str):
+        Absolute path to the combined MeasurementSet.
+    """
+    if n_shards is None:
+        n_shards = pool.size
+    output_ms_path = os.path.abspath(output_ms_path)
+    if os.path.exists(output_ms_path):
+        if not overwrite:
+            raise ValueError("Output MeasurementSet already exists (and "
+                             "overwrite=False): " + output_ms_path)
+        remove_tree(output_ms_path)
+    basename = output_ms_path
+    if basename.endswith('.ms'):
+        basename = basename[:-len('.ms')]
+
+    integration_s = integration_time.to(u.s).value
+    start_s = start_delay.to(u.s).value
+    n_integrations = int(round(
+        (stop_delay.to(u.s).value - start_s) / integration_s))
+    if n_integrations < 1:
+        raise ValueError("Observation is shorter than one integration")
+
+    graph = TaskGraph()
+    shard_paths = []
+    for index, (first, count) in enumerate(
+            split_range(0, n_integrations, n_shards)):
+        shard_path = '{}.shard{:03d}.ms'.format(basename, index)
+        script = []
+        sim.open_sim(script, shard_path, overwrite=True)
+        configure(script)
+        sim.observe(script,
+                    start_delay=(start_s + first * integration_s) * u.s,
+                    stop_delay=(start_s + (first + count) * integration_s) * u.s)
+        if component_list_path is not None:
+            sim.predict(script, os.path.abspath(component_list_path))
+        if noise_std_dev is not None:
+            sim.setseed(script, shard_seed(seed, index))
+            sim.set_simplenoise(script, noise_std_dev)
+            sim.corrupt(script)
+        sim.close_sim(script)
+        graph.add(script, outputs=[shard_path],
+                  name='simulate shard {}'.format(index))
+        shard_paths.append(shard_path)
+
+    script = []
+    concat(script, shard_paths, out_path=output_ms_path)
+    graph.add(script, name='combine shards')
+
+    logger.debug("Simulating %s integrations in %s shards",
+                 n_integrations, len(shard_paths))
+    graph.run(pool, raise_on_severe=raise_on_severe, timeout=timeout)
+
+    if not keep_shards:
+        for path in shard_paths:
+            if os.path.isdir(path):
+                remove_tree(path)
+    return output_ms_path
@@ -0,0 +1,274 @@
+"""
+A pool of pre-spawned casapy sessions.
+
+Spawning casapy is slow (typically tens of seconds), so when running many
+short jobs it pays to keep a few sessions 'warm' and hand them out as needed.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+import pexpect
+
+from drivecasa.interface import Casapy
+
+logger = logging.getLogger(__name__)
+
+
+class _SpawnFailure(object):
+    """
+    Placed in the idle queue in place of a session which could not be
+    respawned, so that :meth:`CasapyPool.checkout` raises rather than
+    waiting for it.
+    """
+
+    def __init__(self, slot, error):
+        self.slot = slot
+        self.error = error
+
+
+class CasapyPool(object):
+    """
+    Manages a fixed-size pool of :class:`.Casapy` sessions.
+
+    Sessions are spawned when the pool is created, then handed out via
+    :meth:`session` (or :meth:`checkout` / :meth:`checkin`). When a session
+    is returned it is reset (see :meth:`.Casapy.reset_session`) so the next
+    user starts from a clean slate. Sessions which have died, or which were
+    left mid-command by a timeout, are discarded and replaced by a fresh
+    session spawned in a background thread.
+
+    Usage::
+
+        with drivecasa.CasapyPool(4) as pool:
+            with pool.session() as casa:
+                casa.run_script(script)
+
+    .. note::
+
+        Each session is run from its own subdirectory of ``working_dir``,
+        and any ``casa_logfile`` / ``commands_logfile`` paths are suffixed
+        with the session slot and spawn-count, so sessions do not clobber
+        each other's files.
+    """
+    #: Number of attempts at respawning a discarded session.
+    respawn_attempts = 3
+    #: Delay before re-attempting a failed respawn, in seconds (doubled
+    #: after each further failure).
+    respawn_delay = 5.0
+
+    def __init__(self, size, working_dir='/tmp/drivecasa', **casapy_kwargs):
+        """
+        Spawn ``size`` casapy sessions.
+
+        Args:
+            size (int): Number of casapy sessions to keep available.
+            working_dir (str): Top-level working directory, sessions are run
+                from subdirectories of this.
+            casapy_kwargs: Any further keyword-arguments are passed through
+                to the :class:`.Casapy` constructor.
+        """
+        if size < 1:
+            raise ValueError("Pool size must be at least 1.")
+        self.size = size
+        self.working_dir = working_dir
+        self._casapy_kwargs = casapy_kwargs
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._spawn_counts = [0] * size
+        self._slots = {}
+        self._closed = False
+
+        spawn_errors = []
+        threads = [threading.Thread(target=self._spawn,
+                                    args=(slot, spawn_errors))
+                   for slot in range(size)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if spawn_errors:
+            self.close()
+            raise RuntimeError(
+                "Could not spawn casapy pool, {} of {} sessions failed to "
+                "start".format(len(spawn_errors), size))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _session_kwargs(self, slot, spawn_count):
+        kwargs = self._casapy_kwargs.copy()
+        suffix = '-{}.{}'.format(slot, spawn_count)
+        kwargs['working_dir'] = os.path.join(self.working_dir,
+                                             'session' + suffix)
+        for logfile_key in ('casa_logfile', 'commands_logfile',
+                            'stats_logfile'):
+            path = kwargs.get(logfile_key)
+            if path:
+                base, ext = os.path.splitext(path)
+                kwargs[logfile_key] = base + suffix + ext
+        return kwargs
+
+    def _spawn(self, slot, errors=None):
+        with self._lock:
+            self._spawn_counts[slot] += 1
+            spawn_count = self._spawn_counts[slot]
+        try:
+            casa = Casapy(**self._session_kwargs(slot, spawn_count))
+        except Exception as e:
+            logger.error("Failed to spawn casapy for pool slot %s: %s",
+                         slot, e)
+            if errors is not None:
+                errors.append(e)
+            return
+        with self._lock:
+            if self._closed:
+                casa.close()
+                return
+            self._slots[id(casa)] = slot
+        self._idle.put(casa)
+
+    def _respawn(self, slot):
+        """
+        Respawn the session for a slot, retrying with backoff. If every
+        attempt fails, the failure is queued to be raised by
+        :meth:`checkout`.
+        """
+        delay = self.respawn_delay
+        for attempt in range(self.respawn_attempts):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+            if self._closed:
+                return
+            errors = []
+            self._spawn(slot, errors)
+            if not errors:
+                return
+        self._idle.put(_SpawnFailure(slot, errors[-1]))
+
+    def _respawn_in_background(self, slot):
+        logger.debug("Respawning casapy for pool slot %s", slot)
+        t = threading.Thread(target=self._respawn, args=(slot,))
+        t.daemon = True
+        t.start()
+
+    def checkout(self, timeout=None):
+        """
+        Take a session from the pool.
+
+        Blocks until a session is available. The session should be handed
+        back with :meth:`checkin` once finished with; :meth:`session` takes
+        care of this automatically.
+
+        If a discarded session could not be respawned (after retrying), a
+        ``RuntimeError`` is raised in place of handing out that session, and
+        another respawn is started in the background.
+
+        Args:
+            timeout: Maximum time to wait for a session, in seconds.
+                ``None`` implies wait indefinitely.
+
+        Returns:
+            :class:`.Casapy` instance.
+        """
+        if self._closed:
+            raise RuntimeError("CasapyPool has been closed.")
+        try:
+            casa = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise RuntimeError(
+                "Timed out waiting for a free casapy session.")
+        if isinstance(casa, _SpawnFailure):
+            self._respawn_in_background(casa.slot)
+            raise RuntimeError(
+                "Could not respawn casapy for pool slot {}: {}".format(
+                    casa.slot, casa.error))
+        return casa
+
+    def checkin(self, casa, discard=False):
+        """
+        Return a session to the pool.
+
+        The session is reset before being made available again. If it has
+        died, fails to reset, or ``discard`` is set, it is terminated and a
+        replacement is spawned in the background.
+
+        Args:
+            casa (:class:`.Casapy`): Session previously obtained from
+                :meth:`checkout`.
+            discard (bool): Throw the session away rather than re-using it.
+        """
+        with self._lock:
+            slot = self._slots.pop(id(casa), None)
+            closed = self._closed
+        if slot is None:
+            raise ValueError(
+                "Session is not checked out from this pool: " + repr(casa))
+        if closed:
+            casa.close()
+            return
+        if not discard and casa.isalive():
+            try:
+                casa.reset_session()
+            except Exception as e:
+                logger.warning("Failed to reset casapy session for pool "
+                               "slot %s: %s", slot, e)
+                discard = True
+        else:
+            discard = True
+
+        if discard:
+            casa.close()
+            self._respawn_in_background(slot)
+        else:
+            with self._lock:
+                self._slots[id(casa)] = slot
+            self._idle.put(casa)
+
+    @contextmanager
+    def session(self, timeout=None):
+        """
+        Context manager which checks out a session, and returns it on exit.
+
+        If the block exits due to a pexpect timeout or EOF, the session is
+        in an unknown state and is replaced rather than re-used.
+
+        Args:
+            timeout: Maximum time to wait for a free session, in seconds.
+        """
+        casa = self.checkout(timeout=timeout)
+        discard = False
+        try:
+            yield casa
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            discard = True
+            raise
+        finally:
+            self.checkin(casa, discard=discard)
+
+    def close(self):
+        """
+        Terminate all idle sessions.
+
+        Sessions currently checked out are terminated when checked back in.
+        """
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                casa = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if not isinstance(casa, _SpawnFailure):
+                casa.close()
@@ -0,0 +1,231 @@
+"""
+Run independent parts of a pipeline in parallel, across a pool of sessions.
+
+The data-reduction helpers (see :mod:`drivecasa.commands.reduction`) append
+:class:`.CachedStep` commands, which record the paths each step reads and
+writes. A :class:`TaskGraph` uses these to infer which steps depend on which,
+then runs steps as soon as their dependencies have completed, each on
+whichever :class:`.CasapyPool` session is free, e.g.::
+
+    graph = TaskGraph()
+    for fits_path in fits_paths:
+        script = []
+        ms = import_uvfits(script, fits_path, out_dir=ms_dir)
+        graph.add(script)
+        script = []
+        clean(script, ms, niter=500, threshold_in_jy=1e-3, out_dir=img_dir)
+        graph.add(script)
+    with drivecasa.CasapyPool(4) as pool:
+        graph.run(pool)
+
+Each import is independent, so up to four run at once; each clean waits only
+for the import of its own input.
+"""
+import logging
+import os
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class Task(object):
+    """
+    A group of commands, run in sequence in a single casapy session.
+
+    Attributes:
+        commands (list): The casapy script.
+        inputs (tuple): Absolute paths read by the commands.
+        outputs (tuple): Absolute paths written by the commands.
+        name (str): Used in log messages.
+        barrier (bool): See :meth:`TaskGraph.add`.
+        dependencies (set): Tasks which must complete before this one starts.
+        result: The :class:`.ScriptResult` from running the task, once it
+            has completed.
+    """
+
+    def __init__(self, commands, inputs=(), outputs=(), name=None,
+                 barrier=False):
+        self.commands = list(commands)
+        self.inputs = tuple(os.path.abspath(p) for p in inputs)
+        self.outputs = tuple(os.path.abspath(p) for p in outputs)
+        self.name = name if name is not None else _describe(self.commands)
+        self.barrier = barrier
+        self.dependencies = set()
+        self.result = None
+
+    def __repr__(self):
+        return '<Task {}>'.format(self.name)
+
+
+class TaskGraph(object):
+    """
+    A pipeline of tasks, with dependencies inferred from their paths.
+
+    A task depends on an earlier task if it reads a path the earlier task
+    writes, or writes a path the earlier task reads or writes (a path
+    'overlaps' another if they are the same, or one is inside the other).
+    Tasks are only ever made to depend on tasks added before them, so
+    the graph is always acyclic and running tasks in the order added would
+    give the same results as running them in parallel.
+    """
+
+    def __init__(self):
+        self.tasks = []
+
+    @classmethod
+    def from_script(cls, script):
+        """
+        Split a single script into tasks.
+
+        Each :class:`.CachedStep` command becomes a task of its own. Plain
+        command strings have no recorded paths, so must be assumed to depend
+        on everything before them (and vice-versa); consecutive plain
+        commands are grouped into one task.
+        """
+        graph = cls()
+        plain = []
+        for cmd in script:
+            if hasattr(cmd, 'outputs'):
+                if plain:
+                    graph.add(plain, barrier=True)
+                    plain = []
+                graph.add([cmd])
+            else:
+                plain.append(cmd)
+        if plain:
+            graph.add(plain, barrier=True)
+        return graph
+
+    def add(self, commands, inputs=(), outputs=(), name=None,
+            barrier=False):
+        """
+        Add a task to the graph.
+
+        Args:
+            commands (list): Script to run, in a single session.
+                The inputs and outputs of any :class:`.CachedStep` commands
+                are included in those of the task.
+            inputs: Any further paths read by the commands.
+            outputs: Any further paths written by the commands.
+            name (str): Used in log messages. Defaults to (part of) the
+                first command.
+            barrier (bool): Make this task depend on all previous tasks,
+                and all subsequent tasks depend on it.
+
+        Returns:
+            The new :class:`Task`.
+        """
+        inputs = list(inputs)
+        outputs = list(outputs)
+        for cmd in commands:
+            inputs.extend(getattr(cmd, 'inputs', ()))
+            outputs.extend(getattr(cmd, 'outputs', ()))
+        task = Task(commands, inputs, outputs, name, barrier)
+        for earlier in self.tasks:
+            if barrier or earlier.barrier or _depends(task, earlier):
+                task.dependencies.add(earlier)
+        self.tasks.append(task)
+        return task
+
+    def run(self, pool, raise_on_severe=True, timeout=-1, batch_size=None):
+        """
+        Run all tasks, in parallel where possible.
+
+        Each task is run on a session checked out from ``pool`` (so is
+        started with a freshly reset session). If a task fails, no further
+        tasks are started; once those already running have finished, the
+        first exception is re-raised.
+
+        Args:
+            pool (:class:`.CasapyPool`): Sessions to run tasks on.
+                One task is run at a time per session.
+            raise_on_severe, timeout, batch_size: As for
+                :meth:`.Casapy.run_script`.
+
+        Returns:
+            List of :class:`.ScriptResult`, one per task in the order added.
+        """
+        waiting_on = dict((task, set(task.dependencies))
+                          for task in self.tasks)
+        dependents = dict((task, []) for task in self.tasks)
+        for task in self.tasks:
+            for dependency in task.dependencies:
+                dependents[dependency].append(task)
+        ready = deque(task for task in self.tasks if not task.dependencies)
+        state = {'running': 0}
+        failures = []
+        cond = threading.Condition()
+
+        def worker():
+            while True:
+                with cond:
+                    while not ready and state['running'] and not failures:
+                        cond.wait()
+                    if failures or not ready:
+                        return
+                    task = ready.popleft()
+                    state['running'] += 1
+                logger.debug("Starting task %s", task.name)
+                try:
+                    with pool.session() as casa:
+                        task.result = casa.run_script(
+                            task.commands, raise_on_severe=raise_on_severe,
+                            timeout=timeout, batch_size=batch_size)
+                except Exception as e:
+                    logger.error("Task %s failed: %s", task.name, e)
+                    with cond:
+                        failures.append(e)
+                        state['running'] -= 1
+                        cond.notify_all()
+                    return
+                with cond:
+                    state['running'] -= 1
+                    for dependent in dependents[task]:
+                        waiting_on[dependent].discard(task)
+                        if not waiting_on[dependent]:
+                            ready.append(dependent)
+                    cond.notify_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(pool.size)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if failures:
+            n_skipped = (len([t for t in self.tasks if t.result is None]) -
+                         len(failures))
+            logger.error("%s tasks not run due to earlier failure.", n_skipped)
+            raise failures[0]
+        return [task.result for task in self.tasks]
+
+
+def _describe(commands):
+    if not commands:
+        return '(empty)'
+    first = str(commands[0]).split('\n')[0]
+    if len(first) > 60:
+        first = first[:57] + '...'
+    return first
+
+
+def _overlaps(path_a, path_b):
+    """
+    True if the paths are the same, or one is inside the other.
+    """
+    if path_a == path_b:
+        return True
+    return (path_a.startswith(path_b.rstrip(os.sep) + os.sep) or
+            path_b.startswith(path_a.rstrip(os.sep) + os.sep))
+
+
+def _depends(task, earlier):
+    for out_path in earlier.outputs:
+        for path in task.inputs + task.outputs:
+            if _overlaps(path, out_path):
+                return True
+    for in_path in earlier.inputs:
+        for path in task.outputs:
+            if _overlaps(path, in_path):
+                return True
+    return False
@@ -0,0 +1,113 @@
+"""
+Stage command inputs on fast local scratch storage.
+
+Tasks such as ``clean`` do heavy random I/O on their input MeasurementSet,
+which is slow if the data live on a network / parallel filesystem. Pass a
+:class:`Staging` to :func:`.commands.clean` or :func:`.commands.mstransform`
+and the command instead runs on copies of its inputs in a local scratch
+directory, writing its outputs there too, e.g.::
+
+    staging = Staging('/scratch/drivecasa')
+    script = []
+    maps = clean(script, '/data/obs.ms', niter=500, threshold_in_jy=1e-3,
+                 staging=staging)
+    staging.wait(script)
+    export_fits(script, maps.image)
+
+Copying happens inside casapy (so on the machine casapy runs on), using
+``cp --reflink=auto`` where available. Inputs are only re-copied if they have
+changed since they were last staged, so repeated commands on the same input
+share a single copy. Outputs are moved back to their usual paths in the
+background once the command completes, so casapy can get on with the next
+command; use :meth:`Staging.wait` before any command which reads them.
+(:meth:`.Casapy.reset_session` also waits, so a :class:`.TaskGraph` run on a
+:class:`.CasapyPool` only starts dependent tasks once the outputs are back.)
+Likewise, staged commands are only recorded in a :class:`.ResultCache` or
+checkpoint file once a wait has completed.
+
+Note that changes made to staged inputs (e.g. model columns written by
+``clean``) are not copied back, and that staged commands always start afresh,
+since any previous outputs are not staged in.
+"""
+import hashlib
+import logging
+import os
+
+from drivecasa.utils import ensure_dir, remove_tree
+
+logger = logging.getLogger(__name__)
+
+#: Command which waits for all staged outputs to be moved back.
+wait_command = "drivecasa_stage('wait')"
+
+
+class Staging(object):
+    """
+    Maps paths to locations in a scratch directory, and generates the
+    commands which copy data to and from them.
+    """
+
+    def __init__(self, scratch_dir):
+        """
+        Args:
+            scratch_dir (str): Local directory to stage data in. Should be
+                on a fast local disk of the machine running casapy.
+        """
+        self.scratch_dir = os.path.abspath(scratch_dir)
+
+    def scratch_path(self, path):
+        """
+        Returns the location of ``path`` in the scratch directory.
+
+        Paths are grouped by a hash of their parent directory, so files of
+        the same name from different directories do not collide.
+        """
+        path = os.path.abspath(path)
+        parent, basename = os.path.split(path)
+        tag = hashlib.sha1(parent.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.scratch_dir, tag, basename)
+
+    def wrap(self, command, inputs, outputs):
+        """
+        Wrap a command (which should already refer to the scratch paths of
+        its inputs and outputs) with the commands to stage them.
+
+        Args:
+            command (str): Command to run on the staged data.
+            inputs (list): Paths read by the command.
+            outputs (list): Paths written by the command. Any which the
+                command does not actually produce are skipped.
+
+        Returns (str):
+            Multi-line command, which stages the inputs in (clearing any
+            stale outputs from scratch), runs ``command``, then starts moving
+            the outputs back.
+        """
+        inputs = [os.path.abspath(p) for p in inputs]
+        outputs = [os.path.abspath(p) for p in outputs]
+        scratch_outputs = [self.scratch_path(p) for p in outputs]
+        for path in scratch_outputs:
+            ensure_dir(os.path.dirname(path))
+        return '\n'.join([
+            "drivecasa_stage('in', {}, {}, clear={})".format(
+                inputs, [self.scratch_path(p) for p in inputs],
+                scratch_outputs),
+            command,
+            "drivecasa_stage('out', {}, {})".format(scratch_outputs, outputs),
+        ])
+
+    def wait(self, script):
+        """
+        Append a command which waits until all outputs have been moved back
+        from scratch (raising if any copy failed).
+        """
+        script.append(wait_command)
+
+    def clear(self):
+        """
+        Delete the scratch directory (including all staged inputs).
+
+        Should only be called when no staged commands are running.
+        """
+        if os.path.isdir(self.scratch_dir):
+            remove_tree(self.scratch_dir)
@@ -0,0 +1,20 @@
+"""
+Tools for testing drive-casa without a CASA installation.
+
+:data:`fake_casa_dir` can be passed as the ``casa_dir`` argument to
+:class:`.Casapy` (or exported as ``CASA_DIR`` before running the unit-tests)
+to drive a lightweight imitation of casapy instead, see
+:mod:`drivecasa.testing.fake_casa`. This is handy for measuring
+drive-casa's own overheads, e.g.::
+
+    casa = drivecasa.Casapy(casa_dir=drivecasa.testing.fake_casa_dir)
+
+The fake is run by the ``python`` in ``$PATH``, unless the
+``FAKE_CASA_PYTHON`` environment variable is set to an alternative
+interpreter.
+"""
+import os
+
+#: Top-level directory of the fake CASA 'installation'.
+fake_casa_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'fakecasa')
@@ -0,0 +1,265 @@
+"""
+A minimal stand-in for the casapy interpreter.
+
+Mimics just enough of casapy's behaviour for the :class:`.Casapy` interface
+to drive it: the ``CASA <N>:`` prompt, ``execfile``, the
+(``--log2term``) log-message format including 'SEVERE' messages, and a
+handful of dummy tasks and tools which create their expected output paths.
+
+Behaviour can be tuned via environment variables:
+
+- ``FAKE_CASA_STARTUP_DELAY``: Seconds to wait before the first prompt.
+- ``FAKE_CASA_DELAY``: Seconds to wait before executing each command.
+
+Commands are executed by whichever Python runs this script (set
+``FAKE_CASA_PYTHON`` to choose, see :mod:`drivecasa.testing`). Real casapy
+(prior to CASA 6) is Python 2, so scripts written for it may need Python 2.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import traceback
+
+
+_banner = 'CASA Version 4.7.0\n  (Fake casapy, for testing drive-casa)'
+
+
+class CasaLog(object):
+    """Mimics the ``casalog`` object, writing CASA-format log lines."""
+
+    def __init__(self, logfile_path=None, log2term=False):
+        self.logfile = None
+        if logfile_path is not None:
+            self.logfile = open(logfile_path, 'a')
+        self.log2term = log2term
+
+    def post(self, message, priority='INFO', origin='fake_casa'):
+        line = '{}\t{}\t{}\t{}'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S'), priority, origin, message)
+        if self.logfile is not None:
+            self.logfile.write(line + '\n')
+            self.logfile.flush()
+        if self.log2term or priority == 'SEVERE':
+            print(line)
+
+
+def _make_dummy_tasks(casalog):
+    """
+    Returns a dict of dummy task functions (and tools), which create their
+    outputs.
+    """
+
+    def create(path, is_dir=True):
+        if is_dir:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(os.path.join(path, 'table.dat'), 'w') as f:
+                f.write('fake\n')
+        else:
+            with open(path, 'w') as f:
+                f.write('fake\n')
+
+    def require(path, task):
+        if not os.path.exists(path):
+            casalog.post('File not found: ' + str(path), 'SEVERE',
+                         task + '::::')
+            return False
+        return True
+
+    def importuvfits(fitsfile, vis, **kwargs):
+        if require(fitsfile, 'importuvfits'):
+            create(vis)
+            casalog.post('Imported ' + fitsfile, origin='importuvfits::::')
+
+    def concat(vis, concatvis, **kwargs):
+        if all(require(v, 'concat') for v in vis):
+            create(concatvis)
+
+    def clean(vis, imagename, niter=0, **kwargs):
+        vis = [vis] if isinstance(vis, str) else vis
+        if all(require(v, 'clean') for v in vis):
+            for ext in ('.image', '.model', '.residual', '.psf', '.flux'):
+                create(imagename + ext)
+            casalog.post('Cleaned {} iterations'.format(niter),
+                         origin='clean::::')
+
+    def exportfits(imagename, fitsimage, overwrite=False, **kwargs):
+        if not require(imagename, 'exportfits'):
+            return
+        if os.path.exists(fitsimage) and not overwrite:
+            casalog.post('Output file exists: ' + fitsimage, 'SEVERE',
+                         'exportfits::::')
+            return
+        create(fitsimage, is_dir=False)
+
+    def mstransform(vis, outputvis, **kwargs):
+        if require(vis, 'mstransform'):
+            create(outputvis)
+
+    class ImageTool(object):
+        """
+        Mimics (a tiny part of) the ``ia`` image tool. Every image is
+        taken to be a ``(8, 8, 1, 4)`` cube, with pixel values
+        ``x + 10 * y + 100 * channel``.
+        """
+
+        shape_ = (8, 8, 1, 4)
+
+        def open(self, infile):
+            return require(infile, 'ia.open')
+
+        def fromshape(self, outfile, shape=None, **kwargs):
+            create(outfile)
+            return True
+
+        def shape(self):
+            return list(self.shape_)
+
+        def getchunk(self, blc=None, trc=None, dropdeg=False, **kwargs):
+            import numpy
+            blc = list(blc or [0, 0, 0, 0])
+            trc = list(trc or [n - 1 for n in self.shape_])
+            x, y, s, c = numpy.ogrid[blc[0]:trc[0] + 1, blc[1]:trc[1] + 1,
+                                     blc[2]:trc[2] + 1, blc[3]:trc[3] + 1]
+            return (x + 10 * y + 0 * s + 100 * c).astype('float32')
+
+        def imageconcat(self, outfile, infiles, axis=-1, relax=False,
+                        overwrite=False, **kwargs):
+            if all(require(f, 'imageconcat') for f in infiles):
+                if os.path.exists(outfile) and not overwrite:
+                    casalog.post('Output image exists: ' + outfile, 'SEVERE',
+                                 'imageconcat::::')
+                else:
+                    create(outfile)
+            return self
+
+        def done(self):
+            return True
+
+        close = done
+
+    class ComponentListTool(object):
+        """Mimics the ``cl`` component-list tool, for point sources."""
+
+        def __init__(self):
+            self.components = []
+
+        def addcomponent(self, **kwargs):
+            self.components.append(kwargs)
+
+        def length(self):
+            return len(self.components)
+
+        def open(self, filename):
+            with open(os.path.join(filename, 'table.dat')) as f:
+                self.components = [None] * int(f.read())
+
+        def rename(self, filename):
+            create(filename)
+            with open(os.path.join(filename, 'table.dat'), 'w') as f:
+                f.write('{}\n'.format(len(self.components)))
+
+        def done(self):
+            self.components = []
+            return True
+
+        close = done
+
+    class SimulatorTool(object):
+        """
+        Mimics the ``sm`` simulator tool: ``sm.close`` creates the
+        MeasurementSet opened with ``sm.open``, other methods do nothing.
+        """
+
+        def __init__(self):
+            self.ms_path = None
+
+        def open(self, ms):
+            self.ms_path = ms
+            return True
+
+        def close(self):
+            if self.ms_path is not None:
+                create(self.ms_path)
+            self.ms_path = None
+            return True
+
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: True
+
+    class MeasuresTool(object):
+        """Mimics the ``me`` measures tool, returning dummy measures."""
+
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: {'type': name, 'args': args}
+
+    def tasklist():
+        print('Available tasks:')
+        print('clean concat exportfits importuvfits mstransform')
+
+    tasks = dict((f.__name__, f) for f in (importuvfits, concat, clean,
+                                           exportfits, mstransform, tasklist))
+    tasks['ia'] = ImageTool()
+    tasks['cl'] = ComponentListTool()
+    tasks['sm'] = SimulatorTool()
+    tasks['me'] = MeasuresTool()
+    return tasks
+
+
+def main(argv):
+    if '--help' in argv:
+        print(_banner)
+        print('Usage: casa [--nologger] [--nogui] [--log2term] '
+              '[--logfile PATH | --nologfile]')
+        return
+    logfile_path = None
+    if '--logfile' in argv:
+        logfile_path = argv[argv.index('--logfile') + 1]
+    elif '--nologfile' not in argv:
+        logfile_path = time.strftime('casapy-%Y%m%d-%H%M%S.log')
+    casalog = CasaLog(logfile_path, log2term='--log2term' in argv)
+    startup_delay = float(os.environ.get('FAKE_CASA_STARTUP_DELAY', 0))
+    delay = float(os.environ.get('FAKE_CASA_DELAY', 0))
+
+    namespace = {'__name__': '__main__', 'casalog': casalog}
+
+    def execfile(path, globs=None):
+        with open(path) as f:
+            code = compile(f.read(), path, 'exec', dont_inherit=True)
+        exec(code, namespace if globs is None else globs)
+
+    namespace['execfile'] = execfile
+    namespace.update(_make_dummy_tasks(casalog))
+
+    time.sleep(startup_delay)
+    print(_banner)
+    n_prompt = 1
+    while True:
+        sys.stdout.write('CASA <{}>: '.format(n_prompt))
+        sys.stdout.flush()
+        try:
+            line = sys.stdin.readline()
+            if not line:
+                break
+            n_prompt += 1
+            if not line.strip():
+                continue
+            time.sleep(delay)
+            exec(compile(line, '<ipython-input>', 'single',
+                         dont_inherit=True), namespace)
+        except KeyboardInterrupt:
+            print('KeyboardInterrupt')
+        except SystemExit:
+            break
+        except Exception:
+            etype, evalue = sys.exc_info()[:2]
+            print('-' * 75)
+            print(''.join(
+                traceback.format_exception_only(etype, evalue)).rstrip())
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
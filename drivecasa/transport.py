@@ -0,0 +1,192 @@
+"""
+Side-channel transport for passing commands to a running casapy session.
+
+By default, each command is written to a tempfile which casapy is then told
+to `execfile` via the terminal. The :class:`FifoChannel` instead streams
+commands to a subroutine running inside casapy via a named pipe, and receives
+a short status frame back via a second pipe.
+
+Terminal output (including the CASA log, if ``log2term`` is set) still
+arrives via the pexpect terminal, so each command is followed by a
+sequence-numbered marker line which tells us where its output ends.
+"""
+import errno
+import fcntl
+import logging
+import os
+import select
+import shutil
+import struct
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Frame header: (sequence number, payload length)
+_header = struct.Struct('>II')
+
+
+class FifoChannel(object):
+    """
+    Command channel to casapy via a pair of named pipes (FIFOs).
+
+    Requires the ``drivecasa_serve_fifo`` subroutine to be loaded in the
+    casapy session (see :mod:`drivecasa.commands.subroutines`). While the
+    channel is open, casapy is busy running the serving loop, so the
+    casapy prompt is unavailable until :meth:`close` is called.
+    """
+
+    def __init__(self, child, prompt, fifo_dir=None):
+        """
+        Args:
+            child: The pexpect spawn instance running casapy.
+            prompt (str): Casapy prompt regex, used to detect when the
+                serving loop has exited.
+            fifo_dir (str): Directory to create the named pipes in.
+                If ``None``, a temporary directory is created (and removed
+                again on :meth:`close`).
+        """
+        self.child = child
+        self.prompt = prompt
+        self._own_fifo_dir = fifo_dir is None
+        if fifo_dir is None:
+            fifo_dir = tempfile.mkdtemp(prefix='drivecasa-fifo-')
+        self.fifo_dir = fifo_dir
+        self.command_path = os.path.join(fifo_dir, 'commands')
+        self.result_path = os.path.join(fifo_dir, 'results')
+        self._command_fd = None
+        self._result_fd = None
+        self._seq = 0
+        #: Marker pattern for the command currently running, if any.
+        self.pending = None
+        #: Whether the first line of output preceding the next marker is
+        #: not the command's own: either the echoed command which started
+        #: the serving loop, or the end of the previous marker line.
+        self.skip_first_line = True
+
+    def open(self, timeout=60):
+        """
+        Create the named pipes and start the serving loop inside casapy.
+        """
+        os.mkfifo(self.command_path)
+        os.mkfifo(self.result_path)
+        self.child.sendline("drivecasa_serve_fifo('{}', '{}')".format(
+            self.command_path, self.result_path))
+        self.skip_first_line = getattr(self.child, 'echo', True)
+        # Opening a FIFO for writing fails with ENXIO until casapy has
+        # opened the other end for reading, so poll until it does.
+        deadline = time.time() + timeout
+        while self._command_fd is None:
+            try:
+                self._command_fd = os.open(self.command_path,
+                                           os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                if not self.child.isalive() or time.time() > deadline:
+                    self._remove_fifos()
+                    raise RuntimeError(
+                        "Casapy did not open the command channel at " +
+                        self.command_path)
+                time.sleep(0.01)
+        _set_blocking(self._command_fd)
+        self._result_fd = os.open(self.result_path,
+                                  os.O_RDONLY | os.O_NONBLOCK)
+        _set_blocking(self._result_fd)
+        logger.debug("Opened casapy command channel in %s", self.fifo_dir)
+
+    def send(self, source):
+        """
+        Send ``source`` to casapy for execution, without waiting.
+
+        Returns:
+            Regex matching the marker line casapy prints once the command
+            has completed. Once this has been matched (e.g. via
+            ``child.expect``), call :meth:`receive` to collect the result.
+        """
+        self._seq += 1
+        if not isinstance(source, bytes):
+            source = source.encode('utf-8')
+        _write_all(self._command_fd,
+                   _header.pack(self._seq, len(source)) + source)
+        self.pending = r'<<drivecasa:fifo:{}:(ok|error|interrupted)>>'.format(
+            self._seq)
+        return self.pending
+
+    def receive(self):
+        """
+        Collect the result of the command most recently sent.
+
+        Returns:
+            Tuple ``(out_lines, status, message)``, where ``out_lines`` is
+            the terminal output produced while running the command,
+            ``status`` is one of 'ok', 'error' or 'interrupted', and
+            ``message`` is the exception summary if an exception was raised.
+        """
+        self.pending = None
+        out_lines = self.child.before.split(self.child.crlf)
+        if self.skip_first_line:
+            out_lines = out_lines[1:]
+        self.skip_first_line = True
+        seq, frame = self._read_frame()
+        if seq != self._seq:
+            raise RuntimeError(
+                "Casapy command channel out of sync (expected result {}, "
+                "got {})".format(self._seq, seq))
+        if not isinstance(frame, str):
+            frame = frame.decode('utf-8')
+        status, _, message = frame.partition('\n')
+        return out_lines, status, message
+
+    def close(self, timeout=60):
+        """
+        Stop the serving loop, returning casapy to its prompt.
+        """
+        if self._command_fd is not None:
+            try:
+                if self.child.isalive():
+                    # A zero-length frame signals the end of the session.
+                    _write_all(self._command_fd, _header.pack(0, 0))
+                    self.child.expect(self.prompt, timeout=timeout)
+            finally:
+                os.close(self._command_fd)
+                os.close(self._result_fd)
+                self._command_fd = None
+                self._result_fd = None
+        self._remove_fifos()
+
+    def _read_frame(self, timeout=60):
+        header = self._read_exactly(_header.size, timeout)
+        seq, length = _header.unpack(header)
+        return seq, self._read_exactly(length, timeout)
+
+    def _read_exactly(self, n_bytes, timeout):
+        data = b''
+        while len(data) < n_bytes:
+            ready, _, _ = select.select([self._result_fd], [], [], timeout)
+            if not ready:
+                raise RuntimeError("Timed out reading from casapy result "
+                                   "channel.")
+            chunk = os.read(self._result_fd, n_bytes - len(data))
+            if not chunk:
+                raise RuntimeError("Casapy closed the result channel.")
+            data += chunk
+        return data
+
+    def _remove_fifos(self):
+        for path in (self.command_path, self.result_path):
+            if os.path.exists(path):
+                os.remove(path)
+        if self._own_fifo_dir and os.path.isdir(self.fifo_dir):
+            shutil.rmtree(self.fifo_dir)
+
+
+def _set_blocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+
+
+def _write_all(fd, data):
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
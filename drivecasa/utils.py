@@ -1,5 +1,36 @@
-import collections
+import errno
+import logging
 import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+
+try:
+    from collections.abc import Iterable
+except ImportError:  # Python 2
+    from collections import Iterable
+
+try:
+    string_types = basestring
+    text_type = unicode
+except NameError:  # Python 3
+    string_types = str
+    text_type = str
+
+logger = logging.getLogger(__name__)
+
+#: Default for the ``background`` argument of :func:`remove_tree`.
+#: Set to ``False`` to make all overwrites delete synchronously.
+background_removal = True
+
+_removal_cond = threading.Condition()
+_removal_queue = deque()
+_removal_state = {'worker': None, 'active': False}
+# Name of a tree renamed aside by remove_tree, with the owning process id.
+_aside_name = re.compile(r'^\..+\.deleting-(\d+)-[0-9a-f]{8}$')
 
 
 def ensure_dir(dirname):
@@ -74,10 +105,11 @@ def byteify(input):
     cf http://stackoverflow.com/a/13105359/725650
     """
     if isinstance(input, dict):
-        return {byteify(key):byteify(value) for key,value in input.iteritems()}
+        return {byteify(key):byteify(value) for key,value in input.items()}
     elif isinstance(input, list):
         return [byteify(element) for element in input]
-    elif isinstance(input, unicode):
+    elif isinstance(input, text_type) and not isinstance(input, str):
+        # (Python 2 only - on Python 3 all strings are unicode.)
         return input.encode('utf-8')
     else:
         return input
@@ -89,9 +121,133 @@ def listify(x):
     Returns:
         x or [x], accordingly.
     """
-    if isinstance(x, basestring):
+    if isinstance(x, string_types):
         return [x]
-    elif isinstance(x, collections.Iterable):
+    elif isinstance(x, Iterable):
         return x
     else:
-        return [x]
\ No newline at end of file
+        return [x]
+
+
+def remove_tree(path, background=None):
+    """
+    Delete a directory tree (e.g. a MeasurementSet) without waiting.
+
+    The directory is renamed aside (to a hidden name in the same parent
+    directory, so the rename is atomic and ``path`` is immediately free for
+    re-use), then deleted by a background thread. Use
+    :func:`wait_for_removals` to wait for pending deletions to complete,
+    e.g. before a step which needs the disk-space back. Deletions still
+    pending when the Python process exits are completed before it exits.
+    Any trees left aside by a process which died before deleting them are
+    deleted by the next call for the same parent directory.
+
+    Files (rather than directories) are simply deleted.
+
+    Args:
+        path (str): Directory to delete.
+        background (bool): Delete in the background. Defaults to the
+            module-level :data:`background_removal` setting.
+    """
+    if background is None:
+        background = background_removal
+    if not os.path.isdir(path):
+        os.remove(path)
+        return
+    parent, basename = os.path.split(os.path.abspath(path))
+    stale = _claim_stale_removals(parent)
+    if not background:
+        for aside_path in stale + [path]:
+            shutil.rmtree(aside_path)
+        return
+    aside_path = _aside_path(parent, basename)
+    os.rename(path, aside_path)
+    with _removal_cond:
+        _removal_queue.extend(stale + [aside_path])
+        if _removal_state['worker'] is None:
+            worker = threading.Thread(target=_remove_queued,
+                                      name='drivecasa-remove-tree')
+            _removal_state['worker'] = worker
+            worker.start()
+        _removal_cond.notify_all()
+
+
+def _aside_path(parent, basename):
+    return os.path.join(parent, '.{}.deleting-{}-{}'.format(
+        basename, os.getpid(), uuid.uuid4().hex[:8]))
+
+
+def _claim_stale_removals(parent):
+    """
+    Find trees renamed aside by :func:`remove_tree` in a process which died
+    before deleting them, and rename them again to claim them for this
+    process.
+
+    Returns:
+        List of the claimed paths, to be deleted.
+    """
+    claimed = []
+    for name in os.listdir(parent):
+        match = _aside_name.match(name)
+        if match is None or _pid_alive(int(match.group(1))):
+            continue
+        basename = name[1:name.rindex('.deleting-')]
+        aside_path = _aside_path(parent, basename)
+        try:
+            os.rename(os.path.join(parent, name), aside_path)
+        except OSError:
+            # Claimed by another process in the meantime.
+            continue
+        logger.debug("Deleting stale %s", os.path.join(parent, name))
+        claimed.append(aside_path)
+    return claimed
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def wait_for_removals(timeout=None):
+    """
+    Wait for the deletions started by :func:`remove_tree` to complete.
+
+    Args:
+        timeout (float): Maximum time to wait, in seconds. ``None`` implies
+            wait indefinitely.
+
+    Returns:
+        ``True`` if all pending deletions have completed.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    with _removal_cond:
+        while _removal_queue or _removal_state['active']:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            _removal_cond.wait(remaining)
+        return True
+
+
+def _remove_queued():
+    """
+    Background worker for :func:`remove_tree`. Exits once the queue is empty.
+    """
+    while True:
+        with _removal_cond:
+            if not _removal_queue:
+                _removal_state['worker'] = None
+                _removal_cond.notify_all()
+                return
+            aside_path = _removal_queue.popleft()
+            _removal_state['active'] = True
+        try:
+            shutil.rmtree(aside_path)
+        except Exception as e:
+            logger.warning("Could not delete %s: %s", aside_path, e)
+        with _removal_cond:
+            _removal_state['active'] = False
+            _removal_cond.notify_all()
@@ -5,6 +5,7 @@ import versioneer
 
 install_requires = [
         'astropy',
+        'numpy',
         'pexpect>4',
     ]
 
@@ -13,6 +14,7 @@ setup(
     version=versioneer.get_version(),
     cmdclass=versioneer.get_cmdclass(),
     packages=find_packages(),
+    package_data={'drivecasa.testing': ['fakecasa/bin/casa']},
     description="An interfacing package for scripting CASA from an "
                 "external pipeline.",
     author="Tim Staley",
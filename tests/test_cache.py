@@ -0,0 +1,64 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+from drivecasa.cache import CachedStep, ResultCache, fingerprint
+
+
+class TestResultCache(TestCase):
+    """
+    Check cache keys and invalidation, without running casapy.
+    """
+    def shortDescription(self):
+        return None
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.in_path = os.path.join(self.tmpdir, 'in.ms')
+        os.mkdir(self.in_path)
+        self.write(os.path.join(self.in_path, 'table.dat'), 'abc')
+        self.out_path = os.path.join(self.tmpdir, 'out.fits')
+        self.step = CachedStep("exportfits('in.ms')",
+                               inputs=[self.in_path],
+                               outputs=[self.out_path])
+        self.cache = ResultCache(os.path.join(self.tmpdir, 'cache.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, contents):
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def test_step_is_a_string(self):
+        self.assertEqual(self.step, "exportfits('in.ms')")
+        self.assertEqual(repr([self.step]), repr(["exportfits('in.ms')"]))
+
+    def test_fingerprint(self):
+        self.assertIsNone(fingerprint(self.out_path))
+        before = fingerprint(self.in_path, content_hash=True)
+        self.write(os.path.join(self.in_path, 'table.dat'), 'abd')
+        self.assertNotEqual(before,
+                            fingerprint(self.in_path, content_hash=True))
+
+    def test_record_and_invalidate(self):
+        self.assertFalse(self.cache.is_fresh(self.step))
+        # Outputs missing, so not recorded:
+        self.cache.record(self.step)
+        self.assertFalse(self.cache.is_fresh(self.step))
+        self.write(self.out_path, 'fits')
+        self.cache.record(self.step)
+        self.assertTrue(self.cache.is_fresh(self.step))
+        # Reloaded from disk:
+        self.assertTrue(ResultCache(self.cache.path).is_fresh(self.step))
+        # Plain strings are never cached:
+        self.assertFalse(self.cache.is_fresh(str(self.step)))
+        # Changed input:
+        self.write(os.path.join(self.in_path, 'extra.dat'), 'x')
+        self.assertFalse(self.cache.is_fresh(self.step))
+
+    def test_output_changed(self):
+        self.write(self.out_path, 'fits')
+        self.cache.record(self.step)
+        os.remove(self.out_path)
+        self.assertFalse(self.cache.is_fresh(self.step))
@@ -0,0 +1,71 @@
+from unittest import TestCase
+import os
+import drivecasa
+from drivecasa.capture import (CaptureAll, CaptureErrors, CapturePolicy,
+                               CaptureTail, SpillToDisk)
+
+severe_line = '2016-05-04 12:00:00\tSEVERE\timportuvfits::::\tOops'
+
+
+class TestCaptureBuffers(TestCase):
+    """
+    Check the output buffers behave as advertised, without running casapy.
+    """
+    def shortDescription(self):
+        return None
+
+    def setUp(self):
+        self.lines = ['line {}'.format(i) for i in range(10)]
+
+    def test_default_policy(self):
+        for policy in (CapturePolicy(), CaptureAll()):
+            buf = policy.new_buffer()
+            buf.extend(self.lines)
+            self.assertEqual(buf, self.lines)
+
+    def test_tail(self):
+        buf = CaptureTail(3).new_buffer()
+        buf.extend(self.lines)
+        self.assertEqual(list(buf), self.lines[-3:])
+        self.assertEqual(len(buf), 3)
+        self.assertEqual(buf[-1], self.lines[-1])
+        self.assertEqual(buf.n_dropped, 7)
+
+    def test_errors_only(self):
+        buf = CaptureErrors().new_buffer()
+        buf.extend(self.lines + [severe_line, 'NameError: foo'])
+        self.assertEqual(list(buf), [severe_line, 'NameError: foo'])
+
+    def test_spill(self):
+        buf = SpillToDisk(4).new_buffer()
+        buf.extend(self.lines)
+        self.assertEqual(len(buf), 10)
+        self.assertTrue(os.path.isfile(buf.spill_path))
+        self.assertEqual(list(buf), self.lines)
+        self.assertEqual(buf[2], self.lines[2])
+        self.assertEqual(buf[8], self.lines[8])
+        self.assertEqual('\n'.join(buf), '\n'.join(self.lines))
+        spill_path = buf.spill_path
+        buf.close()
+        self.assertFalse(os.path.exists(spill_path))
+
+
+class TestCaptureInterface(TestCase):
+    def shortDescription(self):
+        return None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.casa = drivecasa.Casapy(echo_to_stdout=False,
+                                    output_capture=CaptureTail(2))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.casa.close()
+
+    def test_tail_capture(self):
+        script = ['for i in range(10): print "Hello", i',
+                  'importuvfits("dummy_in.fits", "dummy_out.ms")']
+        out, errors = self.casa.run_script(script, raise_on_severe=False)
+        self.assertEqual(len(out), 2)
+        self.assertEqual(len(errors), 1)
@@ -1,6 +1,7 @@
 import unittest
 from unittest import TestCase
 import drivecasa
+import json
 import os
 import tempfile
 from drivecasa import default_test_ouput_dir
@@ -31,3 +32,20 @@ class TestCommandLogging(TestCase):
         self.assertEqual(commands_logged, script)
         # print "Command log", commands_log
         os.remove(commands_logfile)
+
+    def test_stats_logging(self):
+        with tempfile.NamedTemporaryFile(delete=False) as tmpfile:
+            stats_logfile = tmpfile.name
+            os.remove(stats_logfile)
+        casa = drivecasa.Casapy(stats_logfile=stats_logfile,
+                                echo_to_stdout=False)
+        script = ['tasklist()', 'x = 1']
+        result = casa.run_script(script)
+        self.assertEqual([s.command for s in result.stats], script)
+        self.assertEqual([s.index for s in result.stats], [0, 1])
+        self.assertTrue(all(s.wall_time >= 0 for s in result.stats))
+        with open(stats_logfile) as f:
+            stats_logged = [json.loads(line) for line in f]
+        self.assertEqual([s['command'] for s in stats_logged], script)
+        casa.close()
+        os.remove(stats_logfile)
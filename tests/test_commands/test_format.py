@@ -0,0 +1,38 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import drivecasa.commands.format as fmt
+
+
+class TestRegions(TestCase):
+    def shortDescription(self):
+        return None
+
+    def test_mask_strings(self):
+        self.assertEqual(
+            fmt.circular_mask_string([('10deg', '5deg')] * 2),
+            'circle [ [ 10deg , 5deg] , 1arcmin ]\n' * 2)
+        self.assertEqual(fmt.box_mask_string(None, 4), '')
+
+    def test_circle_regions(self):
+        regions = fmt.circle_regions(np.array([[10., 5.], [11., -5.5]]),
+                                        radius='30arcsec')
+        self.assertEqual(regions, ['circle[[10.0deg, 5.0deg], 30arcsec]',
+                                   'circle[[11.0deg, -5.5deg], 30arcsec]'])
+
+    def test_box_regions(self):
+        self.assertEqual(fmt.box_regions([(10, 20)], 5),
+                         ['box[[7.5pix, 17.5pix], [12.5pix, 22.5pix]]'])
+
+    def test_write_region_file(self):
+        centres = np.random.uniform(0, 10, size=(10000, 2))
+        with tempfile.NamedTemporaryFile(suffix='.crtf', delete=False) as f:
+            path = f.name
+        fmt.write_region_file(path, fmt.circle_regions(centres))
+        with open(path) as f:
+            lines = f.read().splitlines()
+        os.remove(path)
+        self.assertEqual(lines[0], fmt.crtf_header)
+        self.assertEqual(len(lines), 10001)
@@ -42,6 +42,22 @@ class TestComponentList(TestCase):
         out, err = self.casa.run_script([])
         self.assertTrue(os.path.isdir(out_path))
 
+    def test_componentlist_bulk(self):
+        srclist = [
+            (SkyCoord(10 * u.deg, (5 + 0.01 * i) * u.deg), 1.5 * u.mJy,
+             3 * u.GHz,)
+            for i in range(1000)
+        ]
+        out_path = os.path.join(self.output_dir, "bulk.cl")
+        script = []
+        sim.make_componentlist_bulk(script, srclist, out_path)
+        self.assertEqual(len(script), 1)
+        self.casa.run_script(script)
+        out, err = self.casa.run_script(
+            ["cl.open('{}')".format(out_path), 'print cl.length()',
+             'cl.close()'])
+        self.assertIn('1000', out)
+
 
 class TestMeasurementSimulation(TestCase):
     def setUp(self):
@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+import astropy.units as u
+import numpy as np
+import drivecasa.commands.simulation as sim
+from astropy.coordinates import SkyCoord
+
+
+class TestSourceLists(TestCase):
+    """
+    Script generation from source lists (no casapy or sample data needed).
+    """
+    def shortDescription(self):
+        return None
+
+    def setUp(self):
+        self.posns = SkyCoord([10, 10] * u.deg, [5, 5.1] * u.deg)
+        self.fluxes = [1.5, 15] * u.mJy
+        self.freqs = [3, 2.5] * u.GHz
+
+    def test_componentlist_array_input(self):
+        script = []
+        sim.make_componentlist(script,
+                               (self.posns, self.fluxes, self.freqs),
+                               '/tmp/array.cl')
+        # cl.done, one addcomponent per source, rename and close.
+        self.assertEqual(len(script), 5)
+        self.assertIn("flux=0.015,", script[2])
+
+        list_script = []
+        sim.make_componentlist(
+            list_script,
+            [(SkyCoord(10 * u.deg, 5 * u.deg), 1.5 * u.mJy, 3 * u.GHz),
+             (SkyCoord(10 * u.deg, 5.1 * u.deg), 15 * u.mJy, 2.5 * u.GHz)],
+            '/tmp/array.cl')
+        self.assertEqual(script, list_script)
+
+    def test_source_table(self):
+        table = sim.source_table((self.posns, self.fluxes, self.freqs))
+        self.assertEqual(table.dtype, sim.source_table_dtype)
+        np.testing.assert_allclose(table['dec_deg'], [5, 5.1])
+        np.testing.assert_allclose(table['flux_jy'], [1.5e-3, 1.5e-2])
+        np.testing.assert_allclose(table['freq_hz'], [3e9, 2.5e9])
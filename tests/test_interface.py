@@ -1,10 +1,13 @@
+import sys
 import unittest
 from unittest import TestCase
 import drivecasa
 import os
+import shutil
 import tempfile
 import pexpect.exceptions
 from drivecasa import default_test_ouput_dir
+from drivecasa.cache import CachedStep
 
 
 class TestDefaultCasaInterface(TestCase):
@@ -74,19 +77,225 @@ class TestDefaultCasaInterface(TestCase):
         with self.assertRaises(ValueError):
             out, errors = self.casa.run_script(script)
 
+    def test_exception_status(self):
+        # No 'Error:' in the output, so only caught via the command status.
+        script = ['raise Exception("boom")']
+        with self.assertRaises(ValueError):
+            out, errors = self.casa.run_script(script)
+
+    def test_prompt_in_output(self):
+        script = ['import time',
+                  'print "CASA <99>: not a prompt"; time.sleep(0.2); '
+                  'print "Hello world"']
+        out, errors = self.casa.run_script(script)
+        self.assertIn('Hello world', out)
+
     def test_error_reporting(self):
         script = ['importuvfits("dummy_in.fits", "dummy_out.ms")']
         out, errors = self.casa.run_script(script, raise_on_severe=False)
         self.assertEqual(len(errors), 1)
 
+    def test_batched_commands(self):
+        script = ['x = 21',
+                  'print "Hello world"',
+                  'print x * 2']
+        out, errors = self.casa.run_script(script, batch_size=2)
+        self.assertEqual([l for l in out if l], ['Hello world', '42'])
+        self.assertEqual(len(errors), 0)
+
+    def test_batched_error_attribution(self):
+        script = ['print "Hello world"',
+                  'importuvfits("dummy_in.fits", "dummy_out.ms")',
+                  'print foobar']
+        out, errors = self.casa.run_script(script[:2], raise_on_severe=False,
+                                           batch_size=len(script))
+        self.assertEqual(len(errors), 1)
+        with self.assertRaises(RuntimeError) as cm:
+            self.casa.run_script(script, batch_size=len(script))
+        self.assertIn('importuvfits', str(cm.exception))
+        with self.assertRaises(ValueError) as cm:
+            self.casa.run_script(script, raise_on_severe=False,
+                                 batch_size=len(script))
+        self.assertIn('print foobar', str(cm.exception))
+
+    def test_iter_script(self):
+        script = ['print "Hello world"',
+                  'importuvfits("dummy_in.fits", "dummy_out.ms")']
+        lines = [l for l in self.casa.iter_script(script,
+                                                  raise_on_severe=False)
+                 if l.text]
+        self.assertEqual(lines[0].text, 'Hello world')
+        self.assertEqual(lines[0].index, 0)
+        severe = [l for l in lines if l.severe]
+        self.assertEqual(len(severe), 1)
+        self.assertEqual(severe[0].command, script[1])
+        with self.assertRaises(RuntimeError):
+            list(self.casa.iter_script(script))
+
+    def test_iter_script_trailing_output(self):
+        # Output printed after the completion sentinel (here by the
+        # interactive display hook) is kept when streaming, as when not.
+        self.casa.run_script(["import sys; sys.displayhook = "
+                              "lambda v: sys.stdout.write('trailing\\n')"])
+        try:
+            out, errors = self.casa.run_script(['print "hi"'])
+            lines = [l.text for l in self.casa.iter_script(['print "hi"'])]
+        finally:
+            self.casa.run_script(['sys.displayhook = sys.__displayhook__'])
+        self.assertEqual([l for l in lines if l], [l for l in out if l])
+
+    def test_evaluate(self):
+        self.assertEqual(self.casa.evaluate('6 * 7'), 42)
+        self.assertEqual(self.casa.evaluate("{'a': [1, 2.5]}"),
+                         {'a': [1, 2.5]})
+        self.casa.run_script(['import numpy'])
+        pixels = self.casa.evaluate('numpy.ones((3, 2), dtype=numpy.int16)')
+        self.assertEqual(pixels.shape, (3, 2))
+        self.assertEqual(pixels.dtype.name, 'int16')
+        stats = self.casa.evaluate("{'max': numpy.array([1.5]), "
+                                   "'npts': numpy.float64(4)}")
+        self.assertEqual(stats['max'].tolist(), [1.5])
+        self.assertEqual(stats['npts'], 4)
+        with self.assertRaises(ValueError):
+            self.casa.evaluate('undefined_name')
+
+    def test_evaluate_leaves_script_state(self):
+        self.casa.run_script(['x = 1'])
+        stats = self.casa.command_stats
+        history = list(self.casa.session_history)
+        self.assertEqual(self.casa.evaluate('x + 1'), 2)
+        self.assertIs(self.casa.command_stats, stats)
+        self.assertEqual(self.casa.session_history, history)
+
+    def test_image_pixels(self):
+        output_dir = tempfile.mkdtemp()
+        image_path = os.path.join(output_dir, 'test.image')
+        self.casa.run_script(["ia.fromshape('{}', [8, 8, 1, 4])".format(
+            image_path), "ia.close()"])
+        stats = self.casa.command_stats
+        pixels = self.casa.image_pixels(image_path)
+        self.assertEqual(pixels.shape, (8, 8, 1, 4))
+        # Fake casapy pixel values are x + 10 * y + 100 * channel
+        self.assertEqual(pixels[1, 2, 0, 3], 321)
+        region = self.casa.image_pixels(image_path, blc=[2, 3, 0, 1],
+                                        trc=[4, 7])
+        self.assertEqual(region.shape, (3, 5, 1, 3))
+        self.assertEqual(region.tolist(), pixels[2:5, 3:8, :, 1:].tolist())
+        self.assertIs(self.casa.command_stats, stats)
+        shutil.rmtree(output_dir)
+
+    def test_lazy_subroutines(self):
+        with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
+            f.write('# x y z d\n1 2 3 25\n')
+            antennalist_path = f.name
+        script = ["x, y, z, d = drivecasa_load_antennalist('{}')".format(
+            antennalist_path), 'print d']
+        out, errors = self.casa.run_script(script)
+        self.assertIn('[25.0]', out)
+        # Parsed configuration is cached, but refreshed if the file changes.
+        with open(antennalist_path, 'a') as f:
+            f.write('4 5 6 12 # pad\n')
+        out, errors = self.casa.run_script(script)
+        os.remove(antennalist_path)
+        self.assertIn('[25.0, 12.0]', out)
+
+    def test_checkpoint_resume(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            checkpoint = f.name
+        script = ['print "Step", {}'.format(i) for i in range(4)]
+        failing_script = script[:2] + ['print foobar'] + script[3:]
+        with self.assertRaises(ValueError):
+            self.casa.run_script(failing_script, checkpoint=checkpoint)
+        out, errors = self.casa.run_script(script, checkpoint=checkpoint,
+                                           resume=True)
+        os.remove(checkpoint)
+        self.assertNotIn('Step 1', out)
+        self.assertIn('Step 2', out)
+        self.assertIn('Step 3', out)
+
+    def test_iter_script_abort(self):
+        script = ['import time',
+                  'for i in range(100):\n'
+                  '    print "Hello", i\n'
+                  '    time.sleep(1)']
+        lines = self.casa.iter_script(script)
+        for line in lines:
+            if line.text == 'Hello 1':
+                lines.close()
+        out, errors = self.casa.run_script(['print "Hello world"'])
+        self.assertIn('Hello world', out)
+
     def test_timeout(self):
         script = ['import math',
                   'print math.pi',
                   ]
         self.casa.run_script(script)
         with self.assertRaises(pexpect.exceptions.TIMEOUT):
-            self.casa.run_script(script, timeout=1e-5)
+            self.casa.run_script(['import time', 'time.sleep(10)'],
+                                 timeout=0.5)
+        self.casa.interrupt()
+        out, errors = self.casa.run_script(script)
+        self.assertIn('3.14159265359', out)
+
+
+class TestFifoTransportCasaInterface(TestDefaultCasaInterface):
+    """
+    Re-run the interface tests, passing commands via the fifo transport.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.casa = drivecasa.Casapy(echo_to_stdout=False, transport='fifo')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.casa.close()
+
+
+class TestPipeEngineCasaInterface(TestDefaultCasaInterface):
+    """
+    Re-run the interface tests, with casapy run via pipes rather than a pty.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.casa = drivecasa.Casapy(echo_to_stdout=False, engine='pipe')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.casa.close()
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            drivecasa.Casapy(engine='telnet')
 
+    def test_close_releases_pipes(self):
+        casa = drivecasa.Casapy(echo_to_stdout=False, engine='pipe')
+        child = casa.child
+        casa.close()
+        self.assertTrue(child.closed)
+        self.assertTrue(child.proc.stdin.closed)
+
+
+class TestPipeEngineFifoTransportCasaInterface(TestDefaultCasaInterface):
+    """
+    Re-run the interface tests, with both the pipe engine and fifo transport.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.casa = drivecasa.Casapy(echo_to_stdout=False, engine='pipe',
+                                    transport='fifo')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.casa.close()
+
+    def test_first_command_output(self):
+        casa = drivecasa.Casapy(echo_to_stdout=False, engine='pipe',
+                                transport='fifo')
+        try:
+            out, errors = casa.run_script(['print "Hello world"'])
+        finally:
+            casa.close()
+        self.assertEqual([l for l in out if l], ['Hello world'])
 
 
 #         print "Errors:", errors
@@ -102,3 +311,163 @@ class TestDefaultCasaInterface(TestCase):
 #         print stdout
 #         print "Stderr:"
 #         print stderr
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio API requires Python 3.5+")
+class TestAsyncCasaInterface(TestCase):
+    """
+    Ensure the asyncio API can drive several sessions concurrently.
+    """
+    def shortDescription(self):
+        return None
+
+    @classmethod
+    def setUpClass(cls):
+        import asyncio
+        cls.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(cls.loop)
+        cls.casas = [drivecasa.Casapy(echo_to_stdout=False),
+                     drivecasa.Casapy(echo_to_stdout=False)]
+
+    @classmethod
+    def tearDownClass(cls):
+        for casa in cls.casas:
+            casa.close()
+        cls.loop.close()
+
+    def test_concurrent_scripts(self):
+        import asyncio
+        scripts = [['print "Hello {}"'.format(i)] for i in range(2)]
+        results = self.loop.run_until_complete(asyncio.gather(
+            *[casa.run_script_async(script)
+              for casa, script in zip(self.casas, scripts)]))
+        for i, (out, errors) in enumerate(results):
+            self.assertIn('Hello {}'.format(i), out)
+            self.assertEqual(len(errors), 0)
+
+    def test_exception_on_general_error(self):
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(
+                self.casas[0].run_script_async(['print foobar']))
+
+    def test_cancellation(self):
+        import asyncio
+        casa = self.casas[0]
+        task = self.loop.create_task(
+            casa.run_script_async(['import time', 'time.sleep(60)']))
+        self.loop.run_until_complete(asyncio.sleep(2))
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            self.loop.run_until_complete(task)
+        out, errors = casa.run_script(['print "Hello world"'])
+        self.assertIn('Hello world', out)
+
+    def test_script_file_lazy_subroutines(self):
+        base_path = tempfile.mktemp()
+        with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
+            f.write("drivecasa_save_value(42, '{}')\n".format(base_path))
+            script_path = f.name
+        try:
+            out, errors = self.loop.run_until_complete(
+                self.casas[1].run_script_from_file_async(script_path))
+            with open(base_path + '.json') as f:
+                self.assertEqual(f.read(), '42')
+        finally:
+            os.remove(script_path)
+            if os.path.exists(base_path + '.json'):
+                os.remove(base_path + '.json')
+
+
+class TestCrashRecovery(TestCase):
+    def shortDescription(self):
+        return None
+
+    def setUp(self):
+        with tempfile.NamedTemporaryFile(delete=False) as tmpfile:
+            self.crash_flag = tmpfile.name
+        os.remove(self.crash_flag)
+        # Kills casapy the first time it is run only.
+        self.crash_cmd = (
+            "import os; os._exit(1) if not os.path.exists('{0}') "
+            "and not open('{0}', 'w').close() else None".format(
+                self.crash_flag))
+        self.casa = drivecasa.Casapy(echo_to_stdout=False,
+                                     crash_recovery=True)
+
+    def tearDown(self):
+        self.casa.close()
+        if os.path.exists(self.crash_flag):
+            os.remove(self.crash_flag)
+
+    def test_resume_after_crash(self):
+        script = ['x = 41', 'x += 1', self.crash_cmd, 'print "x is", x']
+        out, errors = self.casa.run_script(script, batch_size=10)
+        self.assertIn('x is 42', out)
+        self.assertEqual(self.casa.session_history, script)
+
+    def test_cached_steps_not_replayed(self):
+        with tempfile.NamedTemporaryFile(delete=False) as tmpfile:
+            counter = tmpfile.name
+        try:
+            step = CachedStep("open('{}', 'a').write('x')".format(counter))
+            script = ['x = 42', step, self.crash_cmd, 'print "x is", x']
+            out, errors = self.casa.run_script(script, batch_size=10)
+            self.assertIn('x is 42', out)
+            with open(counter) as f:
+                self.assertEqual(f.read(), 'x')
+        finally:
+            os.remove(counter)
+
+    def test_replay_leaves_no_side_files(self):
+        output_dir = tempfile.mkdtemp()
+        image_path = os.path.join(output_dir, 'test.image')
+        value_path = os.path.join(output_dir, 'value')
+        working_dir = self.casa._spawn_args[2]
+
+        def side_files():
+            return ([p for p in os.listdir(tempfile.gettempdir())
+                     if p.startswith('drivecasa-value-')],
+                    [p for p in os.listdir(working_dir)
+                     if p.startswith('drivecasa-pixels-')])
+        try:
+            before = side_files()
+            self.casa.run_script(["ia.fromshape('{}', [8, 8, 1, 4])".format(
+                image_path), "ia.close()",
+                "drivecasa_save_value(1, '{}')".format(value_path)])
+            os.remove(value_path + '.json')
+            self.assertEqual(self.casa.evaluate('6 * 7'), 42)
+            self.assertEqual(self.casa.image_pixels(image_path).shape,
+                             (8, 8, 1, 4))
+            out, errors = self.casa.run_script(
+                ['x = 42', self.crash_cmd, 'print "x is", x'])
+            self.assertIn('x is 42', out)
+            self.assertEqual(side_files(), before)
+            self.assertFalse(os.path.exists(value_path + '.json'))
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_no_history_without_recovery(self):
+        casa = drivecasa.Casapy(echo_to_stdout=False)
+        try:
+            casa.run_script(['x = 42'])
+            self.assertEqual(casa.session_history, [])
+        finally:
+            casa.close()
+
+    def test_repeated_crash(self):
+        with self.assertRaises(pexpect.exceptions.EOF):
+            self.casa.run_script(['import os; os._exit(1)'])
+
+    @unittest.skipIf(sys.version_info < (3, 5),
+                     "asyncio API requires Python 3.5+")
+    def test_resume_after_crash_async(self):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        script = ['x = 41', 'x += 1', self.crash_cmd, 'print "x is", x']
+        try:
+            out, errors = loop.run_until_complete(
+                self.casa.run_script_async(script, batch_size=10))
+        finally:
+            loop.close()
+        self.assertIn('x is 42', out)
+        self.assertEqual(self.casa.session_history, script)
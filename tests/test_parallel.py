@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import astropy.units as u
+from astropy.time import Time
+import drivecasa
+import drivecasa.commands.simulation as sim
+from drivecasa.utils import wait_for_removals
+from drivecasa.parallel import (
+    parallel_clean, parallel_simulate, shard_seed, split_range)
+
+
+class TestSplitRange(TestCase):
+    def shortDescription(self):
+        return None
+
+    def test_even(self):
+        self.assertEqual(split_range(0, 8, 4), [(0, 2), (2, 2), (4, 2), (6, 2)])
+
+    def test_uneven(self):
+        chunks = split_range(10, 7, 3)
+        self.assertEqual(chunks, [(10, 2), (12, 2), (14, 3)])
+        self.assertEqual(sum(n for _, n in chunks), 7)
+
+    def test_more_chunks_than_items(self):
+        self.assertEqual(split_range(0, 2, 4), [(0, 1), (1, 1)])
+
+
+class TestParallelClean(TestCase):
+    """
+    Run against the fake casapy, which just creates the expected maps.
+    """
+    def shortDescription(self):
+        return None
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp(prefix='drivecasa-test-')
+        self.vis = os.path.join(self.output_dir, 'obs.ms')
+        os.makedirs(self.vis)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_parallel_clean(self):
+        with drivecasa.CasapyPool(2, echo_to_stdout=False) as pool:
+            maps = parallel_clean(pool, self.vis, niter=100,
+                                  threshold_in_jy=1e-3, nchan=16,
+                                  out_dir=self.output_dir)
+        for path in (maps.image, maps.model, maps.residual, maps.psf):
+            self.assertTrue(os.path.isdir(path))
+        self.assertIsNone(maps.mask)
+        # Chunk products are removed in the background.
+        wait_for_removals()
+        leftovers = [p for p in os.listdir(self.output_dir) if '.chunk' in p]
+        self.assertEqual(leftovers, [])
+
+
+class TestParallelSimulate(TestCase):
+    def shortDescription(self):
+        return None
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp(prefix='drivecasa-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_shard_seeds(self):
+        seeds = [shard_seed(42, i) for i in range(4)]
+        self.assertEqual(seeds, [shard_seed(42, i) for i in range(4)])
+        self.assertEqual(len(set(seeds)), 4)
+        self.assertNotEqual(seeds, [shard_seed(43, i) for i in range(4)])
+
+    def test_parallel_simulate(self):
+        def configure(script):
+            sim.setfeed(script)
+            sim.setauto(script)
+            sim.settimes(script, integration_time=10 * u.s,
+                         reference_time=Time('2014-05-01T19:55:45'))
+
+        output_ms = os.path.join(self.output_dir, 'sim.ms')
+        with drivecasa.CasapyPool(2, echo_to_stdout=False) as pool:
+            path = parallel_simulate(pool, output_ms, configure,
+                                     integration_time=10 * u.s,
+                                     stop_delay=600 * u.s,
+                                     noise_std_dev=1 * u.mJy)
+        self.assertEqual(path, output_ms)
+        self.assertTrue(os.path.isdir(output_ms))
+        wait_for_removals()
+        self.assertEqual(os.listdir(self.output_dir), ['sim.ms'])
+
+    def test_parallel_simulate_exists(self):
+        output_ms = os.path.join(self.output_dir, 'sim.ms')
+        os.makedirs(output_ms)
+        with drivecasa.CasapyPool(1, echo_to_stdout=False) as pool:
+            with self.assertRaises(ValueError):
+                parallel_simulate(pool, output_ms, lambda script: None,
+                                  integration_time=10 * u.s,
+                                  stop_delay=600 * u.s, overwrite=False)
+        self.assertEqual(os.listdir(output_ms), [])
@@ -0,0 +1,71 @@
+from unittest import TestCase
+import drivecasa
+
+
+class TestCasapyPool(TestCase):
+    """
+    Ensure that pooled casapy sessions are handed out and recycled correctly.
+    """
+    def shortDescription(self):
+        return None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = drivecasa.CasapyPool(2, echo_to_stdout=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def test_session_reuse(self):
+        with self.pool.session() as casa:
+            out, errors = casa.run_script(['print "Hello world"'])
+            self.assertEqual(len(errors), 0)
+        with self.pool.session() as casa:
+            self.assertTrue(casa.isalive())
+
+    def test_state_reset_on_checkin(self):
+        casa = self.pool.checkout()
+        casa.run_script(['_dc_foo = 1'])
+        self.pool.checkin(casa)
+        # Check out both sessions to be sure we see the one used above.
+        sessions = [self.pool.checkout(), self.pool.checkout()]
+        for casa in sessions:
+            with self.assertRaises(ValueError):
+                casa.run_script(['print _dc_foo'])
+        for casa in sessions:
+            self.pool.checkin(casa)
+
+    def test_dead_session_replaced(self):
+        casa = self.pool.checkout()
+        casa.close()
+        self.pool.checkin(casa)
+        sessions = [self.pool.checkout(timeout=120),
+                    self.pool.checkout(timeout=120)]
+        for casa in sessions:
+            self.assertTrue(casa.isalive())
+            self.pool.checkin(casa)
+
+    def test_checkin_foreign_session(self):
+        casa = drivecasa.Casapy(echo_to_stdout=False)
+        try:
+            with self.assertRaises(ValueError):
+                self.pool.checkin(casa)
+        finally:
+            casa.close()
+
+
+class TestCasapyPoolRespawnFailure(TestCase):
+    def shortDescription(self):
+        return None
+
+    def test_failed_respawn_raised(self):
+        with drivecasa.CasapyPool(1, echo_to_stdout=False) as pool:
+            pool.respawn_attempts = 2
+            pool.respawn_delay = 0.1
+            pool._casapy_kwargs['casa_dir'] = '/nonexistent/casa'
+            casa = pool.checkout()
+            pool.checkin(casa, discard=True)
+            with self.assertRaises(RuntimeError) as cm:
+                pool.checkout(timeout=60)
+            self.assertIn('Could not respawn', str(cm.exception))
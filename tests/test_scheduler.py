@@ -0,0 +1,50 @@
+from unittest import TestCase
+import drivecasa
+from drivecasa.cache import CachedStep
+from drivecasa.scheduler import TaskGraph
+
+
+def step(inputs, outputs, command='pass'):
+    return CachedStep(command, inputs=inputs, outputs=outputs)
+
+
+class TestTaskGraph(TestCase):
+    """
+    Check dependencies are inferred from paths, and respected when run.
+    """
+    def shortDescription(self):
+        return None
+
+    def test_dependencies(self):
+        graph = TaskGraph.from_script([
+            step(['/data/a.fits'], ['/data/a.ms']),
+            step(['/data/b.fits'], ['/data/b.ms']),
+            step(['/data/a.ms'], ['/data/a.clean.image']),
+            step(['/data/a.ms/ANTENNA'], ['/data/a.ant']),
+            'print "barrier"',
+            step(['/data/c.fits'], ['/data/c.ms']),
+        ])
+        import_a, import_b, clean_a, ant_a, barrier, import_c = graph.tasks
+        self.assertEqual(import_b.dependencies, set())
+        self.assertEqual(clean_a.dependencies, set([import_a]))
+        self.assertEqual(ant_a.dependencies, set([import_a]))
+        self.assertEqual(barrier.dependencies,
+                         set([import_a, import_b, clean_a, ant_a]))
+        self.assertEqual(import_c.dependencies, set([barrier]))
+
+    def test_write_after_read(self):
+        graph = TaskGraph()
+        read = graph.add([step(['/data/a.ms'], ['/data/a.image'])])
+        overwrite = graph.add([step(['/data/x.fits'], ['/data/a.ms'])])
+        self.assertEqual(overwrite.dependencies, set([read]))
+
+    def test_run(self):
+        graph = TaskGraph()
+        graph.add([step([], ['/tmp/a'], '_dc_x = 1'), 'print "A", _dc_x'])
+        graph.add([step([], ['/tmp/b'], 'print "B"')])
+        graph.add([step(['/tmp/a', '/tmp/b'], [], 'print "C"')])
+        with drivecasa.CasapyPool(2, echo_to_stdout=False) as pool:
+            results = graph.run(pool)
+        for (casa_out, errors), expected in zip(results, ['A 1', 'B', 'C']):
+            self.assertIn(expected, casa_out)
+        self.assertEqual(results[2], graph.tasks[2].result)
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import drivecasa
+from drivecasa.cache import ResultCache
+from drivecasa.commands import clean, mstransform
+from drivecasa.staging import Staging
+
+
+class TestStaging(TestCase):
+    """
+    Run against the fake casapy, which just creates the expected outputs.
+    """
+    def shortDescription(self):
+        return None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.casa = drivecasa.Casapy(echo_to_stdout=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.casa.close()
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='drivecasa-test-')
+        self.data_dir = os.path.join(self.temp_dir, 'data')
+        self.vis = os.path.join(self.data_dir, 'obs.ms')
+        os.makedirs(self.vis)
+        with open(os.path.join(self.vis, 'table.dat'), 'w') as f:
+            f.write('visibilities\n')
+        self.staging = Staging(os.path.join(self.temp_dir, 'scratch'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_staged_pipeline(self):
+        script = []
+        split_vis = mstransform(script, self.vis,
+                                os.path.join(self.data_dir, 'split.ms'),
+                                staging=self.staging)
+        # No wait needed between staged commands in the same session.
+        maps = clean(script, split_vis, niter=100, threshold_in_jy=1e-3,
+                     staging=self.staging)
+        self.staging.wait(script)
+        self.assertIn('/scratch/', script[1])
+        self.casa.run_script(script)
+
+        self.assertTrue(os.path.isdir(split_vis))
+        self.assertTrue(os.path.isdir(maps.image))
+        self.assertFalse(os.path.exists(self.staging.scratch_path(maps.image)))
+        staged_input = self.staging.scratch_path(self.vis)
+        self.assertTrue(os.path.isdir(staged_input))
+
+        # Unchanged inputs are not copied again.
+        rerun = script[:1] + script[-1:]
+        marker = os.path.join(staged_input, 'marker')
+        open(marker, 'w').close()
+        self.casa.run_script(rerun)
+        self.assertTrue(os.path.exists(marker))
+        with open(os.path.join(self.vis, 'table.dat'), 'a') as f:
+            f.write('more visibilities\n')
+        self.casa.run_script(rerun)
+        self.assertFalse(os.path.exists(marker))
+
+    def test_staged_steps_cached(self):
+        cache = ResultCache(os.path.join(self.temp_dir, 'results.json'))
+        casa = drivecasa.Casapy(echo_to_stdout=False, result_cache=cache)
+        try:
+            script = []
+            split_vis = mstransform(script, self.vis,
+                                    os.path.join(self.data_dir, 'split.ms'),
+                                    staging=self.staging)
+            clean(script, split_vis, niter=100, threshold_in_jy=1e-3,
+                  staging=self.staging)
+            casa.run_script(script)
+            # Not recorded until the outputs are known to be back.
+            self.assertFalse(any(cache.is_fresh(step) for step in script))
+            self.staging.wait(script)
+            casa.run_script(script)
+            self.assertTrue(all(cache.is_fresh(step) for step in script[:2]))
+        finally:
+            casa.close()
@@ -0,0 +1,53 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from unittest import TestCase
+from drivecasa.utils import remove_tree, wait_for_removals
+
+
+class TestRemoveTree(TestCase):
+    def shortDescription(self):
+        return None
+
+    def setUp(self):
+        self.parent = tempfile.mkdtemp(prefix='drivecasa-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.parent)
+
+    def make_tree(self, name):
+        path = os.path.join(self.parent, name)
+        for i in range(20):
+            subdir = os.path.join(path, 'sub{}'.format(i))
+            os.makedirs(subdir)
+            with open(os.path.join(subdir, 'table.dat'), 'w') as f:
+                f.write('x' * 1000)
+        return path
+
+    def test_background_removal(self):
+        paths = [self.make_tree('obs{}.ms'.format(i)) for i in range(3)]
+        for path in paths:
+            remove_tree(path)
+            # Path is free for re-use straight away.
+            self.assertFalse(os.path.exists(path))
+            os.makedirs(path)
+        self.assertTrue(wait_for_removals(timeout=30))
+        self.assertEqual(sorted(os.listdir(self.parent)),
+                         ['obs0.ms', 'obs1.ms', 'obs2.ms'])
+
+    def test_stale_removal_swept(self):
+        # Left aside by a process which died before deleting it.
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        stale = self.make_tree('.old.ms.deleting-{}-0123abcd'.format(
+            proc.pid))
+        remove_tree(self.make_tree('obs.ms'))
+        self.assertTrue(wait_for_removals(timeout=30))
+        self.assertFalse(os.path.exists(stale))
+        self.assertEqual(os.listdir(self.parent), [])
+
+    def test_synchronous_removal(self):
+        path = self.make_tree('obs.ms')
+        remove_tree(path, background=False)
+        self.assertEqual(os.listdir(self.parent), [])